@@ -1,18 +1,43 @@
 import streamlit as st
 import os
 import random
+import shutil
 import tempfile
+import glob
+import hashlib
+import importlib.util
+import math
+import json
+import base64
+import sqlite3
+import subprocess
+import sys
+import threading
+import uuid
 import time
 import numpy as np
+from collections import OrderedDict, deque
 from datetime import datetime
 import bisect
-from moviepy.editor import VideoFileClip, concatenate_videoclips, ImageClip, CompositeVideoClip
-from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+import copy
+import queue
+# Solo le classi base di MoviePy (servono alle sottoclassi qui sotto):
+# moviepy.editor si porterebbe dietro tutti gli fx, IPython e la preview
+# pygame a ogni avvio. librosa, gli fx (resize/crop), concatenate e numba
+# si importano alla prima analisi / al primo render (vedi bench-startup).
+from moviepy.video.VideoClip import VideoClip
+from moviepy.video.io.VideoFileClip import VideoFileClip
+from moviepy.audio.AudioClip import AudioClip
+from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader, ffmpeg_parse_infos
 from PIL import Image
-import librosa
-from dataclasses import dataclass, field
+import proglog
+from dataclasses import asdict, dataclass, field
 from typing import Callable, Optional
 
+# Inizio dell'esecuzione dello script: con "streamlit run" ogni rerun
+# riesegue il modulo da capo (vedi PROFILO DEI RERUN).
+_SCRIPT_T0 = time.perf_counter()
+
 # ---------------------------------------------------------------------------
 # MODULATION LAB (opzionale, additivo) — incollato qui per tenere l'app in un
 # unico file (nessuna dipendenza esterna da caricare separatamente su
@@ -125,15 +150,28 @@ def fit_to_size(clip, target_size):
     cw, ch = clip.size
     if cw == tw and ch == th:
         return clip
+    from moviepy.video.fx.crop import crop
+    from moviepy.video.fx.resize import resize
+    new_w, new_h, x1, y1 = fit_geometry((cw, ch), target_size)
+    resized = resize(clip, newsize=(new_w, new_h))
+    return crop(resized, x1=x1, y1=y1, width=tw, height=th)
+
+
+def fit_geometry(src_size, target_size):
+    """Conti del crop-to-fill di fit_to_size: (new_w, new_h, x1, y1) =
+    dimensione dopo lo scale e angolo del ritaglio target_size. Gli
+    stessi numeri finiscono anche nel filtro ffmpeg dei reader delle
+    sorgenti (LazyVideoFileClip fit_size), che decodificano gia' alla
+    dimensione di export."""
+    tw, th = target_size
+    cw, ch = src_size
     scale = max(tw / cw, th / ch)
     new_w, new_h = max(1, round(cw * scale)), max(1, round(ch * scale))
-    resized = clip.resize(newsize=(new_w, new_h))
-    x1 = max(0, (new_w - tw) // 2)
-    y1 = max(0, (new_h - th) // 2)
-    return resized.crop(x1=x1, y1=y1, width=tw, height=th)
+    return new_w, new_h, max(0, (new_w - tw) // 2), max(0, (new_h - th) // 2)
 
 
-def apply_beat_color_react(clip, band_envelope, duration, intensity, profile_acc=None):
+def apply_beat_color_react(clip, band_envelope, duration, intensity, profile_acc=None,
+                           threads=1):
     """
     Tint colore additivo mappato sulle bande di frequenza: bassi->rosso,
     medi->verde, alti->blu (mappatura sinestetica classica, leggibile:
@@ -155,30 +193,13 @@ def apply_beat_color_react(clip, band_envelope, duration, intensity, profile_acc
                     nostra) durante write_videofile. Serve solo a
                     profilare dove va il tempo di un render vero, non ha
                     effetto sul risultato.
+    threads       : thread per frame (run_tiled, a fasce di righe); stesso
+                    risultato a qualunque valore.
     """
-    if intensity <= 0 or not band_envelope:
-        return clip
-
-    low  = band_envelope.get("low")
-    mid  = band_envelope.get("mid")
-    high = band_envelope.get("high")
-    if not low or not mid or not high:
+    tint_at = beat_color_tint(band_envelope, duration, intensity)
+    if tint_at is None:
         return clip
 
-    n = len(low)
-    step = duration / n if n else 0.05
-
-    def _at(arr, t):
-        idx = int(t / step) if step > 0 else 0
-        idx = max(0, min(idx, len(arr) - 1))
-        return arr[idx]
-
-    # Soglia sotto la quale il tint sarebbe visivamente impercettibile:
-    # saltiamo interamente frame astype/clip/cast su passaggi quieti
-    # (silenzio, break, codetta) invece di applicare un'operazione
-    # sull'intero frame per un risultato che non si vedrebbe comunque.
-    _SKIP_EPS = 2.0  # su scala 0-255
-
     # Additivo (non moltiplicativo): a intensity bassa il colore resta
     # riconoscibile ma non lava via i toni originali del video, a intensity
     # alta il tint domina — il clamp finale evita overflow visibile.
@@ -187,18 +208,20 @@ def apply_beat_color_react(clip, band_envelope, duration, intensity, profile_acc
     # memoria per frame (misurato: ~2x piu' veloce a 720p) — nessuna nuova
     # dipendenza (niente cv2), solo numpy che il progetto usa gia'.
     def _color_fx(get_frame, t):
-        r = _at(low,  t)
-        g = _at(mid,  t)
-        b = _at(high, t)
-        tint = np.array([r, g, b], dtype=np.float32) * 255.0 * intensity
-        if np.abs(tint).max() < _SKIP_EPS:
+        tint = tint_at(t)
+        if tint is None:
             return get_frame(t)
         frame = get_frame(t)
         _t0 = time.perf_counter() if profile_acc is not None else None
-        out = frame.astype(np.int16)
-        out += tint.astype(np.int16)
-        np.clip(out, 0, 255, out=out)
-        result = out.astype(np.uint8)
+        result = np.empty_like(frame, dtype=np.uint8)
+
+        def _tile(y0, y1):
+            out = frame[y0:y1].astype(np.int16)
+            out += tint
+            np.clip(out, 0, 255, out=out)
+            result[y0:y1] = out
+
+        run_tiled(threads, frame.shape[0], _tile)
         if profile_acc is not None:
             profile_acc[0] += time.perf_counter() - _t0
         return result
@@ -206,10 +229,57 @@ def apply_beat_color_react(clip, band_envelope, duration, intensity, profile_acc
     return clip.fl(_color_fx)
 
 
+def beat_color_tint(band_envelope, duration, intensity):
+    """t -> tint int16 (r, g, b) di apply_beat_color_react, None se a t il
+    tint e' impercettibile; None al posto della funzione se l'effetto e'
+    spento. Separata dall'effetto perche' serve anche alla chiave dei
+    frame statici di write_video (stesso tint = stesso effetto)."""
+    if intensity <= 0 or not band_envelope:
+        return None
+
+    low  = band_envelope.get("low")
+    mid  = band_envelope.get("mid")
+    high = band_envelope.get("high")
+    if not low or not mid or not high:
+        return None
+
+    n = len(low)
+    step = duration / n if n else 0.05
+
+    # Soglia sotto la quale il tint sarebbe visivamente impercettibile:
+    # saltiamo interamente frame astype/clip/cast su passaggi quieti
+    # (silenzio, break, codetta) invece di applicare un'operazione
+    # sull'intero frame per un risultato che non si vedrebbe comunque.
+    _SKIP_EPS = 2.0  # su scala 0-255
+
+    # Tint e soglia calcolati una volta per tutta la griglia (stessa
+    # aritmetica float32 di un tint alla volta): a ogni frame resta
+    # l'indice, niente np.array/abs/max per frame.
+    tints = _envelope_grid((low, mid, high), n, np.float32) * 255.0 * intensity
+    skip = np.abs(tints).max(axis=1) < _SKIP_EPS
+    tints = tints.astype(np.int16)
+
+    def _tint_at(t):
+        idx = int(t / step) if step > 0 else 0
+        idx = max(0, min(idx, n - 1))
+        return None if skip[idx] else tints[idx]
+
+    return _tint_at
+
+
+def _envelope_grid(bands, n, dtype):
+    """Bande di un inviluppo come matrice (n, len(bands)) sulla griglia di
+    lunghezza n; una banda piu' corta ripete l'ultimo valore (lo stesso
+    clamp dell'indice che si faceva banda per banda)."""
+    idx = np.arange(n)
+    return np.stack([np.asarray(b, dtype=dtype)[np.minimum(idx, len(b) - 1)] for b in bands], axis=1)
+
+
 _LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
 
 
-def apply_beat_saturation_react(clip, band_envelope, duration, intensity, profile_acc=None):
+def apply_beat_saturation_react(clip, band_envelope, duration, intensity, profile_acc=None,
+                                threads=1):
     """
     Boost di SATURAZIONE, non tint: a differenza di apply_beat_color_react
     (che sovrappone un colore additivo sopra il video), questa funzione
@@ -234,53 +304,175 @@ def apply_beat_saturation_react(clip, band_envelope, duration, intensity, profil
     profile_acc   : lista mutabile [float] opzionale, stesso scopo che in
                     apply_beat_color_react — misura i secondi REALI spesi
                     qui dentro durante write_videofile.
+    threads       : thread per frame, come in apply_beat_color_react.
     """
-    if intensity <= 0 or not band_envelope:
+    factor_at = beat_saturation_factor(band_envelope, duration, intensity)
+    if factor_at is None:
         return clip
 
+    def _sat_fx(get_frame, t):
+        factor = factor_at(t)
+        if factor is None:
+            return get_frame(t)
+        frame = get_frame(t)
+        _t0 = time.perf_counter() if profile_acc is not None else None
+        result = np.empty_like(frame, dtype=np.uint8)
+
+        # gray + (f - gray) * factor sul solo array float32 di f, senza i
+        # temporanei a 3 canali di ogni operazione: stessa aritmetica,
+        # stesso ordine della somma sui canali, ~3x piu' veloce a 720p.
+        def _tile(y0, y1):
+            f = frame[y0:y1].astype(np.float32)
+            gray = f[:, :, 0] * _LUMA_WEIGHTS[0]
+            gray += f[:, :, 1] * _LUMA_WEIGHTS[1]
+            gray += f[:, :, 2] * _LUMA_WEIGHTS[2]
+            gray = gray[:, :, None]
+            f -= gray
+            f *= factor
+            f += gray
+            np.clip(f, 0, 255, out=f)
+            result[y0:y1] = f
+
+        run_tiled(threads, frame.shape[0], _tile)
+        if profile_acc is not None:
+            profile_acc[0] += time.perf_counter() - _t0
+        return result
+
+    return clip.fl(_sat_fx)
+
+
+def beat_saturation_factor(band_envelope, duration, intensity):
+    """t -> fattore di saturazione di apply_beat_saturation_react, None se
+    a t il boost e' impercettibile; None al posto della funzione se
+    l'effetto e' spento (come beat_color_tint)."""
+    if intensity <= 0 or not band_envelope:
+        return None
+
     low  = band_envelope.get("low")
     mid  = band_envelope.get("mid")
     high = band_envelope.get("high")
     if not low or not mid or not high:
-        return clip
+        return None
 
     n = len(low)
     step = duration / n if n else 0.05
 
-    def _energy_at(t):
-        idx = int(t / step) if step > 0 else 0
-        idx = max(0, min(idx, n - 1))
-        return max(low[idx], mid[idx], high[idx])
-
     _SKIP_EPS = 0.01  # energia sotto la quale il boost sarebbe impercettibile
 
-    def _sat_fx(get_frame, t):
-        energy = _energy_at(t)
-        if energy < _SKIP_EPS:
-            return get_frame(t)
-        frame = get_frame(t)
-        _t0 = time.perf_counter() if profile_acc is not None else None
-        f = frame.astype(np.float32)
-        gray = (f * _LUMA_WEIGHTS).sum(axis=2, keepdims=True)
-        factor = 1.0 + energy * intensity * 2.0  # 1x (nessun cambio) -> ~3x
-        out = gray + (f - gray) * factor
-        result = np.clip(out, 0, 255).astype(np.uint8)
-        if profile_acc is not None:
-            profile_acc[0] += time.perf_counter() - _t0
-        return result
+    # Come in beat_color_tint, fattori e soglia per tutta la griglia in una
+    # volta (float64, come l'aritmetica Python di un fattore alla volta).
+    energy = _envelope_grid((low, mid, high), n, np.float64).max(axis=1)
+    skip = energy < _SKIP_EPS
+    factors = 1.0 + energy * intensity * 2.0  # 1x (nessun cambio) -> ~3x
 
-    return clip.fl(_sat_fx)
+    def _factor_at(t):
+        idx = int(t / step) if step > 0 else 0
+        idx = max(0, min(idx, n - 1))
+        # float Python, non np.float64: con le regole di promozione di
+        # NumPy 2 un float64 porterebbe il frame float32 dell'effetto a float64
+        return None if skip[idx] else float(factors[idx])
+
+    return _factor_at
+
+
+# Colore e saturazione reattivi come filtri dell'encoder: per frame
+# servono solo tre offset e un fattore, non serve passare l'intero frame
+# per numpy. sendcmd li cambia al volo su lutrgb (offset per canale, lo
+# stesso clip a 0-255 del path numpy: identico) e su colorchannelmixer
+# (saturazione come matrice RGB, gray + (x - gray) * f con i pesi di
+# _LUMA_WEIGHTS e un solo clip finale: entro 2 livelli). Non eq/hue: la
+# saturazione in YUV esce dal gamut sui colori gia' saturi e il clip
+# avviene solo in riproduzione, dopo il sottocampionamento della
+# crominanza (aloni visibili sui bordi).
+ENCODER_COLOR_FILTERS = ("sendcmd", "lutrgb", "colorchannelmixer")
+# I coefficienti di colorchannelmixer stanno in [-2, 2]: la diagonale
+# f + (1 - f) * 0.114 arriva a 2 con f ~2.13. Oltre, due stadi (f1 * f2:
+# le matrici di saturazione si compongono), con un clip in piu' in mezzo.
+_MIXER_MAX_FACTOR = 2.12
+_ffmpeg_filter_names = {}
+
+
+def ffmpeg_has_filters(names):
+    """True se l'ffmpeg di MoviePy ha tutti i filtri in names (elenco
+    letto una volta per processo)."""
+    from moviepy.config import get_setting
+    binary = get_setting("FFMPEG_BINARY")
+    if binary not in _ffmpeg_filter_names:
+        try:
+            out = subprocess.run([binary, "-hide_banner", "-filters"], capture_output=True,
+                                 text=True, timeout=30).stdout
+        except (OSError, subprocess.SubprocessError):
+            out = ""
+        _ffmpeg_filter_names[binary] = {p[1] for p in (l.split() for l in out.splitlines()) if len(p) > 2}
+    return all(n in _ffmpeg_filter_names[binary] for n in names)
+
+
+def encoder_color_filter(tint_at, factor_at, fps, duration, cmd_path):
+    """-vf per l'encoder di write_video con gli stessi tint_at
+    (beat_color_tint) e factor_at (beat_saturation_factor) degli effetti
+    numpy, uno dei due puo' essere None. Scrive in cmd_path il file di
+    sendcmd: un comando solo quando i valori cambiano, valutati sugli
+    stessi istanti di write_video e inviati a meta' strada dal frame
+    precedente (i pts del rawvideo sono n / fps), cosi' ogni frame riceve
+    esattamente i valori del path numpy."""
+    states = []
+    for n, t in enumerate(np.arange(0, duration, 1.0 / fps)):
+        tint = tint_at(t) if tint_at is not None else None
+        factor = factor_at(t) if factor_at is not None else None
+        state = (tuple(tint.tolist()) if tint is not None else (0, 0, 0),
+                 factor if factor is not None else 1.0)
+        if not states or state != states[-1][1]:
+            states.append((n, state))
+    stages = 1
+    if factor_at is not None and max(f for _, (_, f) in states) > _MIXER_MAX_FACTOR:
+        stages = 2
+    lines = []
+    for n, (tint, factor) in states:
+        cmds = []
+        if tint_at is not None:
+            cmds += [f"lutrgb@beat {c} clip(val+{d}\\,0\\,255)" for c, d in zip("rgb", tint)]
+        if factor_at is not None:
+            f1 = min(factor, _MIXER_MAX_FACTOR)
+            for stage, f in zip(range(stages), (f1, factor / f1)):
+                cmds += [f"colorchannelmixer@sat{stage} {k} {v:.6f}"
+                         for k, v in _saturation_matrix(f).items()]
+        lines.append(f"{max(0.0, (n - 0.5) / fps):.6f} {', '.join(cmds)};")
+    with open(cmd_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    path = cmd_path.replace("\\", "/").replace(":", "\\:")
+    chain = [f"sendcmd=f='{path}'"]
+    if tint_at is not None:
+        chain.append("lutrgb@beat")
+    if factor_at is not None:
+        chain += [f"colorchannelmixer@sat{stage}" for stage in range(stages)]
+    return ",".join(chain)
+
+
+def _saturation_matrix(f):
+    """Opzioni di colorchannelmixer per gray + (x - gray) * f."""
+    return {f"{o}{i}": (f if o == i else 0.0) + (1.0 - f) * float(w)
+            for o in "rgb" for i, w in zip("rgb", _LUMA_WEIGHTS)}
 
 
 # --- ANALISI AUDIO ---
-def analyze_audio(audio_file, duration, fast_mode=False):
+def _audio_local_path(audio_file):
+    """Path su disco da passare a librosa: un path (str) si usa cosi'
+    com'e', un file-like viene copiato a blocchi in un temporaneo.
+    Ritorna (path, temporaneo_da_rimuovere)."""
+    if isinstance(audio_file, str):
+        return audio_file, False
     orig_name = getattr(audio_file, "name", "") or ""
     suffix = os.path.splitext(orig_name)[1].lower()
     if suffix not in (".mp3", ".wav"):
         suffix = ".mp3"
     with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as t:
-        t.write(audio_file.read())
-        tmp_path = t.name
+        shutil.copyfileobj(audio_file, t, _UPLOAD_CHUNK)
+        return t.name, True
+
+
+def analyze_audio(audio_file, duration, fast_mode=False):
+    import librosa
+    tmp_path, is_tmp = _audio_local_path(audio_file)
     try:
         y, sr = librosa.load(tmp_path, sr=22050, mono=True, duration=duration)
         actual_dur = (len(y) / sr) if sr else 0.0
@@ -415,30 +607,27 @@ def analyze_audio(audio_file, duration, fast_mode=False):
             "melody": _to_envelope(melody_norm),
         }
     finally:
-        os.remove(tmp_path)
+        if is_tmp:
+            os.remove(tmp_path)
     return beat_times, rms_envelope, band_envelope, onset_times
 
 def detect_bpm(audio_file):
     """Stima rapida del BPM analizzando solo i primi 30s del file audio.
     Restituisce il BPM come float, o None in caso di errore.
-    Non consuma il file_uploader (fa seek(0) alla fine)."""
+    Accetta un path o un file-like (che non consuma: fa seek(0) alla fine)."""
+    import librosa
     try:
-        orig_name = getattr(audio_file, "name", "") or ""
-        suffix = os.path.splitext(orig_name)[1].lower()
-        if suffix not in (".mp3", ".wav"):
-            suffix = ".mp3"
-        audio_file.seek(0)
-        raw = audio_file.read()
-        audio_file.seek(0)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as t:
-            t.write(raw)
-            tmp_path = t.name
+        if not isinstance(audio_file, str):
+            audio_file.seek(0)
+        tmp_path, is_tmp = _audio_local_path(audio_file)
         try:
             y, sr = librosa.load(tmp_path, sr=22050, mono=True, duration=30.0)
             tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
             return float(tempo)
         finally:
-            os.remove(tmp_path)
+            if is_tmp:
+                os.remove(tmp_path)
+                audio_file.seek(0)
     except Exception:
         return None
 
@@ -504,31 +693,198 @@ def build_start_offset_matrix(onset_times, duration, attack=0.06, decay=0.35,
     return matrix
 
 
-def get_preview_frame_from_upload(uploaded_file, max_w=260):
-    """MODULATION LAB (UI): estrae un frame di anteprima (t=0) da un file
-    video caricato, ridimensionato per una preview leggera nel pannello
-    'Sorgenti caricate'. Usa un tempfile indipendente da quello creato in
-    fase di rendering (do_final): serve solo a mostrare un'anteprima, non
-    tocca in alcun modo la pipeline di generazione.
+# Anteprime: ffmpeg chiamato direttamente (un seek in input + filtro scale
+# per ogni istante, piu' istanti in una sola invocazione per la
+# filmstrip) invece di aprire un VideoFileClip (probe + decoder) per
+# prendere un frame e ridimensionarlo con PIL. I frame restano in una
+# cache LRU condivisa tra sessioni, chiave (contenuto, t, larghezza).
+#
+# Cache della UI: ogni widget toccato riesegue main() da capo, quindi
+# tutto cio' che costa (ffmpeg, librosa) passa da una cache con scadenza
+# e limite espliciti — st.cache_data per i risultati piccoli (BPM, probe
+# dei video), la LRU qui sotto (st.cache_resource, budget in byte) per i
+# frame, che st.cache_data copierebbe a ogni lettura. Le chiavi sono per
+# contenuto (_content_key), mai per sessione.
+UI_CACHE_TTL_S = 2 * 3600
+UI_CACHE_MAX_ENTRIES = 64
+THUMB_CACHE_MAX_BYTES = 64 * 1024 ** 2
+EXTRACT_TAIL_MARGIN_S = 0.1     # distanza minima dalla fine per i seek delle miniature
+
+
+class _ThumbCache:
+    """LRU di frame numpy con budget in byte (non in numero di voci: una
+    cattura a 1920px pesa come ~60 miniature a 260px) e scadenza ttl."""
+
+    def __init__(self, max_bytes=THUMB_CACHE_MAX_BYTES, ttl=UI_CACHE_TTL_S):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._items = OrderedDict()   # chiave -> (frame, istante di inserimento)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            frame, stamp = item
+            if self.ttl and time.monotonic() - stamp > self.ttl:
+                del self._items[key]
+                self._bytes -= frame.nbytes
+                return None
+            self._items.move_to_end(key)
+            return frame
 
-    Non solleva mai eccezioni: l'anteprima e' un extra opzionale, non deve
-    mai poter bloccare l'app. Ritorna None se la decodifica fallisce.
-    """
+    def put(self, key, frame):
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = (frame, time.monotonic())
+            self._bytes += frame.nbytes
+            while self._bytes > self.max_bytes and len(self._items) > 1:
+                _, (old, _) = self._items.popitem(last=False)
+                self._bytes -= old.nbytes
+
+
+@st.cache_resource
+def _thumb_cache():
+    return _ThumbCache()
+
+
+def _ui_cache_data(**options):
+    # st.cache_data solo sotto "streamlit run": la CLI e i worker del
+    # render importano lo stesso modulo ma non chiamano queste funzioni
+    # (e st.cache_data senza runtime riempirebbe il log di avvisi).
+    from streamlit import runtime
+    if not runtime.exists():
+        return lambda fn: fn
+    return st.cache_data(**options)
+
+
+@_ui_cache_data(ttl=UI_CACHE_TTL_S, max_entries=UI_CACHE_MAX_ENTRIES, show_spinner=False)
+def _cached_display_info(content_key, path):
+    # content_key fa da chiave (path + dimensione + mtime fuori dall'archivio)
+    return _video_display_info(path)
+
+
+@_ui_cache_data(ttl=UI_CACHE_TTL_S, max_entries=UI_CACHE_MAX_ENTRIES, show_spinner="Analisi BPM...")
+def _cached_bpm(path):
+    """detect_bpm per la UI, su un path dell'archivio upload (il nome del
+    file e' l'hash del contenuto: stesso brano, stessa voce)."""
+    return detect_bpm(path)
+
+
+def _video_display_info(path):
+    """(larghezza, altezza, durata, fps) come li vede l'utente: ffmpeg
+    ruota in automatico i video con metadato di rotazione."""
+    infos = ffmpeg_parse_infos(path)
+    w, h = infos["video_size"]
+    if infos.get("video_rotation", 0) in (90, 270):
+        w, h = h, w
+    return w, h, infos.get("duration") or 0.0, infos.get("video_fps") or 25.0
+
+
+def extract_frames(path, times, max_w=None):
+    """Frame RGB agli istanti 'times' (secondi), ridimensionati a max_w
+    di larghezza mantenendo le proporzioni (mai ingranditi), con UNA
+    invocazione di ffmpeg. Gli istanti oltre la fine del video vengono
+    portati vicino all'ultimo frame. Ritorna una lista di array, uno per
+    istante (None dove ffmpeg non ha prodotto il frame)."""
+    from moviepy.config import get_setting
+    w, h, duration, fps = _cached_display_info(_content_key(path), path)
+    if max_w and w > max_w:
+        out_w, out_h = int(max_w), max(1, int(h * max_w / w))
+    else:
+        out_w, out_h = w, h
+    # Un seek a duration - 1/fps puo' cadere oltre l'ultimo frame reale
+    # (durata del container arrotondata, timestamp non allineati): un
+    # frame intero piu' un margine di sicurezza.
+    last = max(0.0, duration - 1.0 / fps - EXTRACT_TAIL_MARGIN_S)
+    times = [min(max(0.0, float(t)), last) for t in times]
+
+    # Un'uscita per istante (non un unico concat): un ingresso che non
+    # produce il frame lascia vuoto solo il proprio file, senza far
+    # scivolare i frame successivi negli slot sbagliati.
+    frame_bytes = out_w * out_h * 3
+    with tempfile.TemporaryDirectory(prefix="loop507_frames_") as tmp:
+        outs = [os.path.join(tmp, f"{i}.rgb") for i in range(len(times))]
+        cmd = [get_setting("FFMPEG_BINARY"), "-v", "error"]
+        for t in times:
+            cmd += ["-ss", f"{t:.3f}", "-i", path]
+        cmd += ["-filter_complex", ";".join(f"[{i}:v]scale={out_w}:{out_h}[v{i}]"
+                                            for i in range(len(times)))]
+        for i, out in enumerate(outs):
+            cmd += ["-map", f"[v{i}]", "-frames:v", "1", "-f", "rawvideo", "-pix_fmt", "rgb24", out]
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        frames = []
+        for out in outs:
+            try:
+                with open(out, "rb") as f:
+                    data = f.read(frame_bytes)
+            except OSError:
+                data = b""
+            frames.append(np.frombuffer(data, dtype=np.uint8).reshape(out_h, out_w, 3).copy()
+                          if len(data) == frame_bytes else None)
+    return frames
+
+
+def _content_key(path):
+    # Nell'archivio upload il nome del file E' l'hash del contenuto (e
+    # l'mtime cambia a ogni uso); fuori, path + dimensione + mtime.
+    path = os.path.abspath(path)
+    if os.path.dirname(path) == os.path.abspath(UPLOAD_STORE_DIR):
+        return os.path.basename(path)
+    info = os.stat(path)
+    return (path, info.st_size, info.st_mtime_ns)
+
+
+def get_filmstrip(path, times, max_w=260):
+    """Come extract_frames, ma passando dalla cache: ffmpeg parte solo
+    per gli istanti mancanti. Non solleva mai eccezioni (l'anteprima e'
+    un extra): None al posto dei frame non leggibili."""
     try:
-        uploaded_file.seek(0)
-        tmp_path = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4').name
-        with open(tmp_path, "wb") as f:
-            f.write(uploaded_file.read())
-        uploaded_file.seek(0)
-        clip = VideoFileClip(tmp_path)
-        frame = clip.get_frame(0)
-        h, w = frame.shape[:2]
-        if w > max_w:
-            scale = max_w / w
-            new_w, new_h = max_w, max(1, int(h * scale))
-            frame = np.array(Image.fromarray(frame).resize((new_w, new_h)))
-        clip.close()
-        return frame
+        cache = _thumb_cache()
+        base = _content_key(path)
+        keys = [(base, round(float(t), 3), max_w) for t in times]
+        frames = [cache.get(k) for k in keys]
+        missing = [i for i, f in enumerate(frames) if f is None]
+        if missing:
+            extracted = extract_frames(path, [times[i] for i in missing], max_w)
+            if len(extracted) != len(missing):
+                # nessuna garanzia su quale frame sia quale: niente cache
+                return [None] * len(times)
+            for i, frame in zip(missing, extracted):
+                if frame is not None:
+                    frame.setflags(write=False)   # condiviso tra sessioni
+                    cache.put(keys[i], frame)
+                frames[i] = frame
+        return frames
+    except Exception:
+        return [None] * len(times)
+
+
+def get_thumbnail(path, t=0.0, max_w=260):
+    """Un frame di anteprima (default t=0, 260px): vedi get_filmstrip."""
+    return get_filmstrip(path, [t], max_w)[0]
+
+
+def get_source_filmstrip(path, n=5, max_w=120):
+    """Striscia di n miniature equidistanti lungo tutto il video, gia'
+    affiancate in un'unica immagine (None se il video non e' leggibile).
+    In cache come immagine intera: a ogni rerun niente probe ne' ffmpeg."""
+    try:
+        cache = _thumb_cache()
+        key = (_content_key(path), "filmstrip", n, max_w)
+        strip = cache.get(key)
+        if strip is None:
+            duration = _cached_display_info(_content_key(path), path)[2]
+            frames = get_filmstrip(path, [duration * (i + 0.5) / n for i in range(n)], max_w)
+            if any(f is None for f in frames):
+                return None
+            strip = np.concatenate(frames, axis=1)
+            strip.setflags(write=False)
+            cache.put(key, strip)
+        return strip
     except Exception:
         return None
 
@@ -563,7 +919,7 @@ def apply_selective_stripe(get_frame, t, duration, fps, opacity_curve,
                             content_follows_band=False,
                             content_anchor_pos_pct=50.0,
                             content_anchor_length_pos_pct=50.0,
-                            frozen_content=None):
+                            frozen_content=None, jit=False, threads=1):
     """MODULATION LAB: 'banda selettiva', ispirata al sistema a strisce di
     Recursive Cut Pro ma adattata alla pipeline di VideoDecomposer
     (post-processing sul clip GIA' composto, non un sistema multi-sorgente
@@ -700,15 +1056,71 @@ def apply_selective_stripe(get_frame, t, duration, fps, opacity_curve,
         if content_crop.shape[:2] != _target_hw:
             content_crop = np.array(Image.fromarray(content_crop).resize((_target_hw[1], _target_hw[0])))
 
-    frame[p0:p1, l0:l1] = (
-        frame[p0:p1, l0:l1].astype(np.float32) * (1 - opacity)
-        + content_crop.astype(np.float32) * opacity
-    ).astype(np.uint8)
+    kernels = jit_kernels() if jit else None
+    if kernels is not None:
+        # Stessa aritmetica float32 (pesi arrotondati a float32 come fa
+        # numpy con uno scalare Python), senza i tre array temporanei.
+        kernels.blend_region(frame, content_crop, p0, l0,
+                             np.float32(1 - opacity), np.float32(opacity))
+        return frame
+
+    def _tile(y0, y1):
+        frame[p0 + y0:p0 + y1, l0:l1] = (
+            frame[p0 + y0:p0 + y1, l0:l1].astype(np.float32) * (1 - opacity)
+            + content_crop[y0:y1].astype(np.float32) * opacity
+        ).astype(np.uint8)
+
+    run_tiled(threads, p1 - p0, _tile)
     return frame
 
 
+def chain_frame_key(below_key, param_at):
+    """Chiave di un effetto .fl() che a t dipende solo dal frame sotto e
+    da param_at(t) (tint, fattore di saturazione...): coppia (chiave del
+    clip sotto, parametro). Gli array diventano tuple, confrontabili."""
+    def _key(t):
+        base = below_key(t)
+        if base is None:
+            return None
+        param = param_at(t)
+        if isinstance(param, np.ndarray):
+            param = tuple(param.tolist())
+        return (base, param)
+    return _key
+
+
+def selective_stripe_key(below_key, t, duration, fps, opacity_curve,
+                         time_offset=2.0, stripe_source=None, base_opacity=0.0,
+                         frozen_content=None):
+    """Chiave del frame di apply_selective_stripe per write_video: la
+    chiave del clip sotto (below_key(t)) piu' cio' che a t cambia nella
+    banda — opacita' e, se il contenuto non e' un'immagine catturata,
+    il frame da cui viene ritagliato. None = non noto (niente riuso).
+    Geometria e parametri della banda sono fissi per tutto il render."""
+    base = below_key(t)
+    if base is None:
+        return None
+    pulse = 0.0
+    if opacity_curve is not None and len(opacity_curve) > 0:
+        idx = min(int(t * fps), len(opacity_curve) - 1)
+        pulse = float(opacity_curve[idx])
+    opacity = min(1.0, base_opacity + pulse)
+    if opacity <= 0.005:
+        return base
+    if frozen_content is not None:
+        content = ()
+    elif stripe_source is not None:
+        content = source_frame_key(stripe_source, t % max(stripe_source.duration, 0.001))
+    else:
+        content = below_key((t + time_offset) % max(duration, 0.001))
+    if content is None:
+        return None
+    return (base, opacity, content)
+
+
 # --- BANDE TEMPORALI (Temporal Band Slicer) ---
-def glitch_temporal_bands(frame, intensity=0.7, ampiezza_bande=0.5, spostamento=0.6, direzione=0.5):
+def glitch_temporal_bands(frame, intensity=0.7, ampiezza_bande=0.5, spostamento=0.6, direzione=0.5,
+                          threads=1):
     """
     Temporal Band Slicer: il frame viene tagliato in bande orizzontali di
     altezza variabile; ciascuna banda viene ricollocata da una diversa
@@ -726,11 +1138,29 @@ def glitch_temporal_bands(frame, intensity=0.7, ampiezza_bande=0.5, spostamento=
         spostamento    : 0-1, quanto lontano puo' saltare una banda
         direzione      : 0 = solo orizzontale, 1 = solo verticale,
                          0.5 = mix casuale banda per banda
+        threads        : thread per frame (run_tiled sulle bande, righe
+                         disgiunte); stesso risultato a qualunque valore.
 
     Ritorna: np.ndarray (H, W, 3) uint8 — stesso shape di frame.
     """
     h, w = frame.shape[:2]
+    moves = _temporal_bands_plan(h, w, intensity, ampiezza_bande, spostamento, direzione)
+    out = frame.copy()
+
+    # Le righe y:y_end del frame ruotato di (dy, dx) sono le righe
+    # (y - dy) % h ruotate di dx: si sposta solo la banda, non tutto il frame.
+    def _tile(i0, i1):
+        for y, y_end, dy, dx in moves[i0:i1]:
+            rows = (np.arange(y, y_end) - dy) % h
+            out[y:y_end] = np.roll(frame[rows], dx, axis=1)
+
+    run_tiled(threads, len(moves), _tile, min_items=2)
+    return out
+
 
+def _temporal_bands_plan(h, w, intensity, ampiezza_bande, spostamento, direzione):
+    """Le estrazioni casuali di glitch_temporal_bands, nello stesso ordine
+    di sempre: [(y, y_end, dy, dx)] delle sole bande spostate."""
     max_shift_x = max(10, int(w * (0.05 + 0.55 * spostamento)))
     max_shift_y = max(6, int(h * (0.03 + 0.45 * spostamento)))
     prob_band = float(np.clip(0.15 + 0.8 * intensity, 0.1, 0.95))
@@ -747,7 +1177,7 @@ def glitch_temporal_bands(frame, intensity=0.7, ampiezza_bande=0.5, spostamento=
         heights.append(bh)
         remaining -= bh
 
-    out = frame.copy()
+    moves = []
     y = 0
     for bh in heights:
         y_end = min(y + bh, h)
@@ -756,20 +1186,20 @@ def glitch_temporal_bands(frame, intensity=0.7, ampiezza_bande=0.5, spostamento=
                 dx, dy = 0, random.randint(-max_shift_y, max_shift_y)
             else:
                 dx, dy = random.randint(-max_shift_x, max_shift_x), 0
-            out[y:y_end] = np.roll(frame, (dy, dx), axis=(0, 1))[y:y_end]
+            moves.append((y, y_end, dy, dx))
         y = y_end
-
-    return out
+    return moves
 
 
-def apply_temporal_bands_clip(get_frame, t, intensity, ampiezza_bande, spostamento, direzione):
+def apply_temporal_bands_clip(get_frame, t, intensity, ampiezza_bande, spostamento, direzione,
+                              threads=1):
     """Wrapper per l'uso in .fl(): estrae il frame RGB (uint8) e applica
     glitch_temporal_bands, preservando eventuale canale alpha invariato."""
     frame = get_frame(t)
     rgb = frame[:, :, :3].astype(np.uint8)
     rgb_out = glitch_temporal_bands(
         rgb, intensity=intensity, ampiezza_bande=ampiezza_bande,
-        spostamento=spostamento, direzione=direzione
+        spostamento=spostamento, direzione=direzione, threads=threads
     )
     if frame.shape[2] == 4:
         out = frame.copy()
@@ -780,9 +1210,28 @@ def apply_temporal_bands_clip(get_frame, t, intensity, ampiezza_bande, spostamen
 
 # --- MOTORE PROCEDURALE (slit scan) ---
 def apply_procedural_slit_scan(get_frame, t, duration, val_a, val_b, is_random, scan_mode,
-                                rms_envelope=None):
+                                rms_envelope=None, threads=1):
     frame = get_frame(t).copy()
     h, w, _ = frame.shape
+    axis, strands = _slit_scan_plan(h, w, t, duration, val_a, val_b, is_random, scan_mode, rms_envelope)
+
+    # Strisce disgiunte (righe con asse 1, colonne con asse 0), ciascuna
+    # ruotata in place: si dividono fra i thread senza toccarsi.
+    def _tile(i0, i1):
+        for a0, a1, offset in strands[i0:i1]:
+            if axis == 1:
+                frame[a0:a1, :] = np.roll(frame[a0:a1, :], offset, axis=1)
+            else:
+                frame[:, a0:a1] = np.roll(frame[:, a0:a1], offset, axis=0)
+
+    run_tiled(threads, len(strands), _tile, min_items=2)
+    return frame
+
+
+def _slit_scan_plan(h, w, t, duration, val_a, val_b, is_random, scan_mode, rms_envelope):
+    """Le estrazioni casuali di apply_procedural_slit_scan, nello stesso
+    ordine di sempre: (asse del roll, [(inizio, fine, offset)]) delle sole
+    strisce spostate (righe con asse 1, colonne con asse 0)."""
     progress = t / duration
     if is_random:
         current_strand = random.uniform(min(val_a, val_b), max(val_a, val_b))
@@ -797,6 +1246,7 @@ def apply_procedural_slit_scan(get_frame, t, duration, val_a, val_b, is_random,
         intensity = 1.0
     c_mode = scan_mode
     if scan_mode == "Mix": c_mode = random.choice(["Orizzontale", "Verticale"])
+    strands = []
     if c_mode == "Orizzontale":
         current_y = 0
         while current_y < h:
@@ -804,18 +1254,111 @@ def apply_procedural_slit_scan(get_frame, t, duration, val_a, val_b, is_random,
             next_y = min(current_y + strand_h, h)
             if random.random() > magnet_prob:
                 offset = int(random.uniform(-w, w) * np.sin(np.pi * progress) * intensity)
-                frame[current_y:next_y, :] = np.roll(frame[current_y:next_y, :], offset, axis=1)
+                strands.append((current_y, next_y, offset))
             current_y = next_y
-    else:
-        current_x = 0
-        while current_x < w:
-            strand_w = int(random.uniform(current_strand * 0.5, current_strand * 2))
-            next_x = min(current_x + strand_w, w)
-            if random.random() > magnet_prob:
-                offset = int(random.uniform(-h, h) * np.sin(np.pi * progress) * intensity)
-                frame[:, current_x:next_x] = np.roll(frame[:, current_x:next_x], offset, axis=0)
-            current_x = next_x
-    return frame
+        return 1, strands
+    current_x = 0
+    while current_x < w:
+        strand_w = int(random.uniform(current_strand * 0.5, current_strand * 2))
+        next_x = min(current_x + strand_w, w)
+        if random.random() > magnet_prob:
+            offset = int(random.uniform(-h, h) * np.sin(np.pi * progress) * intensity)
+            strands.append((current_x, next_x, offset))
+        current_x = next_x
+    return 0, strands
+
+
+# --- KERNEL JIT (Numba, opzionale) ---
+# Il blend della banda selettiva compilato con Numba (parallel=True: righe
+# su piu' core), con la stessa aritmetica float32 del path numpy: risultato
+# identico bit per bit (bench-kernels lo verifica). Bande temporali e slit
+# scan restano su numpy: spostano righe/colonne intere, copie gia' a banda
+# di memoria che un kernel non batte.
+# Numba arriva gia' con librosa ma non e' obbligatorio: senza, o se la
+# compilazione fallisce, jit_kernels() e' None e si resta sul path numpy.
+JIT_KERNELS_AVAILABLE = importlib.util.find_spec("numba") is not None
+_jit_kernels = []   # [namespace o None] dopo il primo tentativo
+
+
+def jit_kernels():
+    """Namespace con i kernel compilati (blend_region), None se Numba non
+    c'e' o non compila. Import e compilazione al primo uso, una volta per
+    processo: niente cache=True su disco, che lega i kernel al nome del
+    modulo e si rompe quando Streamlit esegue app.py come script."""
+    if not _jit_kernels:
+        kernels = None
+        if JIT_KERNELS_AVAILABLE:
+            try:
+                kernels = _build_jit_kernels()
+            except Exception:
+                kernels = None
+        _jit_kernels.append(kernels)
+    return _jit_kernels[0]
+
+
+def _build_jit_kernels():
+    import types
+    import numba
+
+    @numba.njit(parallel=True)
+    def blend_region(frame, content, p0, l0, w_frame, w_content):
+        # (frame * (1 - opacity) + content * opacity).astype(uint8) in float32
+        ph, pw, c = content.shape
+        for y in numba.prange(ph):
+            for x in range(pw):
+                for k in range(c):
+                    v = (np.float32(frame[p0 + y, l0 + x, k]) * w_frame
+                         + np.float32(content[y, x, k]) * w_content)
+                    frame[p0 + y, l0 + x, k] = np.uint8(v)
+
+    return types.SimpleNamespace(blend_region=blend_region)
+
+
+# --- EFFETTI A TILE (thread pool) ---
+# Gli effetti per frame sono numpy su array grandi, che rilascia il GIL:
+# divisi in fasce di righe (o in bande/strisce disgiunte) girano su piu'
+# core mentre il resto di write_video aspetta. Ogni fascia fa la stessa
+# aritmetica elemento per elemento del frame intero, quindi il risultato
+# non dipende dal numero di thread. Il pool e' persistente (uno per numero
+# di thread, creato al primo uso): niente creazione di thread per frame.
+EFFECT_THREADS = max(1, min(4, os.cpu_count() or 1))
+EFFECT_TILE_MIN_ROWS = 64   # sotto, una fascia costa piu' di coordinamento che di calcolo
+_effect_pools = {}
+_effect_pools_lock = threading.Lock()
+
+
+def effect_pool(threads):
+    """ThreadPoolExecutor condiviso con 'threads' worker (None se 1)."""
+    if threads <= 1:
+        return None
+    with _effect_pools_lock:
+        pool = _effect_pools.get(threads)
+        if pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(max_workers=threads - 1,
+                                      thread_name_prefix="vd-effect")
+            _effect_pools[threads] = pool
+    return pool
+
+
+def run_tiled(threads, n, fn, min_items=EFFECT_TILE_MIN_ROWS):
+    """fn(i0, i1) su fasce contigue di range(n), una per thread: la prima
+    gira nel thread chiamante, le altre sul pool (threads - 1 worker).
+    Con un thread solo, o con meno di min_items elementi per fascia, e'
+    una chiamata fn(0, n) e basta."""
+    tiles = max(1, min(threads, n // max(1, min_items)))
+    if tiles <= 1:
+        if n > 0:
+            fn(0, n)
+        return
+    bounds = [n * i // tiles for i in range(tiles + 1)]
+    pool = effect_pool(threads)
+    futures = [pool.submit(fn, bounds[i], bounds[i + 1]) for i in range(1, tiles)]
+    try:
+        fn(bounds[0], bounds[1])
+    finally:
+        for f in futures:
+            f.result()
 
 # ---------------------------------------------------------------------------
 # REMIX DJ — genera sequenza slice/loop in stile CDJ
@@ -847,6 +1390,7 @@ def concatenate_in_batches(clips, method="chain", batch_size=250):
     durata) ma ogni singola chiamata a concatenate_videoclips lavora su una
     lista corta, tenendo l'overhead sotto controllo.
     """
+    from moviepy.video.compositing.concatenate import concatenate_videoclips
     if len(clips) <= batch_size:
         return concatenate_videoclips(clips, method=method)
     batches = [
@@ -856,56 +1400,281 @@ def concatenate_in_batches(clips, method="chain", batch_size=250):
     return concatenate_videoclips(batches, method=method)
 
 
-def crossfade_in_batches(clips, crossfade_dur, target_size, duration, batch_size=250):
+@dataclass
+class Fragment:
+    """Un frammento del remix VJ come DATO, non come catena di clip MoviePy:
+    sorgente (chiave in video_clips), punto di partenza nel sorgente, durata
+    sulla timeline e le trasformazioni di tempo che prima erano oggetti
+    wrapper a parte (speedx per il pitch glitch, ImageClip + concatenate per
+    il freeze, concatenate([base] * loop_reps) + speedx per lo stutter).
+
+    Qui tutte e tre diventano una sola funzione t -> src_t (src_offset),
+    valutata pigramente in fase di encoding: nessun frame decodificato al
+    momento della pianificazione, nessun oggetto in piu' per evento — il
+    costo di un frammento stutterato o con freeze e' identico a quello di
+    un frammento normale.
+    """
+
+    key: object
+    src_start: float
+    duration: float
+    speed: float = 1.0        # pitch glitch (ex speedx), 1.0 = velocita' naturale
+    freeze_dur: float = 0.0   # secondi iniziali fermi sul primo frame (ex ImageClip)
+    loop_reps: int = 1        # ripetizioni stutter compresse nello slot (ex concat+speedx)
+
+    def src_offset(self, t):
+        """Tempo locale del frammento -> (offset nel sorgente da src_start,
+        maschera 'frame congelato'). Vettoriale: t puo' essere un float o un
+        array numpy (l'audio viene interrogato a blocchi di istanti).
+
+        Ordine delle trasformazioni = ordine in cui prima si annidavano i
+        wrapper: lo stutter (il piu' esterno) ripete loop_reps volte lo slot
+        compresso, dentro ogni ripetizione il freeze tiene fermo il primo
+        frame per freeze_dur, e il pitch glitch scala il tempo restante."""
+        t = np.asarray(t, dtype=np.float64)
+        if self.loop_reps > 1:
+            t = np.mod(t * self.loop_reps, self.duration)
+        frozen = t < self.freeze_dur
+        if self.freeze_dur > 0:
+            t = np.maximum(t - self.freeze_dur, 0.0)
+        return t * self.speed, frozen
+
+    def src_time(self, t):
+        """Istante (scalare) da leggere nel sorgente per il tempo locale t."""
+        off, _ = self.src_offset(t)
+        return self.src_start + float(off)
+
+
+class FragmentTimeline(VideoClip):
     """
-    Versione 'a blocchi' del crossfade tra slice, sullo stesso principio di
-    concatenate_in_batches: prima il crossfade veniva applicato con UN SOLO
-    CompositeVideoClip contenente TUTTI i frammenti — bypassando del tutto
-    il batching che concatenate_in_batches esiste apposta per fornire.
-    Con centinaia di frammenti (comune in VJ Mode automatico, dove il
-    crossfade e' acceso di default) questo significava che l'unica strada
-    protetta dall'overhead-non-lineare di MoviePy era quella SENZA crossfade
-    — la strada con crossfade (quella usata di default) non aveva nessuna
-    protezione, a prescindere da quanto la stima frammenti fosse tarata bene.
-
-    Qui il crossfade si applica DENTRO ogni blocco da `batch_size` frammenti
-    (un CompositeVideoClip piccolo per blocco, non uno enorme), poi i blocchi
-    vengono uniti con un taglio secco tramite concatenate_in_batches — si
-    perde una sola dissolvenza ogni `batch_size` tagli (1 su 250, impercettibile
-    su un video con centinaia di tagli) in cambio della stessa protezione
-    memoria che il resto della pipeline gia' ha.
+    Timeline unica del remix VJ: una lista di Fragment letti da un solo clip
+    sorgente per chiave (gia' adattato al formato di export con fit_to_size,
+    condiviso da tutti i frammenti invece di un subclip+resize+crop per
+    frammento), con crossfade opzionale che compone SOLO i frame di
+    sovrapposizione.
+
+    Prima il crossfade passava da un CompositeVideoClip per blocco
+    (crossfade_in_batches, fino a 250 clip posizionati con crossfadein):
+    per OGNI frame d'uscita MoviePy scorreva tutti i layer del blocco per
+    capire quali fossero attivi e li componeva con le maschere in float —
+    anche se in qualunque istante i frammenti sovrapposti sono al massimo
+    due (cf <= 40% della durata di entrambi i vicini, quindi tre frammenti
+    non possono mai essere attivi insieme). Qui il frammento attivo si
+    trova con una bisect sugli istanti di inizio: fuori dalla zona di
+    crossfade il frame passa cosi' com'e' (nessuna copia, nessun blend),
+    dentro la zona si fa un unico blend a due ingressi in aritmetica intera
+    (peso su 256 livelli, uint16) — nessuna maschera, nessun float.
+
+    Stessa identica geometria temporale di prima (start_t = t - cf, con
+    cf = min(crossfade_dur, 40% del frammento, 40% del precedente)), ma
+    senza piu' il taglio secco ogni 250 frammenti: non servendo piu' i
+    blocchi, la timeline e' unica anche con migliaia di frammenti. Con
+    crossfade_dur=0 e' una semplice concatenazione.
+
+    sources  : dict {key: clip} gia' alla dimensione finale 'size'.
+    duration : durata finale dichiarata; oltre la fine dell'ultimo
+               frammento si tiene fermo il suo ultimo istante.
+
+    I frammenti che ripassano sugli stessi frame (stutter: loop_reps
+    ripetizioni dello stesso tratto, ognuna con un seek all'indietro;
+    freeze) tengono i frame decodificati in un piccolo memo per
+    frammento (_memo_frame): la prima ripetizione legge in avanti TUTTI i
+    frame del tratto, le successive li riprendono da li'. Cosi' uno
+    stutter costa la stessa decodifica di un frammento normale.
     """
-    if len(clips) <= batch_size:
-        return _crossfade_single_batch(clips, crossfade_dur, target_size, duration)
 
-    composed_batches = [
-        _crossfade_single_batch(clips[i:i + batch_size], crossfade_dur, target_size, None)
-        for i in range(0, len(clips), batch_size)
-    ]
-    return concatenate_in_batches(composed_batches, method="chain").set_duration(duration)
-
-
-def _crossfade_single_batch(clips, crossfade_dur, target_size, duration):
-    """Crossfade 'classico' (un CompositeVideoClip), ma solo su un blocco
-    limitato di clip — mai su migliaia insieme."""
-    positioned = []
-    t = 0.0
-    for i, clip in enumerate(clips):
-        if i == 0:
-            positioned.append(clip.set_start(0))
-            t = clip.duration
+    def __init__(self, fragments, sources, crossfade_dur, size, duration=None, fps=None):
+        VideoClip.__init__(self)
+        self.fragments = list(fragments)
+        self.sources = sources
+        self.size = tuple(size)
+        starts, fades = [], []
+        t = 0.0
+        for i, frag in enumerate(self.fragments):
+            if i == 0 or crossfade_dur <= 0:
+                cf = 0.0
+                start_t = t
+            else:
+                cf = min(crossfade_dur, frag.duration * 0.4, self.fragments[i - 1].duration * 0.4)
+                cf = max(cf, 0.0)
+                start_t = max(0.0, t - cf)
+            starts.append(start_t)
+            fades.append(cf)
+            t = start_t + frag.duration
+        self.starts = starts
+        self.fades = fades
+        self.duration = duration if duration is not None else t
+        self.end = self.duration
+        self.fps = fps
+        self.make_frame = self._make_frame
+        self._memo = OrderedDict()   # indice frammento -> {pos nel sorgente: frame}
+
+        if any(getattr(src, "audio", None) is not None for src in sources.values()):
+            self.audio = _TimelineAudio(self, self.duration)
+
+    def reset_memo(self):
+        """Svuota il memo dei frammenti (dopo il giro a vuoto di
+        plan_source_reads, che ci lascia frame finti)."""
+        self._memo.clear()
+
+    def _index_at(self, t):
+        i = bisect.bisect_right(self.starts, t) - 1
+        return max(0, min(i, len(self.fragments) - 1))
+
+    def fragment_frame(self, i, local_t):
+        frag = self.fragments[i]
+        src = self.sources[frag.key]
+        src_t = min(max(0.0, frag.src_time(local_t)), src.duration)
+        if frag.loop_reps > 1 or frag.freeze_dur > 0:
+            frame = self._memo_frame(i, frag, src, src_t)
+            if frame is not None:
+                return frame
+        return src.get_frame(src_t)
+
+    def _memo_frame(self, i, frag, src, src_t):
+        """Frame di src_t dal memo del frammento i, None = niente memo
+        (sorgente gia' in FrameCache o clip generico, oppure tratto oltre
+        FRAGMENT_MEMO_MAX_BYTES). Chiave = frame del reader (stessa
+        quantizzazione di get_frame). Su un frame mancante si leggono
+        anche quelli fra l'ultimo in memo e questo: lo stutter campiona il
+        tratto a passo loop_reps, e senza i frame intermedi la ripetizione
+        successiva (sfasata) non troverebbe nulla. Il reader li avrebbe
+        comunque decodificati e scartati (skip_frames)."""
+        reader = getattr(src, "reader", None)
+        if not isinstance(reader, _ProbedVideoReader):
+            return None
+        fps = reader.fps
+        w, h = reader.size
+        span = int(math.ceil(frag.duration * frag.speed * fps)) + 1
+        if span * w * h * 3 > FRAGMENT_MEMO_MAX_BYTES:
+            return None
+        memo = self._memo.get(i)
+        if memo is None:
+            memo = self._memo[i] = {}
+            while len(self._memo) > FRAGMENT_MEMO_FRAGMENTS:
+                self._memo.popitem(last=False)
         else:
-            cf = min(crossfade_dur, clip.duration * 0.4, clips[i - 1].duration * 0.4)
-            cf = max(cf, 0.0)
-            start_t = max(0.0, t - cf)
-            c = clip.crossfadein(cf) if cf > 0 else clip
-            positioned.append(c.set_start(start_t))
-            t = start_t + clip.duration
-    composed = CompositeVideoClip(positioned, size=target_size)
-    return composed.set_duration(min(t, duration) if duration is not None else t)
+            self._memo.move_to_end(i)
+        pos = int(src_t * fps + 0.00001)
+        frame = memo.get(pos)
+        if frame is None:
+            last = max(memo) if memo else pos
+            for k in range(last + 1 if last < pos else pos, pos + 1):
+                memo[k] = src.get_frame(k / fps)
+            frame = memo[pos]
+        return frame
+
+    def frame_key(self, t):
+        """Chiave del frame di _make_frame(t) senza decodificare nulla
+        (stesso percorso: frammento, crossfade, frame del reader). Due
+        istanti con la stessa chiave danno lo stesso frame: e' cio' che
+        write_video riusa nei freeze, e ovunque il render legge piu' volte
+        lo stesso frame sorgente (fps del render sopra quello del
+        sorgente, pitch glitch lento). None = non noto."""
+        i = self._index_at(t)
+        local_t = max(0.0, t - self.starts[i])
+        cf = self.fades[i]
+        if cf <= 0 or local_t >= cf:
+            return self._fragment_key(i, local_t)
+        w = int(local_t / cf * 256.0 + 0.5)
+        bottom = self._fragment_key(i - 1, t - self.starts[i - 1])
+        if w <= 0:
+            return bottom
+        top = self._fragment_key(i, local_t)
+        if w >= 256 or bottom is None or top is None:
+            return top if w >= 256 else None
+        return (bottom, top, w)
+
+    def _fragment_key(self, i, local_t):
+        frag = self.fragments[i]
+        src = self.sources[frag.key]
+        return source_frame_key(src, min(max(0.0, frag.src_time(local_t)), src.duration))
+
+    def _make_frame(self, t):
+        i = self._index_at(t)
+        local_t = max(0.0, t - self.starts[i])
+        cf = self.fades[i]
+        if cf <= 0 or local_t >= cf:
+            return self.fragment_frame(i, local_t)
+        # Zona di sovrapposizione: stesso fadein lineare della maschera di
+        # crossfadein (alpha = local_t / cf), con il frammento precedente sotto.
+        w = int(local_t / cf * 256.0 + 0.5)
+        bottom = self.fragment_frame(i - 1, t - self.starts[i - 1])
+        if w <= 0:
+            return bottom
+        top = self.fragment_frame(i, local_t)
+        return blend_frames_int(bottom, top, w)
+
+
+FRAGMENT_MEMO_MAX_BYTES = 128 * 1024 ** 2   # tratto massimo di un frammento in memo
+FRAGMENT_MEMO_FRAGMENTS = 3                 # frammenti in memo (crossfade: corrente + precedente)
+
+
+def blend_frames_int(bottom, top, w):
+    """Blend a due ingressi in aritmetica intera: w in [0, 256] e' il peso
+    di 'top' su 256 livelli. uint16 basta: 255*256 + 128 < 65536."""
+    if w >= 256:
+        return top
+    out = top.astype(np.uint16)
+    out *= w
+    out += bottom.astype(np.uint16) * (256 - w)
+    out += 128
+    out >>= 8
+    return out.astype(np.uint8)
+
+
+class _TimelineAudio(AudioClip):
+    """Audio della FragmentTimeline: stesso risultato del CompositeAudioClip
+    che il CompositeVideoClip/concatenate costruivano da soli (tracce
+    sovrapposte sommate, nessun fade sull'audio, silenzio durante un
+    freeze), ma per ogni chunk si interrogano solo i frammenti che cadono
+    nel suo intervallo (searchsorted), non tutti, e ognuno con la stessa
+    mappa di tempo del video (src_offset)."""
+
+    def __init__(self, timeline, duration):
+        AudioClip.__init__(self)
+        self.timeline = timeline
+        audios = [s.audio for s in timeline.sources.values() if s.audio is not None]
+        self.nchannels = max(a.nchannels for a in audios)
+        fpss = [a.fps for a in audios if getattr(a, "fps", None)]
+        self.fps = max(fpss) if fpss else 44100
+        self.starts = np.asarray(timeline.starts, dtype=np.float64)
+        self.ends = self.starts + np.asarray([f.duration for f in timeline.fragments], dtype=np.float64)
+        self.duration = duration
+        self.end = duration
+        self.make_frame = self._make_frame
+
+    def _make_frame(self, t):
+        scalar = not isinstance(t, np.ndarray)
+        tt = np.atleast_1d(np.asarray(t, dtype=np.float64))
+        out = np.zeros((len(tt), self.nchannels))
+        lo = max(0, int(np.searchsorted(self.starts, tt.min(), side="right")) - 2)
+        hi = int(np.searchsorted(self.starts, tt.max(), side="right"))
+        for j in range(lo, hi):
+            frag = self.timeline.fragments[j]
+            audio = self.timeline.sources[frag.key].audio
+            if audio is None:
+                continue
+            mask = (tt >= self.starts[j]) & (tt < self.ends[j])
+            if not mask.any():
+                continue
+            off, frozen = frag.src_offset(tt[mask] - self.starts[j])
+            src_t = np.clip(frag.src_start + off, 0.0, max(0.0, audio.duration - 1.0 / self.fps))
+            snd = np.zeros((len(src_t), self.nchannels))
+            # Lo stutter riavvolge il tempo sorgente dentro lo stesso chunk:
+            # il reader audio di MoviePy regge solo intervalli contigui, quindi
+            # si interroga un tratto monotono alla volta.
+            cuts = np.flatnonzero(np.diff(src_t) < 0) + 1
+            for a, b in zip(np.r_[0, cuts], np.r_[cuts, len(src_t)]):
+                part = np.asarray(audio.get_frame(src_t[a:b]))
+                snd[a:b] = part.reshape(b - a, -1)
+            snd[np.atleast_1d(frozen)] = 0.0
+            out[mask] += snd
+        return out[0] if scalar else out
+
 
 def generate_dj_remix(video_clips, duration, fps, slice_dur, loop_reps,
-                      stutter_prob, pitch_glitch, p_bar,
+                      stutter_prob, pitch_glitch, reporter,
                       beat_slice_mode=False, beat_times=None,
                       rms_envelope=None, band_envelope=None,
                       crossfade_dur=0.0, freeze_on_beat=False,
@@ -919,7 +1688,8 @@ def generate_dj_remix(video_clips, duration, fps, slice_dur, loop_reps,
                       export_size=None, react_to_peaks=True,
                       cut_source="beat", onset_times=None,
                       subdivision_coarsen=1.0,
-                      mod_matrix=None, mod_matrix_fps=None):
+                      mod_matrix=None, mod_matrix_fps=None,
+                      seek_aware=False):
     """
     VJ Mode:
     - slice_dur       : durata base di ogni slice (manuale, es. 0.1 ... 2.0 s)
@@ -981,13 +1751,18 @@ def generate_dj_remix(video_clips, duration, fps, slice_dur, loop_reps,
                         gia' scelta: in "Random totale"/"Random in range" la
                         pesca resta puramente casuale tra i valori previsti,
                         senza che il burst-detector la sovrascriva mai.
+    - seek_aware      : se True, dentro la zona scelta dai bucket lo start
+                        preferisce i punti economici da raggiungere con un
+                        seek (vedi seek_aware_start). Richiede sorgenti con
+                        infos["keyframes"] (LazyVideoFileClip); False =
+                        start uniforme nella zona, come prima.
 
     Anti-ripetizione v3: sistema bucket — distribuisce i tagli uniformemente
     nelle zone del sorgente, funziona bene sia su clip corti che su lunghi (50s+).
     """
     keys = list(video_clips.keys())
     target_size = export_size or video_clips[keys[0]].size
-    all_clips = []
+    all_clips = []  # lista di Fragment (dati), non di clip MoviePy
     total_fragments = 0
     curr_t = 0.0
 
@@ -1034,7 +1809,11 @@ def generate_dj_remix(video_clips, duration, fps, slice_dur, loop_reps,
         # Rotazione esatta: solo i bucket con il minimo assoluto di visite
         candidates = [i for i, c in enumerate(counts) if c == min_v]
         chosen = random.choice(candidates)
-        s = random.uniform(chosen * bucket_size, min(chosen * bucket_size + bucket_size, max_start))
+        b_start = chosen * bucket_size
+        b_end = min(b_start + bucket_size, max_start)
+        s = random.uniform(b_start, b_end)
+        if seek_aware:
+            s = seek_aware_start(s, b_start, b_end, getattr(source, "infos", {}).get("keyframes"))
         counts[chosen] += 1
         return s
 
@@ -1430,8 +2209,7 @@ def generate_dj_remix(video_clips, duration, fps, slice_dur, loop_reps,
                     # effettivamente disponibile dopo il clamp.
                     p_actual = max(1.0 / fps, p_end - pending_start)
                     pn = max(1, round(p_actual * fps))
-                    pclip = fit_to_size(p_src.subclip(pending_start, p_end), target_size).set_fps(fps).set_duration(p_actual)
-                    all_clips.append(pclip)
+                    all_clips.append(Fragment(pending_k, pending_start, p_actual))
                     _register_clip(p_actual)
                     frame_count += pn
                     total_fragments += 1
@@ -1455,11 +2233,10 @@ def generate_dj_remix(video_clips, duration, fps, slice_dur, loop_reps,
                 start_p = start_p + _mod_offset_curve[_idx]
                 start_p = max(0.0, min(start_p, max(0.0, source.duration - seg)))
 
-            base_clip = fit_to_size(source.subclip(start_p, min(start_p + seg, source.duration)), target_size).set_fps(fps).set_duration(seg)
+            frag = Fragment(k, start_p, seg)
 
             if pitch_glitch and random.random() < 0.15:
-                factor = random.choice([0.5, 0.75, 1.5, 2.0])
-                base_clip = base_clip.speedx(factor).set_duration(seg)
+                frag.speed = random.choice([0.5, 0.75, 1.5, 2.0])
 
             # Freeze-frame on beat
             on_beat = False
@@ -1485,15 +2262,12 @@ def generate_dj_remix(video_clips, duration, fps, slice_dur, loop_reps,
             freeze_trigger = max(rhythmic_intensity, 0.8 * bass_level)
             local_freeze_prob = min(1.0, freeze_prob * (0.5 + 0.9 * freeze_trigger))
             if freeze_on_beat and on_beat and local_freeze_prob > 0 and random.random() < local_freeze_prob and seg > 0.15:
-                f_dur = min(freeze_dur, seg * 0.5)
-                frame_f = base_clip.get_frame(0)
-                freeze_clip = ImageClip(frame_f).set_duration(f_dur).set_fps(fps)
-                rest_dur = seg - f_dur
-                rest_clip = base_clip.subclip(0, rest_dur) if rest_dur > 0.04 else base_clip.set_duration(0.04)
-                base_clip = concatenate_videoclips([freeze_clip, rest_clip], method="chain").set_duration(seg)
+                # Niente get_frame(0) qui (decodifica a tempo di
+                # pianificazione) ne' ImageClip: il freeze e' solo una
+                # mappa di tempo, valutata frame per frame in encoding.
+                frag.freeze_dur = min(freeze_dur, seg * 0.5)
 
             if random.random() < stutter_prob and loop_reps > 1:
-                combo = concatenate_videoclips([base_clip] * loop_reps, method="chain")
                 # PRIMA: durava n_frames * loop_reps — cioe' DOPPIO/TRIPLO
                 # dello slot che il beat/onset aveva assegnato a quel
                 # segmento. frame_count avanzava piu' dell'audio (che
@@ -1507,15 +2281,13 @@ def generate_dj_remix(video_clips, duration, fps, slice_dur, loop_reps,
                 # (n_frames) — stesso effetto visivo di stutter (il clip si
                 # ripete loop_reps volte, solo piu' veloce), ma il tempo
                 # totale consumato resta identico a quello non-stutterato,
-                # quindi l'audio non si disallinea mai.
-                combo = combo.speedx(loop_reps).set_duration(n_frames / fps)
-                all_clips.append(combo)
-                _register_clip(n_frames / fps)
-                frame_count += n_frames
-            else:
-                all_clips.append(base_clip)
-                _register_clip(seg)
-                frame_count += n_frames
+                # quindi l'audio non si disallinea mai. La ripetizione e'
+                # una mappa di tempo sullo stesso frammento (Fragment.
+                # loop_reps), non piu' loop_reps copie concatenate.
+                frag.loop_reps = loop_reps
+            all_clips.append(frag)
+            _register_clip(seg)
+            frame_count += n_frames
 
             pending_seg   = 0.0
             pending_k     = k
@@ -1526,7 +2298,7 @@ def generate_dj_remix(video_clips, duration, fps, slice_dur, loop_reps,
             # Nessun taglio: accumula nel pending (stessa sorgente)
             pending_seg += seg
 
-        p_bar.progress(
+        reporter.update(
             min(total_fragments / estimated * 0.5, 0.5),
             text=f"VJ Mode: {total_fragments} slice"
         )
@@ -1544,8 +2316,7 @@ def generate_dj_remix(video_clips, duration, fps, slice_dur, loop_reps,
             # realmente disponibile dopo il clamp, per non dichiarare un
             # set_duration maggiore del footage esistente nella sorgente.
             p_actual = max(1.0 / fps, p_end - pending_start)
-            pclip = fit_to_size(p_src.subclip(pending_start, p_end), target_size).set_fps(fps).set_duration(p_actual)
-            all_clips.append(pclip)
+            all_clips.append(Fragment(pending_k, pending_start, p_actual))
             _register_clip(p_actual)
             total_fragments += 1
 
@@ -1554,13 +2325,87 @@ def generate_dj_remix(video_clips, duration, fps, slice_dur, loop_reps,
     # poter "decomporre" l'audio caricato con la stessa identica griglia.
     cut_schedule = [c.duration for c in all_clips]
 
-    if crossfade_dur > 0 and len(all_clips) > 1:
-        final = crossfade_in_batches(all_clips, crossfade_dur, target_size, duration)
-    else:
-        final = concatenate_in_batches(all_clips, method="chain").set_duration(duration)
+    # Un solo clip adattato al formato per sorgente, condiviso da tutti i
+    # frammenti che la usano (prima: subclip + resize + crop per ognuno).
+    fitted = {k: fit_to_size(video_clips[k], target_size) for k in keys}
+    final = FragmentTimeline(all_clips, fitted, crossfade_dur, target_size, duration, fps=fps)
     return final, total_fragments, cut_schedule
 
-def decompose_audio_track(audio_clip, cut_schedule, total_duration):
+# ---------------------------------------------------------------------------
+# AUDIO ENGINE — buffer numpy
+# Brano e audio delle sorgenti decodificati UNA volta (ffmpeg -> float32),
+# traccia finale assemblata con slicing numpy sulla stessa lista di
+# Fragment del video, scritta una volta in WAV e codificata in AAC nello
+# stesso passaggio ffmpeg del video. Prima ogni modalita' costruiva un
+# grafo di clip audio MoviePy (centinaia di subclip concatenati, piu' un
+# CompositeAudioClip nei mix) valutato a blocchi durante l'encoding, con
+# il reader audio che faceva seek a ogni frammento.
+# ---------------------------------------------------------------------------
+AUDIO_FPS = 44100
+AUDIO_CHANNELS = 2
+
+
+def decode_audio(path, max_duration=None, fps=AUDIO_FPS, nchannels=AUDIO_CHANNELS):
+    """Intera traccia audio di un file -> array float32 (campioni, canali),
+    o None se il file non ha audio. max_duration limita la decodifica ai
+    primi secondi effettivamente usati."""
+    from moviepy.config import get_setting
+    cmd = [get_setting("FFMPEG_BINARY"), "-v", "error", "-i", path]
+    if max_duration is not None:
+        cmd += ["-t", f"{max_duration:.3f}"]
+    cmd += ["-vn", "-ac", str(nchannels), "-ar", str(fps), "-f", "f32le", "-"]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0 or not proc.stdout:
+        return None
+    return np.frombuffer(proc.stdout, dtype=np.float32).reshape(-1, nchannels)
+
+
+def write_wav(path, buf, fps=AUDIO_FPS):
+    """Buffer float (campioni, canali) -> WAV PCM 16 bit. Il clip a [-1, 1]
+    evita il wrap-around dei mix che superano il fondo scala."""
+    import wave
+    pcm = (np.clip(buf, -1.0, 1.0) * 32767.0).astype("<i2")
+    with wave.open(path, "wb") as w:
+        w.setnchannels(buf.shape[1])
+        w.setsampwidth(2)
+        w.setframerate(fps)
+        w.writeframes(pcm.tobytes())
+
+
+def fragments_audio_track(fragments, starts, source_audio, total_duration, fps=AUDIO_FPS):
+    """Audio originale della timeline: per ogni Fragment, i campioni del
+    suo sorgente rimappati con la stessa src_offset del video (stutter,
+    freeze = silenzio, pitch glitch). Tracce sovrapposte (crossfade) si
+    sommano, come nel CompositeAudioClip di prima. None se nessuna
+    sorgente usata ha audio."""
+    n_total = int(round(total_duration * fps))
+    out = None
+    for frag, start in zip(fragments, starts):
+        buf = source_audio.get(frag.key)
+        if buf is None or not len(buf):
+            continue
+        if out is None:
+            out = np.zeros((n_total, buf.shape[1]), dtype=np.float32)
+        n0 = min(n_total, int(round(start * fps)))
+        n1 = min(n_total, int(round((start + frag.duration) * fps)))
+        if n1 <= n0:
+            continue
+        if frag.speed == 1.0 and frag.freeze_dur <= 0 and frag.loop_reps <= 1:
+            # Caso comune: tratto contiguo del sorgente, solo slicing.
+            i0 = int(round(frag.src_start * fps + (n0 - start * fps)))
+            i0 = min(max(i0, 0), len(buf))
+            part = buf[i0:i0 + (n1 - n0)]
+            out[n0:n0 + len(part)] += part
+            continue
+        off, frozen = frag.src_offset(np.arange(n0, n1) / fps - start)
+        idx = np.clip(np.round((frag.src_start + off) * fps).astype(np.int64), 0, len(buf) - 1)
+        part = buf[idx]
+        part[np.atleast_1d(frozen)] = 0.0
+        out[n0:n1] += part
+    return out
+
+
+def decompose_audio_track(music, cut_schedule, total_duration, fps=AUDIO_FPS):
     """
     Applica al brano caricato la STESSA griglia di tagli usata per assemblare
     il video (cut_schedule = lista di durate, nello stesso ordine con cui
@@ -1569,21 +2414,22 @@ def decompose_audio_track(audio_clip, cut_schedule, total_duration):
     per i video) invece del punto "naturale" in sequenza: il risultato e'
     il brano rimescolato nella stessa grammatica ritmica del video, cioe'
     gli slice tagliano anche il brano caricato.
-    """
-    from moviepy.editor import concatenate_audioclips
 
-    if not cut_schedule:
-        return audio_clip.set_duration(total_duration)
-
-    audio_dur = audio_clip.duration
-    if audio_dur is None or audio_dur <= 0.05:
-        return audio_clip.set_duration(total_duration)
+    music = buffer float32 (campioni, canali) di decode_audio; restituisce
+    un buffer lungo total_duration (silenzio oltre l'ultimo slot).
+    """
+    n_total = int(round(total_duration * fps))
+    out = np.zeros((n_total, music.shape[1]), dtype=np.float32)
+    audio_dur = len(music) / fps
+    if not cut_schedule or audio_dur <= 0.05:
+        part = music[:n_total]
+        out[:len(part)] = part
+        return out
 
     n_buckets = min(40, max(8, int(audio_dur / 0.5)))
     bucket_counts = [0] * n_buckets
     bucket_size = audio_dur / n_buckets
 
-    pieces = []
     elapsed = 0.0
     for seg in cut_schedule:
         if elapsed >= total_duration:
@@ -1604,22 +2450,1184 @@ def decompose_audio_track(audio_clip, cut_schedule, total_duration):
             start = random.uniform(b_start, max(b_start, b_end))
             # Clamp di sicurezza: i bucket sono ritagliati sulla durata TOTALE
             # del brano, ma il punto di partenza valido per questo segmento
-            # e' al massimo max_start (altrimenti start+seg supera la durata
-            # del file e moviepy va in errore "Accessing time t=... with clip
-            # duration=..."). Senza questo clamp, bucket vicini alla fine del
+            # e' al massimo max_start (altrimenti start+seg supera la fine
+            # del brano). Senza questo clamp, bucket vicini alla fine del
             # brano potevano restituire start > max_start.
             start = min(start, max_start)
             bucket_counts[chosen] += 1
 
-        piece = audio_clip.subclip(start, min(start + seg, audio_dur)).set_duration(seg)
-        pieces.append(piece)
+        n0 = int(round(elapsed * fps))
+        n1 = min(n_total, int(round((elapsed + seg) * fps)))
+        i0 = int(round(start * fps))
+        part = music[i0:i0 + (n1 - n0)]
+        out[n0:n0 + len(part)] = part
         elapsed += seg
+    return out
+
+
+def build_audio_track(mode, total_duration, fragments=None, starts=None, source_paths=None,
+                      music_path=None, cut_schedule=None, vol_music=1.0, vol_original=1.0,
+                      fps=AUDIO_FPS):
+    """Traccia finale per una modalita' AUDIO_MIX_LABELS, come buffer float32
+    (None = video muto). music_path None = nessun brano caricato: resta
+    l'audio originale, come 'original_only'.
+
+    Stesse regole del mix MoviePy di prima: brano in loop se piu' corto
+    della durata; nei mix i volumi si applicano solo se c'e' davvero un
+    audio originale, altrimenti resta il brano com'e'."""
+    n_total = int(round(total_duration * fps))
+    use_music = music_path is not None and mode != "original_only"
+    need_original = (not use_music) or mode in ("mix", "mix_decomposed")
+
+    original = None
+    if need_original and fragments:
+        # Ogni sorgente si decodifica una volta sola, fino all'ultimo
+        # istante che un frammento ne legge.
+        reach = {}
+        for frag in fragments:
+            end = frag.src_start + frag.duration * frag.speed  # src_offset <= t * speed
+            reach[frag.key] = max(reach.get(frag.key, 0.0), end)
+        source_audio = {k: decode_audio(source_paths[k], max_duration=reach[k] + 0.1)
+                        for k in reach if k in source_paths}
+        original = fragments_audio_track(fragments, starts, source_audio, total_duration, fps)
+
+    if not use_music:
+        return original
+
+    music = decode_audio(music_path, fps=fps)
+    if music is None:
+        raise RuntimeError("Brano audio non decodificabile.")
+    if mode in ("custom_decomposed", "mix_decomposed"):
+        music = decompose_audio_track(music, cut_schedule, total_duration, fps)
+    elif len(music) < n_total:
+        music = music[np.arange(n_total) % len(music)]
+    else:
+        music = music[:n_total]
+
+    if mode in ("mix", "mix_decomposed") and original is not None:
+        return music * np.float32(vol_music) + original * np.float32(vol_original)
+    return music
+
+
+# ---------------------------------------------------------------------------
+# PROBE SORGENTI
+# Prima load_sources apriva le sorgenti una alla volta: ffmpeg_parse_infos
+# per la dimensione, poi VideoFileClip che rifaceva lo stesso probe e
+# avviava subito il decoder video (e un secondo processo per l'audio, mai
+# letto: l'audio finale lo costruisce l'audio engine dai file). Ora il
+# probe gira in parallelo in un pool di thread ed e' in cache per
+# contenuto (in memoria e su disco: serve a tutti i render successivi
+# dello stesso file, anche in un altro worker), e il decoder parte solo
+# al primo frame richiesto davvero.
+# ---------------------------------------------------------------------------
+PROBE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "loop507_probe")
+PROBE_WORKERS = 4
+_PROBE_MEMO = {}
+_PROBE_LOCK = threading.Lock()
+
+
+def probe_keyframes(path):
+    """Istanti (s) dei keyframe del primo stream video. Il decoder salta
+    tutti i frame non-key (-skip_frame nokey), quindi il costo e' la
+    lettura del file piu' la decodifica dei soli keyframe."""
+    from moviepy.config import get_setting
+    proc = subprocess.run(
+        [get_setting("FFMPEG_BINARY"), "-hide_banner", "-skip_frame", "nokey", "-i", path,
+         "-map", "0:v:0", "-vf", "showinfo", "-f", "null", "-"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    times = []
+    for line in proc.stderr.decode("utf-8", "replace").splitlines():
+        if "Parsed_showinfo" in line and "pts_time:" in line:
+            try:
+                times.append(float(line.split("pts_time:")[1].split()[0]))
+            except ValueError:
+                pass
+    return sorted(times)
+
+
+def probe_source(path):
+    """Metadati di un video: il dict di ffmpeg_parse_infos (dimensione,
+    fps, durata, rotazione, presenza di audio...) piu' 'keyframes' (lista
+    degli istanti) e 'keyframe_count'. In cache per contenuto."""
+    key = hashlib.sha1(repr(_content_key(path)).encode()).hexdigest()
+    with _PROBE_LOCK:
+        if key in _PROBE_MEMO:
+            return _PROBE_MEMO[key]
+    cache_path = os.path.join(PROBE_CACHE_DIR, key + ".json")
+    infos = None
+    try:
+        with open(cache_path) as f:
+            infos = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if infos is None:
+        infos = ffmpeg_parse_infos(path)
+        infos["keyframes"] = probe_keyframes(path)
+        infos["keyframe_count"] = len(infos["keyframes"])
+        try:
+            os.makedirs(PROBE_CACHE_DIR, exist_ok=True)
+            tmp = f"{cache_path}.{uuid.uuid4().hex}.part"
+            with open(tmp, "w") as f:
+                json.dump(infos, f)
+            os.replace(tmp, cache_path)
+        except OSError:
+            pass   # cache solo in memoria
+    with _PROBE_LOCK:
+        _PROBE_MEMO[key] = infos
+    return infos
+
+
+def probe_sources(paths):
+    """probe_source su tutti i path {chiave: path} in parallelo ->
+    {chiave: infos}. Il probe e' un processo ffmpeg: i thread aspettano
+    e basta, nessun problema di GIL."""
+    from concurrent.futures import ThreadPoolExecutor
+    keys = list(paths)
+    if len(keys) <= 1:
+        return {k: probe_source(paths[k]) for k in keys}
+    with ThreadPoolExecutor(max_workers=min(PROBE_WORKERS, len(keys))) as pool:
+        return dict(zip(keys, pool.map(probe_source, [paths[k] for k in keys])))
+
+
+class _ProbedVideoReader(FFMPEG_VideoReader):
+    """FFMPEG_VideoReader costruito da infos gia' noti: niente secondo
+    probe e niente processo ffmpeg all'apertura. get_frame() di MoviePy
+    avvia il processo da solo se non c'e' (self.proc None), al primo
+    frame richiesto e gia' nel punto giusto."""
+
+    def __init__(self, filename, infos, target_resolution=None,
+                 resize_algo="bicubic", pix_fmt="rgb24", fit_size=None):
+        # Stessi attributi e stessa logica di target_resolution di
+        # FFMPEG_VideoReader.__init__, senza initialize()/read_frame().
+        self.filename = filename
+        self.proc = None
+        self.frame_hook = None   # FramePrefetcher / plan_source_reads
+        self.fps = infos["video_fps"]
+        self.size = infos["video_size"]
+        self.rotation = infos["video_rotation"]
+        self.vf = None
+        if fit_size:
+            # Crop-to-fill nel decoder: scale + crop di fit_geometry
+            # calcolati sulla dimensione mostrata (ffmpeg ruota da solo i
+            # video con metadato di rotazione PRIMA dei filtri), frame
+            # in uscita gia' esattamente fit_size.
+            w, h = self.size
+            if self.rotation in (90, 270):
+                w, h = h, w
+            new_w, new_h, x1, y1 = fit_geometry((w, h), fit_size)
+            self.size = tuple(fit_size)
+            if (new_w, new_h) == (w, h) and self.size == (w, h):
+                self.vf = "null"
+            else:
+                self.vf = f"scale={new_w}:{new_h},crop={fit_size[0]}:{fit_size[1]}:{x1}:{y1}"
+        elif target_resolution:
+            target_resolution = target_resolution[1], target_resolution[0]
+            if None in target_resolution:
+                ratio = 1
+                for idx, target in enumerate(target_resolution):
+                    if target:
+                        ratio = target / self.size[idx]
+                self.size = (int(self.size[0] * ratio), int(self.size[1] * ratio))
+            else:
+                self.size = target_resolution
+        self.resize_algo = resize_algo
+        self.duration = infos["video_duration"]
+        self.ffmpeg_duration = infos["duration"]
+        self.nframes = infos["video_nframes"]
+        self.infos = infos
+        self.pix_fmt = pix_fmt
+        self.depth = 4 if pix_fmt == "rgba" else 3
+        w, h = self.size
+        self.bufsize = self.depth * w * h + 100
+        self.pos = 1
+
+    # Costo dei frame letti e buttati in avanti, in "frame decodificati":
+    # con fit_size ogni frame scartato passa comunque per scale + crop e
+    # per la pipe alla dimensione di export (misurato: 480x640 -> 720x1280
+    # ~16 ms contro ~1.3 ms della sola decodifica). Il rilancio del decoder
+    # costa l'avvio di ffmpeg piu' la decodifica dal keyframe precedente.
+    SKIPPED_FRAME_COST = 8
+    DECODER_SPAWN_FRAMES = 15
+
+    def get_frame(self, t):
+        """get_frame() di MoviePy con una regola diversa per i salti in
+        avanti: MoviePy rilancia il decoder solo oltre 100 frame e sotto
+        legge e butta i frame intermedi. Qui si sceglie la via meno cara
+        con i keyframe del probe (_seek_is_cheaper). Con un frame_hook
+        attivo il frame arriva prima da li' (decode-ahead); None = lettura
+        non pianificata, si decodifica qui come sempre."""
+        pos = self.frame_index(t)
+        if self.frame_hook is not None:
+            frame = self.frame_hook.take(pos, t)
+            if frame is not None:
+                return frame
+        if not self.proc:
+            self.initialize(t)
+            self.pos = pos
+            self.lastread = self.read_frame()
+        if pos == self.pos:
+            return self.lastread
+        if pos < self.pos or pos > self.pos + 100 or self._seek_is_cheaper(pos):
+            self.initialize(t)
+        else:
+            self.skip_frames(pos - self.pos - 1)
+        self.lastread = self.read_frame()
+        self.pos = pos
+        return self.lastread
+
+    def frame_index(self, t):
+        """Frame (1-based, come MoviePy) che get_frame(t) restituisce."""
+        return int(self.fps * t + 0.00001) + 1
+
+    def _seek_is_cheaper(self, pos):
+        """Rilanciare il decoder su pos (1-based, come MoviePy) costa meno
+        che leggere e buttare i frame da self.pos a pos?"""
+        skipped = pos - self.pos - 1
+        keyframes = self.infos.get("keyframes") or ()
+        i = bisect.bisect_right(keyframes, (pos - 1 + 0.5) / self.fps) - 1
+        keyframe_pos = int(keyframes[i] * self.fps + 0.5) if i >= 0 else 0
+        decoded = (pos - 1) - keyframe_pos
+        return decoded + self.DECODER_SPAWN_FRAMES < skipped * self.SKIPPED_FRAME_COST
+
+    def close(self):
+        """Come close() di MoviePy ma con SIGKILL: su SIGTERM ffmpeg chiude
+        "pulito" e svuota la catena di filtri, e con frame grandi (crop-to-
+        fill a 1080p) l'attesa arrivava a 0.2-0.4 s per seek. Il decoder
+        scrive solo su una pipe che stiamo buttando, non c'e' nulla da
+        salvare."""
+        if self.proc:
+            self.proc.kill()
+            self.proc.stdout.close()
+            self.proc.stderr.close()
+            self.proc.wait()
+            self.proc = None
+        if hasattr(self, "lastread"):
+            del self.lastread
+
+    def initialize(self, starttime=0):
+        """initialize() di MoviePy con due differenze: il filtro video
+        (crop-to-fill di fit_size) al posto dello scale fisso, e il seek
+        SOLO in input. MoviePy fa "-ss (t-1) -i file -ss 1": il secondo
+        -ss scarta i frame DOPO i filtri, quindi un secondo intero di
+        frame passava per scale + crop e veniva buttato a ogni seek. Il
+        seek in input di ffmpeg e' gia' preciso al frame e scarta prima
+        dei filtri (vedi anche SEEK_PREROLL_S)."""
+        self.close()
+        i_arg = []
+        if starttime:
+            # ffmpeg parte dal primo frame con pts >= -ss, MoviePy vuole il
+            # frame int(t * fps): si punta a un quarto di frame prima.
+            n = int(self.fps * starttime + 0.00001)
+            i_arg = ["-ss", "%.06f" % max(0.0, (n - 0.25) / self.fps)]
+        i_arg += ["-i", self.filename]
+        vf = self.vf or "scale=%d:%d" % tuple(self.size)
+        from moviepy.config import get_setting
+        cmd = ([get_setting("FFMPEG_BINARY")] + i_arg +
+               ["-loglevel", "error", "-f", "image2pipe", "-vf", vf,
+                "-sws_flags", self.resize_algo, "-pix_fmt", self.pix_fmt,
+                "-vcodec", "rawvideo", "-"])
+        self.proc = subprocess.Popen(cmd, bufsize=self.bufsize, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+
+
+class LazyVideoFileClip(VideoFileClip):
+    """VideoFileClip senza costo di apertura: metadati dal probe in cache,
+    decoder avviato al primo get_frame, nessun reader audio. infos in piu'
+    rispetto a VideoFileClip: keyframes / keyframe_count.
+
+    fit_size=(w, h): i frame escono dal decoder gia' adattati con il
+    crop-to-fill di fit_to_size (che a quel punto non fa piu' nulla).
+    target_resolution: come in VideoFileClip (entrambi i lati = stretch)."""
+
+    def __init__(self, filename, infos=None, target_resolution=None, fit_size=None):
+        VideoClip.__init__(self)
+        infos = infos if infos is not None else probe_source(filename)
+        self.reader = _ProbedVideoReader(filename, infos, target_resolution=target_resolution,
+                                         fit_size=fit_size)
+        self.duration = self.reader.duration
+        self.end = self.reader.duration
+        self.fps = self.reader.fps
+        self.size = self.reader.size
+        self.rotation = self.reader.rotation
+        self.filename = filename
+        self.infos = infos
+        self.make_frame = lambda t: self.reader.get_frame(t)
+
+
+# Costo di un seek: per leggere da t il reader riparte con "-ss t -i
+# file", quindi ffmpeg salta al keyframe precedente a t e decodifica
+# (buttandoli) tutti i frame da li' fino a t. Il punto piu' economico e'
+# subito DOPO un keyframe, e il costo cresce fino a un GOP intero
+# (secondi, sui video da telefono) subito prima del keyframe successivo.
+# SEEK_PREROLL_S = quanto prima di t il reader fa partire il seek in
+# input: 0 con _ProbedVideoReader; era 1.0 con il reader di MoviePy
+# ("-ss (t - 1) -i file -ss 1").
+SEEK_PREROLL_S = 0.0
+SEEK_TOLERANCE_S = 0.25   # larghezza della finestra "economica" dopo ogni keyframe
+
+
+def seek_cost(t, keyframes):
+    """Secondi di video decodificati e scartati per partire da t."""
+    seek_to = max(0.0, t - min(SEEK_PREROLL_S, t))
+    i = bisect.bisect_right(keyframes, seek_to) - 1
+    return t - (keyframes[i] if i >= 0 else 0.0)
+
+
+def seek_aware_start(s, b_start, b_end, keyframes, tolerance=SEEK_TOLERANCE_S):
+    """Sposta uno start scelto a caso nella zona [b_start, b_end] verso un
+    punto economico da raggiungere con un seek, SENZA uscire dalla zona
+    (le garanzie anti-ripetizione dei bucket restano quelle di prima).
+
+    Finestre economiche: [kf + SEEK_PREROLL_S, + tolerance] per ogni
+    keyframe kf, piu' l'inizio del file. Se s ci cade gia' dentro resta
+    cosi'; altrimenti si pesca a caso dentro una delle finestre che
+    intersecano la zona; se nessuna la interseca, all'inizio della zona
+    (il punto della zona piu' vicino al keyframe che la precede)."""
+    if not keyframes or b_end <= b_start:
+        return s
+    if seek_cost(s, keyframes) <= SEEK_PREROLL_S + tolerance:
+        return s
+    windows = [(0.0, tolerance)] + [(kf + SEEK_PREROLL_S, kf + SEEK_PREROLL_S + tolerance)
+                                    for kf in keyframes]
+    inside = [(max(lo, b_start), min(hi, b_end)) for lo, hi in windows
+              if lo <= b_end and hi >= b_start]
+    if inside:
+        lo, hi = random.choice(inside)
+        return random.uniform(lo, hi)
+    return random.uniform(b_start, min(b_end, b_start + tolerance))
+
+
+# ---------------------------------------------------------------------------
+# DECODE-AHEAD
+# Durante write_videofile la catena era strettamente seriale: frame dal
+# decoder -> effetti .fl -> pipe dell'encoder, e ogni attesa sul decoder
+# (seek a un taglio, frame scartati) teneva fermo anche l'encoder. Quali
+# frame di quali sorgenti verranno letti, e in che ordine, e' pero' gia'
+# deciso dal montaggio: plan_source_reads() lo ricava con un giro a vuoto
+# della composizione e FramePrefetcher li decodifica in anticipo, un
+# thread (e un processo ffmpeg) per sorgente, in code limitate. Il thread
+# del render applica solo gli effetti e scrive.
+# ---------------------------------------------------------------------------
+PREFETCH_DEPTH = 12   # frame in coda per sorgente (720p: ~2.7 MB l'uno)
+_PREFETCH_END = object()
+
+
+class _ReadRecorder:
+    """frame_hook di plan_source_reads: annota (pos, t) di ogni lettura e
+    restituisce un frame finto 1x1 invece di decodificare. Le letture
+    ripetute dello stesso frame contano una volta sola (come in take())."""
+
+    _DUMMY = np.zeros((1, 1, 3), dtype=np.uint8)
+
+    def __init__(self):
+        self.reads = []
+
+    def take(self, pos, t):
+        if not self.reads or self.reads[-1][0] != pos:
+            self.reads.append((pos, t))
+        return self._DUMMY
+
+
+def plan_source_reads(clip, sources, times):
+    """{chiave: [(pos, t), ...]}: le letture di ogni sorgente, in ordine,
+    fatte da clip.get_frame(t) per ogni t di times. Il giro a vuoto passa
+    per lo stesso codice del render (concatenate di MoviePy,
+    FragmentTimeline, crossfade, stessi float), quindi il piano e' esatto;
+    i frame sono finti 1x1, niente decodifica ne' blend veri. clip va
+    preso PRIMA degli effetti sui pixel (slit-scan, strisce, colore)."""
+    recorders = {}
+    for k, src in sources.items():
+        reader = getattr(src, "reader", None)
+        if isinstance(reader, _ProbedVideoReader):
+            recorders[k] = reader.frame_hook = _ReadRecorder()
+    # Il memo dei frammenti (FragmentTimeline) deve partire vuoto come
+    # partira' in encoding, e non deve tenere i frame finti.
+    reset_memo = getattr(clip, "reset_memo", None)
+    if reset_memo:
+        reset_memo()
+    try:
+        for t in times:
+            clip.get_frame(t)
+    finally:
+        for k in recorders:
+            sources[k].reader.frame_hook = None
+        if reset_memo:
+            reset_memo()
+    return {k: r.reads for k, r in recorders.items()}
+
+
+class _SourcePrefetch:
+    """Coda di una sorgente. Il thread decodifica le letture del piano con
+    una copia del reader (proprio processo ffmpeg, stessa logica di seek)
+    e le mette in coda; take() le consuma in ordine dal thread del render.
+    Una lettura che non e' la prossima del piano (es. la banda selettiva
+    senza sorgente, che rilegge la sequenza sfasata) torna None e la fa il
+    reader principale, senza toccare la coda. Con lossy (uscita live, che
+    salta i frame in ritardo) una lettura che e' piu' avanti nel piano,
+    entro una coda di distanza, scarta i frame saltati invece di
+    diventare un miss: senza, la coda resterebbe indietro per sempre."""
+
+    def __init__(self, reader, reads, depth, stop, lossy=False):
+        self.reads = reads
+        self.lossy = lossy
+        self.skipped = 0              # frame scartati dalla coda (lossy)
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.stop = stop
+        self.next = 0                 # indice in reads della prossima lettura attesa
+        self.last = (None, None)      # ultimo (pos, frame) servito
+        self.hits = 0
+        self.misses = 0
+        self.stall_s = 0.0            # attesa del render su coda vuota
+        self.fill_sum = 0             # frame in coda al momento di ogni take()
+        self.error = None
+        self._reader = copy.copy(reader)
+        self._reader.proc = None
+        self._reader.frame_hook = None
+        self._reader.pos = 1
+        if hasattr(self._reader, "lastread"):
+            del self._reader.lastread
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            for _pos, t in self.reads:
+                if not self._put(self._reader.get_frame(t)):
+                    return
+        except Exception as e:
+            # Il render non si ferma: dal punto in cui il thread si e'
+            # interrotto legge di nuovo il reader principale.
+            self.error = e
+        finally:
+            self._reader.close()
+        self._put(_PREFETCH_END)
+
+    def take(self, pos, t):
+        if pos == self.last[0]:
+            return self.last[1]
+        if self.next >= len(self.reads) or self.reads[self.next][0] != pos:
+            if not (self.lossy and self._skip_to(pos)):
+                self.misses += 1
+                return None
+        self.fill_sum += self.queue.qsize()
+        try:
+            frame = self.queue.get_nowait()
+        except queue.Empty:
+            t0 = time.perf_counter()
+            frame = self.queue.get()
+            self.stall_s += time.perf_counter() - t0
+        if frame is _PREFETCH_END:
+            self.next = len(self.reads)
+            self.misses += 1
+            return None
+        self.next += 1
+        self.hits += 1
+        self.last = (pos, frame)
+        return frame
+
+    def _skip_to(self, pos):
+        ahead = min(len(self.reads), self.next + 1 + self.queue.maxsize)
+        j = next((j for j in range(self.next + 1, ahead) if self.reads[j][0] == pos), None)
+        if j is None:
+            return False
+        while self.next < j:
+            if self.queue.get() is _PREFETCH_END:
+                self.next = len(self.reads)
+                return False
+            self.next += 1
+            self.skipped += 1
+        return True
+
+
+class FramePrefetcher:
+    """Decode-ahead durante l'encoding, come context manager attorno a
+    write_videofile: all'ingresso aggancia una _SourcePrefetch al reader di
+    ogni sorgente del piano (plan_source_reads) e ne avvia il thread,
+    all'uscita ferma i thread e sgancia tutto. depth = frame in coda per
+    sorgente; 0 = disattivato (i reader decodificano da soli come prima).
+    stats() riassume code e attese per la profilazione del render."""
+
+    def __init__(self, sources, plan, depth=PREFETCH_DEPTH, lossy=False):
+        self.sources = sources
+        self.depth = depth
+        self._stop = threading.Event()
+        self.streams = {}
+        if depth > 0:
+            for k, reads in plan.items():
+                if reads:
+                    self.streams[k] = _SourcePrefetch(sources[k].reader, reads, depth, self._stop,
+                                                      lossy=lossy)
+
+    def __enter__(self):
+        for k, stream in self.streams.items():
+            self.sources[k].reader.frame_hook = stream
+            stream.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self._stop.set()
+        for k, stream in self.streams.items():
+            self.sources[k].reader.frame_hook = None
+            stream.thread.join()
+
+    def preroll(self, timeout):
+        """Aspetta, al massimo timeout secondi, che ogni coda sia piena (o
+        che il suo thread abbia finito): l'uscita live parte con il
+        margine intero invece di inseguire il decoder dal primo frame."""
+        end = time.perf_counter() + timeout
+        while time.perf_counter() < end:
+            if all(s.queue.full() or not s.thread.is_alive() for s in self.streams.values()):
+                return
+            time.sleep(0.005)
+
+    def stats(self):
+        taken = sum(s.hits for s in self.streams.values())
+        reads = taken + sum(s.misses for s in self.streams.values())
+        return {
+            "depth": self.depth,
+            "hits": taken,
+            "misses": reads - taken,
+            "stall_s": sum(s.stall_s for s in self.streams.values()),
+            "skipped": sum(s.skipped for s in self.streams.values()),
+            "mean_fill": sum(s.fill_sum for s in self.streams.values()) / taken if taken else 0.0,
+            "errors": [f"V{k + 1}: {s.error}" if isinstance(k, int) else f"{k}: {s.error}"
+                       for k, s in self.streams.items() if s.error is not None],
+        }
+
+
+# ---------------------------------------------------------------------------
+# CACHE FRAME RAW
+# I remix VJ tagliano centinaia di frammenti da loop corti (5-30 s) e
+# ripassano di continuo sugli stessi punti: ogni ritorno e' un nuovo seek
+# e una nuova decodifica H.264. Per le sorgenti in cui conviene
+# (frame_cache_pays_off, deciso sul piano delle letture) i frame vengono
+# decodificati UNA volta, gia' alla geometria di export e all'fps del
+# render, in un file uint8 grezzo letto come np.memmap: un frame e' una
+# slice, senza copie ne' decoder. Il file e' per contenuto + geometria +
+# fps e viene scritto con un rename atomico, quindi i render paralleli
+# (CLI --jobs, worker della coda) lo condividono in sola lettura.
+# ---------------------------------------------------------------------------
+FRAME_CACHE_DIR = os.environ.get(
+    "LOOP507_FRAME_CACHE_DIR", os.path.join(tempfile.gettempdir(), "loop507_frames"))
+FRAME_CACHE_MAX_BYTES = int(float(os.environ.get("LOOP507_FRAME_CACHE_GB", "4")) * 1024 ** 3)
+FRAME_CACHE_MAX_SOURCE_BYTES = 1024 ** 3   # sorgenti piu' grandi restano al decoder
+
+
+def source_frame_key(clip, t):
+    """(reader, frame) che clip.get_frame(t) legge da un LazyVideoFileClip
+    (reader ffmpeg o della FrameCache, quello attivo adesso); None per
+    qualunque altro clip. Base delle chiavi dei frame statici."""
+    reader = getattr(clip, "reader", None)
+    if isinstance(reader, (_ProbedVideoReader, RawFrameReader)):
+        return (id(reader), reader.frame_index(t))
+    return None
+
+
+class RawFrameReader:
+    """Reader su una np.memmap (n, h, w, 3) della FrameCache, al posto del
+    _ProbedVideoReader di un LazyVideoFileClip: i subclip e la
+    FragmentTimeline leggono clip.reader a ogni frame, quindi basta
+    sostituirlo. Il frame per t e' int(t * fps) all'fps del render (vedi
+    FrameCache._build): sugli istanti della griglia del render e' lo
+    stesso frame del reader ffmpeg; un frammento che parte fra due
+    istanti della griglia puo' anticipare di meno di un frame del render."""
+
+    def __init__(self, frames, fps, infos):
+        self.frames = frames
+        self.fps = fps
+        self.infos = infos
+        self.size = (frames.shape[2], frames.shape[1])
+        self.duration = infos["video_duration"]
+        self.nframes = len(frames)
+        self.proc = None
+        self.frame_hook = None
+
+    def frame_index(self, t):
+        return min(max(int(self.fps * t + 0.00001), 0), self.nframes - 1)
+
+    def get_frame(self, t):
+        return self.frames[self.frame_index(t)]
+
+    def close(self):
+        pass
+
+
+class FrameCache:
+    """Cartella di file di frame grezzi con budget su disco. I file meno
+    usati di recente (mtime, aggiornato a ogni apertura) vengono rimossi
+    quando un nuovo file non ci sta; un file gia' mappato da un altro
+    processo resta leggibile anche dopo la rimozione (POSIX)."""
+
+    def __init__(self, root=FRAME_CACHE_DIR, max_bytes=FRAME_CACHE_MAX_BYTES,
+                 max_source_bytes=FRAME_CACHE_MAX_SOURCE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_source_bytes = max_source_bytes
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def estimate_bytes(reader, fps):
+        w, h = reader.size
+        return int(math.ceil(reader.duration * fps)) * w * h * 3
+
+    def path_for(self, src_path, reader, fps):
+        w, h = reader.size
+        key = hashlib.sha1(repr((_content_key(src_path), reader.vf, tuple(reader.size),
+                                 reader.resize_algo, float(fps))).encode()).hexdigest()
+        return os.path.join(self.root, f"{key}_{w}x{h}.u8")
+
+    def open(self, src_path, reader, fps, keep=()):
+        """np.memmap read-only dei frame di src_path come li produrrebbe
+        reader, costruita se manca. None se la sorgente supera la soglia
+        per sorgente o non entra nel budget."""
+        path = self.path_for(src_path, reader, fps)
+        if not os.path.exists(path):
+            need = self.estimate_bytes(reader, fps)
+            if need > self.max_source_bytes or not self._make_room(need, keep):
+                return None
+            self._build(src_path, reader, fps, path)
+        w, h = reader.size
+        n = os.path.getsize(path) // (w * h * 3)
+        if n == 0:
+            return None
+        os.utime(path)
+        return np.memmap(path, dtype=np.uint8, mode="r", shape=(n, h, w, 3))
+
+    def _build(self, src_path, reader, fps, path):
+        # fps con round=up: il frame i e' lo stesso che il reader ffmpeg
+        # restituirebbe per get_frame(i / fps), cioe' int(i / fps * fps_sorgente).
+        from moviepy.config import get_setting
+        vf = "fps=%s:round=up,%s" % (fps, reader.vf or "scale=%d:%d" % tuple(reader.size))
+        tmp = f"{path}.{os.getpid()}.part"
+        try:
+            subprocess.run(
+                [get_setting("FFMPEG_BINARY"), "-v", "error", "-y", "-i", src_path, "-an",
+                 "-vf", vf, "-sws_flags", reader.resize_algo, "-pix_fmt", "rgb24",
+                 "-f", "rawvideo", tmp],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _make_room(self, need, keep=()):
+        if need > self.max_bytes:
+            return False
+        files = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".u8"):
+                continue   # .part: un altro processo la sta scrivendo
+            p = os.path.join(self.root, name)
+            try:
+                st_ = os.stat(p)
+            except OSError:
+                continue
+            files.append((st_.st_mtime, st_.st_size, p))
+        total = sum(size for _, size, _ in files)
+        for _, size, p in sorted(files):
+            if total + need <= self.max_bytes:
+                break
+            if p in keep:
+                continue
+            try:
+                os.remove(p)
+                total -= size
+            except OSError:
+                pass
+        return total + need <= self.max_bytes
+
+
+def frame_cache_pays_off(reader, fps, reads):
+    """La cache conviene per questa sorgente? Costi in "frame decodificati"
+    come in _ProbedVideoReader: senza cache ogni ripartenza del decoder
+    (letture non consecutive nel piano) costa l'avvio piu' in media mezzo
+    GOP, e ogni frame letto passa per filtri e pipe; con la cache si paga
+    una volta la decodifica dell'intera sorgente e la conversione dei suoi
+    frame all'fps del render, poi le letture sono slice. In pratica:
+    conviene quando durata della sorgente x frammenti tagliati da li'
+    supera un paio di passate sul file."""
+    if not reads:
+        return False
+    restarts = 1 + sum(1 for (a, _), (b, _) in zip(reads, reads[1:]) if b != a + 1)
+    keyframes = reader.infos.get("keyframes") or [0.0]
+    gop_frames = reader.duration / max(1, len(keyframes)) * reader.fps
+    direct = (restarts * (gop_frames / 2 + _ProbedVideoReader.DECODER_SPAWN_FRAMES)
+              + len(reads) * _ProbedVideoReader.SKIPPED_FRAME_COST)
+    build = (reader.duration * reader.fps
+             + reader.duration * fps * _ProbedVideoReader.SKIPPED_FRAME_COST)
+    return build < direct
+
+
+def use_frame_cache(video_clips, paths, plan, fps, cache=None):
+    """Passa alla FrameCache le sorgenti del piano per cui conviene
+    (frame_cache_pays_off): il reader ffmpeg del clip viene chiuso e
+    sostituito da un RawFrameReader. Restituisce {chiave: (byte, costruita)}
+    per il report; le sorgenti escluse restano al decoder (e al
+    decode-ahead)."""
+    cache = cache or FrameCache()
+    used, keep = {}, set()
+    for k, reads in plan.items():
+        clip = video_clips[k]
+        reader = clip.reader
+        if not isinstance(reader, _ProbedVideoReader) or not frame_cache_pays_off(reader, fps, reads):
+            continue
+        path = cache.path_for(paths[k], reader, fps)
+        built = not os.path.exists(path)
+        try:
+            frames = cache.open(paths[k], reader, fps, keep=keep)
+        except (OSError, subprocess.CalledProcessError):
+            frames = None
+        if frames is None:
+            continue
+        keep.add(path)
+        reader.close()
+        clip.reader = RawFrameReader(frames, fps, reader.infos)
+        used[k] = (frames.nbytes, built)
+    return used
+
+
+# ---------------------------------------------------------------------------
+# SCRITTURA VIDEO
+# write_videofile di MoviePy converte ogni frame con tobytes() (una copia
+# intera del frame) prima di scriverlo nella pipe di ffmpeg, a valle di
+# una catena che di copie ne fa gia' parecchie, e la scrittura blocca il
+# render finche' ffmpeg non ha consumato il frame. RawVideoWriter scrive
+# i frame uint8 contigui direttamente dalla loro memoria (memoryview), da
+# un thread a parte e su una pipe allargata; solo i frame non contigui o
+# non uint8 passano per un pool di buffer preallocati e riusati.
+# ---------------------------------------------------------------------------
+WRITER_POOL_FRAMES = 3          # frame in volo verso ffmpeg / buffer del pool
+PIPE_BUFFER_BYTES = 1024 ** 2   # pipe stdin di ffmpeg (Linux: default 64 KiB)
+
+
+def _enlarge_pipe(fileobj, size=PIPE_BUFFER_BYTES):
+    """Allarga il buffer di una pipe (Linux, F_SETPIPE_SZ): ogni risveglio
+    di ffmpeg si porta via 1 MiB invece di 64 KiB. Altrove non fa nulla."""
+    try:
+        import fcntl
+        fcntl.fcntl(fileobj.fileno(), getattr(fcntl, "F_SETPIPE_SZ", 1031), size)
+    except (ImportError, OSError):
+        pass
+
+
+class RawVideoWriter:
+    """FFMPEG_VideoWriter senza la copia per frame. Stessa riga di comando
+    di MoviePy (rawvideo rgb24 su stdin, '-i audio -acodec copy', codec,
+    preset, ffmpeg_params, yuv420p per libx264 a lati pari), piu' i -map
+    espliciti: con audiofile = un video (l'anteprima prende l'audio dal
+    render finale) ffmpeg sceglierebbe da solo il video a risoluzione
+    piu' alta, cioe' quello sbagliato.
+
+    write_frame() non copia i frame uint8 C-contigui della dimensione
+    giusta: lo stesso array va in coda e finisce nella pipe, quindi chi lo
+    passa non deve piu' modificarlo (i frame del render sono array nuovi
+    o frame read-only del decoder). Gli altri vengono convertiti in uno
+    dei buffer del pool, che torna libero appena scritto."""
+
+    def __init__(self, filename, size, fps, codec="libx264", preset="ultrafast",
+                 audiofile=None, ffmpeg_params=None, pool_size=WRITER_POOL_FRAMES):
+        from moviepy.config import get_setting
+        w, h = size
+        self.filename = filename
+        self.shape = (h, w, 3)
+        cmd = [get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error",
+               "-f", "rawvideo", "-vcodec", "rawvideo", "-s", "%dx%d" % (w, h),
+               "-pix_fmt", "rgb24", "-r", "%.02f" % fps, "-an", "-i", "-"]
+        if audiofile:
+            cmd += ["-i", audiofile, "-acodec", "copy", "-map", "0:v:0", "-map", "1:a:0?"]
+        cmd += ["-vcodec", codec, "-preset", preset] + list(ffmpeg_params or [])
+        if codec == "libx264" and w % 2 == 0 and h % 2 == 0:
+            cmd += ["-pix_fmt", "yuv420p"]
+        cmd.append(filename)
+        # stderr su file: un ffmpeg che scrive molti errori non puo'
+        # bloccarsi su una pipe che nessuno legge.
+        self._log = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                     stderr=self._log, bufsize=0)
+        _enlarge_pipe(self.proc.stdin)
+        self._free = queue.Queue()
+        for _ in range(max(1, pool_size)):
+            self._free.put(np.empty(self.shape, dtype=np.uint8))
+        self._todo = queue.Queue(maxsize=max(1, pool_size))
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write_frame(self, frame):
+        if self._error is not None:
+            self._raise()
+        if frame.dtype == np.uint8 and frame.shape == self.shape and frame.flags.c_contiguous:
+            self._todo.put((frame, None))
+        else:
+            buf = self._free.get()
+            np.copyto(buf, frame, casting="unsafe")
+            self._todo.put((buf, buf))
+
+    def _run(self):
+        out = self.proc.stdin
+        while True:
+            item = self._todo.get()
+            if item is None:
+                return
+            frame, buf = item
+            if self._error is None:
+                try:
+                    view = memoryview(frame).cast("B")
+                    while view:
+                        view = view[out.write(view):]
+                except (OSError, ValueError) as e:
+                    self._error = e
+            if buf is not None:
+                self._free.put(buf)
+
+    def _stop_thread(self):
+        self._todo.put(None)
+        self._thread.join()
+
+    def _raise(self):
+        self.abort()
+        self._log.seek(0)
+        log = self._log.read().decode("utf-8", "replace").strip()
+        self._log.close()
+        raise IOError(f"{self._error}\n\nFFMPEG ({self.filename}):\n{log}")
+
+    def close(self):
+        """Chiude stdin e aspetta ffmpeg. A differenza di MoviePy un
+        codice d'uscita diverso da 0 (es. l'assertion dell'encoder AAC a
+        fine file) e' un errore, con il log di ffmpeg nel messaggio."""
+        if self.proc is None:
+            return
+        self._stop_thread()
+        try:
+            self.proc.stdin.close()
+        except OSError as e:
+            self._error = self._error or e
+        rc = self.proc.wait()
+        if self._error is None and rc != 0:
+            self._error = OSError(f"ffmpeg exit code {rc}")
+        if self._error is not None:
+            self._raise()
+        self.proc = None
+        self._log.close()
+
+    def abort(self):
+        """Render interrotto: ffmpeg va chiuso subito, il file e' da buttare."""
+        if self.proc is None:
+            return
+        self.proc.kill()
+        self._stop_thread()
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+            self._log.close()
+        return False
+
+
+def write_video(clip, filename, fps=None, codec="libx264", preset="ultrafast",
+                audio=None, ffmpeg_params=None, logger=None, frame_key=None):
+    """write_videofile() del render con RawVideoWriter: stessi istanti di
+    iter_frames (np.arange con passo 1/fps, su cui conta anche il piano
+    del decode-ahead), stessa barra 't' per il logger di proglog. audio =
+    path di un file da cui copiare l'audio (WAV del mix, o il render
+    finale per l'anteprima) oppure None/False.
+
+    frame_key : t -> chiave del frame di clip a t (None = non nota). Un
+    tratto statico (freeze, banda con immagine catturata su un freeze)
+    ha la stessa chiave per piu' istanti di fila: il frame viene
+    calcolato una volta e lo stesso array si rimanda al writer, senza
+    decodifica, senza catena di effetti e senza copia. Il video resta a
+    fps costante (rawvideo su pipe non porta timestamp): x264 codifica i
+    frame ripetuti come macroblocchi skip, tempi e sync audio non
+    cambiano. Restituisce il numero di frame riusati."""
+    fps = fps or clip.fps
+    logger = proglog.default_bar_logger(logger)
+    reused = 0
+    last_key = frame = None
+    with RawVideoWriter(filename, clip.size, fps, codec=codec, preset=preset,
+                        audiofile=audio or None, ffmpeg_params=ffmpeg_params) as writer:
+        for t in logger.iter_bar(t=np.arange(0, clip.duration, 1.0 / fps)):
+            key = frame_key(t) if frame_key is not None else None
+            if key is not None and key == last_key:
+                reused += 1
+            else:
+                frame = clip.get_frame(t)
+            writer.write_frame(frame)
+            last_key = key
+    return reused
+
+
+# ---------------------------------------------------------------------------
+# USCITA LIVE
+# Lo stesso clip del render (montaggio, effetti, Modulation Lab) suonato
+# in tempo reale invece che scritto su file: il frame n va consegnato a
+# start + n / fps. Un frame pronto in anticipo aspetta la sua scadenza;
+# quando il frame precedente e' uscito (fine di write_frame, che blocca
+# se ffmpeg o la rete non tengono il passo) piu' di un frame dopo la sua
+# scadenza, questo non viene calcolato e si rimanda l'ultimo (lo stream
+# resta a fps costante, in sync con l'audio). Gli effetti reattivi
+# leggono gli inviluppi gia' analizzati all'istante t del frame, quindi
+# seguono l'orologio dello stream anche quando si salta. L'uscita e' sempre un ffmpeg che legge
+# rawvideo da stdin (RawVideoWriter): MPEG-TS H.264 + audio o MJPEG su
+# un URL (udp://, tcp://...), oppure rgb24 grezzo su una named pipe.
+# ---------------------------------------------------------------------------
+LIVE_SINKS = ("mpegts", "mjpeg", "pipe")
+LIVE_DEFAULT_TARGETS = {"mpegts": "udp://127.0.0.1:5000", "mjpeg": "udp://127.0.0.1:5001",
+                        "pipe": os.path.join(tempfile.gettempdir(), "loop507_live.rgb")}
+LIVE_LATENCY_S = 0.5        # margine di pre-roll e di decode-ahead
+LIVE_WRITER_FRAMES = 2      # frame in volo verso ffmpeg (meno dell'offline: latenza)
+
+
+@dataclass
+class LiveOutput:
+    """Dove e come suonare un render dal vivo (render(..., live=...))."""
+    sink: str = "mpegts"
+    target: Optional[str] = None        # URL o path della pipe (default: LIVE_DEFAULT_TARGETS)
+    latency_s: float = LIVE_LATENCY_S
+    stats_every: float = 2.0            # secondi fra due righe di statistiche (0 = mai)
+    log: Optional[Callable] = print
+
+
+def live_prefetch_depth(latency_s, fps):
+    """Decode-ahead per sorgente che sta nel margine di latenza: una coda
+    piu' lunga non si riempirebbe comunque nel pre-roll."""
+    return max(2, min(48, int(round(latency_s * fps))))
+
+
+def live_writer(live, size, fps, audio=None, video_params=()):
+    """RawVideoWriter verso il sink di 'live'. L'audio (il WAV del mix)
+    va solo in MPEG-TS; i filtri colore dell'encoder (video_params) valgono
+    per tutti i sink, che passano tutti da ffmpeg."""
+    if live.sink not in LIVE_SINKS:
+        raise ValueError(f"Sink live sconosciuto: {live.sink} (validi: {', '.join(LIVE_SINKS)})")
+    target = live.target or LIVE_DEFAULT_TARGETS[live.sink]
+    params = list(video_params)
+    if live.sink == "mpegts":
+        if target.startswith("udp://") and "pkt_size" not in target:
+            target += ("&" if "?" in target else "?") + "pkt_size=1316"
+        params += ["-tune", "zerolatency", "-g", str(max(1, int(round(fps))))]
+        if audio:
+            params += ["-c:a", "aac"]
+        return RawVideoWriter(target, size, fps, codec="libx264", preset="ultrafast",
+                              audiofile=audio, ffmpeg_params=params + ["-f", "mpegts"],
+                              pool_size=LIVE_WRITER_FRAMES)
+    if live.sink == "mjpeg":
+        return RawVideoWriter(target, size, fps, codec="mjpeg", preset="ultrafast",
+                              ffmpeg_params=params + ["-q:v", "5", "-f", "mjpeg"],
+                              pool_size=LIVE_WRITER_FRAMES)
+    # Named pipe: creata se manca. ffmpeg resta fermo all'apertura finche'
+    # dall'altra parte non c'e' un lettore (rgb24, dimensione e fps del render).
+    if not os.path.exists(target):
+        os.mkfifo(target)
+    return RawVideoWriter(target, size, fps, codec="rawvideo", preset="ultrafast",
+                          ffmpeg_params=params + ["-pix_fmt", "rgb24", "-f", "rawvideo"],
+                          pool_size=LIVE_WRITER_FRAMES)
+
+
+class LiveStats:
+    """Contatori di play_live: frame inviati, saltati (ritardo: si rimanda
+    l'ultimo), riusati (stessa chiave statica). frame_times = ritardo di
+    ogni frame inviato, dalla sua scadenza alla fine di write_frame (lo
+    stesso numero che decide i salti); compute_times = solo get_frame."""
+
+    def __init__(self, fps):
+        self.fps = fps
+        self.sent = 0
+        self.dropped = 0
+        self.reused = 0
+        self.frame_times = []
+        self.compute_times = []
+        self.elapsed = 0.0
+
+    def p95_ms(self):
+        return float(np.percentile(self.frame_times, 95)) * 1000.0 if self.frame_times else 0.0
+
+    def compute_p95_ms(self):
+        return float(np.percentile(self.compute_times, 95)) * 1000.0 if self.compute_times else 0.0
+
+    def achieved_fps(self):
+        # frame calcolati davvero (non rimandati) al secondo di orologio
+        return (self.sent - self.dropped) / self.elapsed if self.elapsed > 0 else 0.0
+
+    def line(self):
+        return (f"live {self.elapsed:6.1f}s  {self.achieved_fps():5.1f}/{self.fps:g} fps  "
+                f"saltati {self.dropped}  riusati {self.reused}  p95 {self.p95_ms():.1f} ms "
+                f"(calcolo {self.compute_p95_ms():.1f} ms)")
+
+    def as_dict(self):
+        return {"elapsed_s": round(self.elapsed, 3), "target_fps": self.fps, "sent": self.sent,
+                "dropped": self.dropped, "reused": self.reused,
+                "achieved_fps": round(self.achieved_fps(), 2), "p95_frame_ms": round(self.p95_ms(), 2),
+                "p95_compute_ms": round(self.compute_p95_ms(), 2)}
+
+
+def play_live(clip, writer, fps, frame_key=None, log=print, stats_every=2.0,
+              clock=time.perf_counter, sleep=time.sleep):
+    """Suona clip su writer a 'fps' contro l'orologio (vedi USCITA LIVE).
+    frame_key come in write_video: un frame con la stessa chiave del
+    precedente non si ricalcola. Restituisce le LiveStats."""
+    stats = LiveStats(fps)
+    period = 1.0 / fps
+    frame = last_key = None
+    late = 0.0          # ritardo del frame precedente alla fine di write_frame
+    late_at_drop = None  # ritardo che ha fatto saltare il frame precedente
+    start = clock()
+    next_log = start + stats_every
+    for n, t in enumerate(np.arange(0, clip.duration, period)):
+        deadline = start + n * period
+        # Un altro salto solo se il precedente ha recuperato: se il ritardo
+        # non scende e' l'uscita a non tenere il passo, non il calcolo, e
+        # saltare ancora congelerebbe lo stream sull'ultimo frame.
+        if frame is not None and late > period and (late_at_drop is None or late < late_at_drop):
+            stats.dropped += 1
+            late_at_drop = late
+        else:
+            late_at_drop = None
+            key = frame_key(t) if frame_key is not None else None
+            if key is not None and key == last_key:
+                stats.reused += 1
+            else:
+                t0 = clock()
+                frame = clip.get_frame(t)
+                stats.compute_times.append(clock() - t0)
+            last_key = key
+            wait = deadline - clock()
+            if wait > 0:
+                sleep(wait)
+        writer.write_frame(frame)
+        late = clock() - deadline
+        stats.frame_times.append(late)
+        stats.sent += 1
+        if log is not None and stats_every > 0 and clock() >= next_log:
+            stats.elapsed = clock() - start
+            log(stats.line())
+            next_log += stats_every
+    stats.elapsed = clock() - start
+    return stats
 
-    if not pieces:
-        return audio_clip.set_duration(total_duration)
 
-    result = concatenate_audioclips(pieces)
-    return result.set_duration(min(elapsed, total_duration))
+# ---------------------------------------------------------------------------
+# FRAME SERVER (scrubbing)
+# Il montaggio pianificato con i suoi effetti, interrogato a un istante
+# qualunque invece che frame dopo frame: render(..., serve=True) prepara
+# lo stesso clip del render (analisi audio, piano dei tagli, Modulation
+# Lab, colore/saturazione numpy) senza scrivere nulla e lo restituisce
+# qui. Nessun lavoro nuovo per l'accesso casuale: il frammento attivo lo
+# trova la bisect di FragmentTimeline, il reader (_ProbedVideoReader)
+# decodifica dal keyframe piu' vicino solo se conviene rispetto a leggere
+# in avanti, e gli effetti si calcolano per quel solo frame.
+#
+# L'istante si arrotonda alla griglia del render (n / fps), quindi a
+# parita' di seed il frame e' quello del file — tranne bande temporali e
+# slit scan, che pescano dal random a ogni frame in ordine di lettura.
+# ---------------------------------------------------------------------------
+FRAME_SERVER_CACHE = 96     # frame composti tenuti in memoria (LRU)
+
+
+class FrameServer:
+    """Frame composto del montaggio all'istante t (frame_at), con una LRU
+    degli ultimi frame chiesti. Tiene aperte le sorgenti del render
+    (engine e clips, es. i video dedicati delle strisce): close() (o il
+    with) le chiude. Thread-safe: le letture sono in serie."""
+
+    def __init__(self, clip, engine=None, frame_key=None, cache_frames=FRAME_SERVER_CACHE,
+                 log="", clips=()):
+        self.clip = clip
+        self.engine = engine
+        self.clips = list(clips)
+        self.frame_key = frame_key
+        self.fps = clip.fps
+        self.duration = clip.duration
+        self.size = tuple(clip.size)
+        self.log = log                  # righe del log tecnico del montaggio
+        # frame della griglia: stesso np.arange di iter_frames
+        self.n_frames = max(1, len(np.arange(0, self.duration, 1.0 / self.fps)))
+        self.cache_frames = max(1, int(cache_frames))
+        self._cache = OrderedDict()     # n -> frame (read-only)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.frame_times = []
+
+    def frame_index(self, t):
+        """Indice del frame della griglia del render piu' vicino a t."""
+        return min(self.n_frames - 1, max(0, int(round(float(t) * self.fps))))
+
+    def frame_at(self, t):
+        """Frame RGB uint8 (h, w, 3) all'istante t, agganciato alla
+        griglia del render. Non modificare: e' quello tenuto in cache."""
+        n = self.frame_index(t)
+        with self._lock:
+            frame = self._cache.get(n)
+            if frame is not None:
+                self._cache.move_to_end(n)
+                self.hits += 1
+                return frame
+            t0 = time.perf_counter()
+            frame = self.clip.get_frame(n * (1.0 / self.fps))
+            if frame.dtype != np.uint8:
+                frame = frame.clip(0, 255).astype(np.uint8)
+            frame.setflags(write=False)
+            self.frame_times.append(time.perf_counter() - t0)
+            self.misses += 1
+            self._cache[n] = frame
+            while len(self._cache) > self.cache_frames:
+                self._cache.popitem(last=False)
+            return frame
+
+    def stats(self):
+        ft = self.frame_times
+        return {"hits": self.hits, "misses": self.misses, "cached": len(self._cache),
+                "mean_ms": round(float(np.mean(ft)) * 1000.0, 2) if ft else 0.0,
+                "p95_ms": round(float(np.percentile(ft, 95)) * 1000.0, 2) if ft else 0.0}
+
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+            if self.engine is not None:
+                self.engine.close_sources()
+                self.engine = None
+            for c in self.clips:
+                c.close()
+            self.clips = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def frame_server(config, progress=None, analysis_cache=None, cache_frames=FRAME_SERVER_CACHE):
+    """API Python dello scrubbing: FrameServer sul montaggio di 'config'
+    (un RenderConfig, come per render). Per ritrovare lo stesso montaggio
+    in un render successivo serve config.seed fissato."""
+    server = render(config, progress=progress, analysis_cache=analysis_cache, serve=True)
+    server.cache_frames = max(1, int(cache_frames))
+    return server
 
 
 # ---------------------------------------------------------------------------
@@ -1628,38 +3636,40 @@ def decompose_audio_track(audio_clip, cut_schedule, total_duration):
 class VideoEngine:
     def __init__(self):
         self.video_clips = {}
+        self.source_infos = {}   # probe_source() per chiave
+        self.seek_aware = False  # start vicino ai keyframe (seek_aware_start)
+        self.effect_threads = 1  # thread per frame dello slit scan (run_tiled)
         self.stats = {"fragments": 0, "sources": 0}
+        # Frammenti dell'ultima generate*() nell'ordine di montaggio, come
+        # Fragment (sorgente, punto di partenza, durata): servono all'audio
+        # engine per ricostruire l'audio originale senza il grafo di clip.
+        self.fragments = []
+        # Montaggio dell'ultima generate*() prima dello slit-scan: il clip
+        # su cui plan_source_reads() ricava le letture (decode-ahead).
+        self.timeline = None
 
     def load_sources(self, paths, target_size=None):
         # target_size = (w, h) del formato di export scelto. Il video finale
-        # verra' comunque tagliato/scalato a quella dimensione (fit_to_size)
-        # — decodificare le sorgenti a piena risoluzione nativa (es. 4K) per
-        # poi scartare i pixel in piu' e' solo spreco di RAM, moltiplicato
-        # per ogni sorgente caricata (con piu' video insieme il carico si
-        # somma: candidato concreto per OOM su host con memoria limitata
-        # come il piano gratuito di Streamlit Cloud).
+        # verra' comunque tagliato/scalato a quella dimensione — decodificare
+        # le sorgenti a piena risoluzione nativa (es. 4K) per poi scartare i
+        # pixel in piu' e' solo spreco di RAM, moltiplicato per ogni
+        # sorgente caricata (con piu' video insieme il carico si somma:
+        # candidato concreto per OOM su host con memoria limitata come il
+        # piano gratuito di Streamlit Cloud).
         #
-        # ATTENZIONE: MoviePy, se target_resolution specifica SIA altezza CHE
-        # larghezza, forza quell'esatta dimensione senza rispettare l'aspect
-        # ratio (deformazione) — romperebbe silenziosamente il crop-to-fill di
-        # fit_to_size. Per questo qui si vincola SOLO l'asse piu' grande della
-        # sorgente (l'altro resta None), cosi' MoviePy scala mantenendo l'aspect
-        # ratio nativo — fit_to_size riceve un frame piu' piccolo ma con le
-        # stesse proporzioni di sempre, e ricalcola scale/crop esattamente come
-        # prima, solo partendo da una risoluzione di decodifica piu' bassa.
-        # Se il probe fallisce per qualsiasi motivo, si procede alla risoluzione
-        # nativa: nessuna regressione, solo nessun risparmio di memoria.
-        DECODE_CAP = 1600  # margine oltre il piu' grande formato di export (1280px)
+        # Prima si limitava solo il lato lungo (1600px) e fit_to_size
+        # rifaceva resize + crop in Python su ogni frame: per una sorgente
+        # 16:9 esportata in 9:16 il decoder produceva frame larghi 1600px
+        # di cui Python buttava via quasi tutto. Ora scale + crop sono un
+        # filtro ffmpeg del reader (stessi conti di fit_to_size, vedi
+        # fit_geometry): dalla pipe arrivano gia' frame target_size e
+        # fit_to_size li restituisce cosi' come sono.
+        # Probe di tutte le sorgenti in parallelo (e in cache): i clip
+        # sono LazyVideoFileClip, il decoder parte al primo frame letto.
+        infos = probe_sources(paths)
+        self.source_infos = infos
         for i, p in paths.items():
-            target_resolution = None
-            if target_size is not None:
-                try:
-                    native_w, native_h = ffmpeg_parse_infos(p)["video_size"]
-                    if max(native_w, native_h) > DECODE_CAP:
-                        target_resolution = (None, DECODE_CAP) if native_w >= native_h else (DECODE_CAP, None)
-                except Exception:
-                    target_resolution = None
-            self.video_clips[i] = VideoFileClip(p, target_resolution=target_resolution)
+            self.video_clips[i] = LazyVideoFileClip(p, infos[i], fit_size=target_size)
         self.stats["sources"] = len(self.video_clips)
         first_key = next(iter(self.video_clips))
         return self.video_clips[first_key].size
@@ -1711,12 +3721,14 @@ class VideoEngine:
         b_start = chosen_bucket * bucket_size
         b_end   = min(b_start + bucket_size, max_start)
         s = random.uniform(b_start, b_end)
+        if self.seek_aware:
+            s = seek_aware_start(s, b_start, b_end, getattr(source, "infos", {}).get("keyframes"))
 
         counts[chosen_bucket] += 1
         return s
 
     def generate_fixed_quota(self, quotas, r_a, r_b, r_rand, duration, fps,
-                              s_a, s_b, s_rand, scan_dir, p_bar, use_scan,
+                              s_a, s_b, s_rand, scan_dir, reporter, use_scan,
                               beat_times=None, rms_envelope=None, export_size=None):
         keys = list(self.video_clips.keys())
         target_size = export_size or self.video_clips[keys[0]].size
@@ -1729,6 +3741,7 @@ class VideoEngine:
         time_budget = {k: norm[k] * duration for k in keys}
         recent_cuts = {k: [] for k in keys}
         all_clips = []
+        all_frags = []
 
         # --- Intervalli beat reali: se disponibili, guidano la durata delle
         # slice anche in Quote Fisse (prima venivano ignorati del tutto: il
@@ -1767,29 +3780,37 @@ class VideoEngine:
                 start_p = self._pick_start(source, k, seg_dur, recent_cuts)
                 clip = fit_to_size(source.subclip(start_p, start_p + seg_dur), target_size).set_fps(fps)
                 all_clips.append(clip)
+                all_frags.append(Fragment(k, start_p, seg_dur))
                 spent += seg_dur
                 progress = spent / budget
                 self.stats["fragments"] += 1
-                p_bar.progress(min(self.stats["fragments"] / max(1, int(duration / r_a)) * 0.4, 0.4),
-                               text=f"Composizione: {self.stats['fragments']} pezzi")
-
-        random.shuffle(all_clips)
+                reporter.update(min(self.stats["fragments"] / max(1, int(duration / r_a)) * 0.4, 0.4),
+                                text=f"Composizione: {self.stats['fragments']} pezzi")
+
+        # Clip e Fragment mescolati insieme (stessa permutazione, stesse
+        # chiamate al generatore casuale di prima).
+        paired = list(zip(all_clips, all_frags))
+        random.shuffle(paired)
+        all_clips = [c for c, _ in paired]
+        self.fragments = [f for _, f in paired]
         cut_schedule = [c.duration for c in all_clips]
-        final = concatenate_in_batches(all_clips, method="chain").set_duration(duration)
+        final = self.timeline = concatenate_in_batches(all_clips, method="chain").set_duration(duration)
         if use_scan:
             _rms = rms_envelope
             final = final.fl(lambda gf, t: apply_procedural_slit_scan(
-                gf, t, final.duration, s_a, s_b, s_rand, scan_dir, _rms))
+                gf, t, final.duration, s_a, s_b, s_rand, scan_dir, _rms,
+                threads=self.effect_threads))
         return final, cut_schedule
 
     def generate(self, weights, r_a, r_b, r_rand, duration, fps,
-                 s_a, s_b, s_rand, scan_dir, p_bar, use_scan,
+                 s_a, s_b, s_rand, scan_dir, reporter, use_scan,
                  beat_times=None, rms_envelope=None, export_size=None):
         curr_t = 0
         clips = []
         keys = list(self.video_clips.keys())
         target_size = export_size or self.video_clips[keys[0]].size
         self.stats["fragments"] = 0
+        self.fragments = []
         beat_idx = 0
         recent_cuts = {k: [] for k in keys}
 
@@ -1815,17 +3836,19 @@ class VideoEngine:
             start_p = self._pick_start(source, v_idx, seg_dur, recent_cuts)
             clip = fit_to_size(source.subclip(start_p, start_p + seg_dur), target_size).set_fps(fps)
             clips.append(clip)
+            self.fragments.append(Fragment(v_idx, start_p, seg_dur))
             curr_t += seg_dur
             self.stats["fragments"] += 1
-            p_bar.progress(min(curr_t / duration * 0.4, 0.4),
-                           text=f"Composizione: {self.stats['fragments']} pezzi")
+            reporter.update(min(curr_t / duration * 0.4, 0.4),
+                            text=f"Composizione: {self.stats['fragments']} pezzi")
 
         cut_schedule = [c.duration for c in clips]
-        final = concatenate_in_batches(clips, method="chain").set_duration(duration)
+        final = self.timeline = concatenate_in_batches(clips, method="chain").set_duration(duration)
         if use_scan:
             _rms = rms_envelope
             final = final.fl(lambda gf, t: apply_procedural_slit_scan(
-                gf, t, final.duration, s_a, s_b, s_rand, scan_dir, _rms))
+                gf, t, final.duration, s_a, s_b, s_rand, scan_dir, _rms,
+                threads=self.effect_threads))
         return final, cut_schedule
 
 
@@ -1912,7 +3935,2446 @@ def translate_report_to_en(text: str) -> str:
 # ---------------------------------------------------------------------------
 # INTERFACCIA
 # ---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+# RENDER HEADLESS — la pipeline di "AVVIA RENDERING" senza Streamlit.
+# main() costruisce un RenderConfig dai widget e chiama render(); lo stesso
+# render() si usa da Python o da riga di comando con un job JSON/YAML:
+#
+#   python app.py render job.json
+#   python app.py render cartella_job/ --jobs 4 --out renders/
+# ---------------------------------------------------------------------------
+
+# Preset "automatici" di Decompose — combinano in un colpo solo ritmo dei
+# tagli e spessore/asse delle strisce, sul modello di VJ_PRESETS in VJ Mode.
+# Non richiedono audio: sono solo scorciatoie di stile per evitare di tarare
+# a mano min/max e px ogni volta.
+DECOMPOSE_PRESETS = {
+    "Lento Cinematico":    dict(r_a=0.8,  r_b=2.0, r_rand=True,
+                                 s_a=20, s_b=60,  s_rand=False, scan_dir="Orizzontale"),
+    "Standard Bilanciato": dict(r_a=0.2,  r_b=1.0, r_rand=True,
+                                 s_a=10, s_b=80,  s_rand=True,  scan_dir="Mix"),
+    "Nervoso Glitch":      dict(r_a=0.1,  r_b=0.4, r_rand=True,
+                                 s_a=5,  s_b=40,  s_rand=True,  scan_dir="Verticale"),
+    "Random Estremo":      dict(r_a=0.05, r_b=3.0, r_rand=True,
+                                 s_a=1,  s_b=150, s_rand=True,  scan_dir="Mix"),
+}
+
+# Preset per genere musicale — valori tarati su stutter/loop/crossfade/freeze.
+# "subdiv" e' la misura beat di base (in unita' MEASURE_FACTORS) usata in
+# automatico: prima non esisteva, e il default generico (bpm_to_default_
+# subdivision) raggruppava 4 beat per slice per QUALSIASI genere a tempo
+# medio/alto — quindi "Techno" tagliava alla stessa grana lenta di
+# "Ambient", niente affatto reattivo.
+VJ_PRESETS = {
+    "Techno":   dict(loop_reps=3, stutter_prob=0.50, pitch_glitch=False,
+                      crossfade_ms=40,  freeze_prob=0.35, freeze_ms=100, subdiv=0.5),
+    "House":    dict(loop_reps=2, stutter_prob=0.30, pitch_glitch=False,
+                      crossfade_ms=100, freeze_prob=0.20, freeze_ms=150, subdiv=1.0),
+    "Ambient":  dict(loop_reps=1, stutter_prob=0.10, pitch_glitch=False,
+                      crossfade_ms=250, freeze_prob=0.10, freeze_ms=300, subdiv=2.0),
+    "Pop":      dict(loop_reps=2, stutter_prob=0.25, pitch_glitch=False,
+                      crossfade_ms=80,  freeze_prob=0.20, freeze_ms=150, subdiv=1.0),
+    "Classica": dict(loop_reps=1, stutter_prob=0.05, pitch_glitch=False,
+                      crossfade_ms=300, freeze_prob=0.08, freeze_ms=250, subdiv=4.0),
+}
+
+
+@dataclass
+class StripeConfig:
+    """Una banda selettiva (Modulation Lab) del VJ Mode. Stessi parametri
+    degli slider 'Banda selettiva 1/2'. source: None = fallback (stessa
+    sequenza sfasata di offset_s), int = indice di una delle sorgenti
+    caricate, str = path di un video dedicato."""
+
+    pct: float = 18.0
+    pos: float = 50.0
+    orient: str = "Orizzontale"
+    offset_s: float = 2.0
+    amount: float = 0.6
+    base_opacity: float = 0.15
+    length_pct: float = 100.0
+    length_pos_pct: float = 50.0
+    content_follows: bool = False
+    content_anchor_pos: float = 50.0
+    content_anchor_length_pos: float = 50.0
+    source: object = None
+    frozen_content: object = None  # ritaglio HxWx3 catturato (immagine fissa)
+
+
+@dataclass
+class RenderConfig:
+    """Tutto quello che serve a un render, senza widget: i nomi dei campi
+    sono gli stessi delle variabili di main(). sources = {indice: path},
+    audio = path del brano (opzionale)."""
+
+    sources: dict = field(default_factory=dict)
+    audio: Optional[str] = None
+    audio_name: Optional[str] = None   # nome originale (chiave cache analisi)
+    app_mode: str = "VJ Mode"
+    duration: float = 15.0
+    fps: int = 24
+    formato_label: str = "16:9 (1280x720)"
+    fast_audio_analysis: bool = False
+    seek_aware: bool = False            # start dei tagli vicino ai keyframe
+    prefetch_depth: int = PREFETCH_DEPTH  # decode-ahead: frame in coda per sorgente (0 = off)
+    frame_cache: bool = True            # cache frame raw dove conviene (frame_cache_pays_off)
+    encoder_color: bool = True          # colore/saturazione reattivi come filtri ffmpeg dell'encoder
+    jit_kernels: bool = True            # kernel Numba per il blend delle bande, se disponibile
+    effect_threads: int = EFFECT_THREADS  # thread per frame degli effetti numpy (run_tiled)
+    bpm: Optional[float] = None         # solo per il report
+    bpm_manual: bool = False
+    seed: Optional[int] = None
+    name: Optional[str] = None          # nome file di output (default render_name)
+    output_dir: Optional[str] = None    # default: cartella temporanea
+    make_preview: bool = True
+
+    # Decompose
+    mix_mode: str = "Random"
+    weights: dict = field(default_factory=dict)
+    quotas: dict = field(default_factory=dict)
+    decompose_style: Optional[str] = None
+    r_a: float = 0.2
+    r_b: float = 1.0
+    r_rand: bool = False
+    use_scan: bool = True
+    s_a: int = 10
+    s_b: int = 80
+    s_rand: bool = True
+    scan_dir: str = "Orizzontale"
+    beat_sync: bool = False
+
+    # VJ Mode
+    auto_vj: bool = False
+    vj_genre: Optional[str] = None
+    slice_dur: float = 0.25
+    loop_reps: int = 2
+    stutter_prob: float = 0.4
+    pitch_glitch: bool = False
+    beat_slice_mode: bool = False
+    cut_source: str = "beat"
+    crossfade_dur: float = 0.0
+    freeze_on_beat: bool = False
+    freeze_prob: float = 0.0
+    freeze_dur: float = 0.15
+    source_mode: str = "random"
+    source_weights: dict = field(default_factory=dict)
+    no_repeat: bool = False
+    slice_density: float = 1.0
+    beat_subdivision_mode: str = "fixed"
+    beat_subdivision_factor: float = 1.0
+    beat_subdivision_choices: Optional[list] = None
+    manual_duration_mode: str = "fixed"
+    manual_duration_choices: object = None
+    react_to_peaks: bool = True
+    subdivision_coarsen: float = 1.0
+    mod_lab_on: bool = False
+    mod_matrix_amount: float = 0.35
+    stripes: list = field(default_factory=list)
+
+    # Audio e post-processing
+    audio_mix_mode: str = "custom_only"
+    vol_music: float = 1.0
+    vol_original: float = 1.0
+    color_react_amount: float = 0.0
+    saturation_react_amount: float = 0.0
+    temporal_bands_on: bool = False
+    tb_intensity: float = 0.0
+    tb_ampiezza: float = 0.0
+    tb_spostamento: float = 0.0
+    tb_direzione: float = 0.0
+
+    @property
+    def export_size(self):
+        return EXPORT_SIZES.get(self.formato_label)
+
+    @property
+    def use_custom_audio(self):
+        return bool(self.audio) and self.audio_mix_mode != "original_only"
+
+
+@dataclass
+class RenderResult:
+    video_path: Optional[str]           # None per un render live
+    preview_path: Optional[str]
+    render_name: str
+    report: str
+    profiling: dict
+    profiling_log: str
+    fragments: int
+    cut_schedule: Optional[list] = None
+    warnings: list = field(default_factory=list)
+
+
+class ProgressReporter:
+    """Avanzamento del render, separato da chi lo mostra. I motori chiamano
+    update() quante volte vogliono (a ogni frammento, a ogni frame
+    scritto): verso il sink — qualsiasi oggetto con .progress(value,
+    text), cioe' st.progress o _QueueProgress — passa al massimo un
+    aggiornamento ogni 1/max_rate secondi. Prima ogni chiamata era un
+    delta websocket di Streamlit (o una scrittura sul database della
+    coda), migliaia per render con subdivisioni fitte.
+
+    force=True (cambio di fase: "Analisi audio...", "Scrittura video...")
+    passa sempre, dopo l'ultimo valore trattenuto della fase precedente;
+    flush() manda l'ultimo valore trattenuto (render() lo chiama a fine
+    encoding, quando non segue subito un cambio di fase)."""
+
+    def __init__(self, sink=None, max_rate=10.0):
+        self.sink = sink
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self._last_emit = 0.0
+        self._pending = None
+
+    def update(self, value, text=None, force=False):
+        value = min(max(float(value), 0.0), 1.0)
+        now = time.monotonic()
+        if not force and now - self._last_emit < self.min_interval:
+            self._pending = (value, text)
+            return
+        if force:
+            self.flush()
+        self._emit(value, text, now)
+
+    def flush(self):
+        if self._pending is not None:
+            self._emit(*self._pending, time.monotonic())
+
+    def encode_logger(self, lo, hi, text):
+        """Logger da passare a write_videofile: avanzamento in frame
+        scritti, mappato nell'intervallo [lo, hi]."""
+        return _EncodeProgressLogger(self, lo, hi, text)
+
+    def _emit(self, value, text, now):
+        self._pending = None
+        self._last_emit = now
+        if self.sink is not None:
+            self.sink.progress(value, text=text)
+
+
+class _NullProgress(ProgressReporter):
+    """Nessun avanzamento (render headless, CLI, benchmark): update() non
+    fa nulla, nemmeno il controllo del tempo."""
+
+    def update(self, value, text=None, force=False):
+        pass
+
+    def flush(self):
+        pass
+
+    def encode_logger(self, lo, hi, text):
+        return None   # logger=None: MoviePy non traccia nemmeno i frame
+
+
+class _EncodeProgressLogger(proglog.ProgressBarLogger):
+    """Logger di write_videofile -> ProgressReporter: i frame scritti
+    (barra 't' di MoviePy) mappati tra lo e hi, cosi' la barra avanza
+    durante l'encoding invece di saltare da 0.75 a 0.90 alla fine."""
+
+    def __init__(self, reporter, lo, hi, text):
+        super().__init__(min_time_interval=0.1)
+        self.reporter = reporter
+        self.lo, self.hi, self.text = lo, hi, text
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        if bar != "t" or attr != "index":
+            return
+        total = self.bars[bar].get("total") or 0
+        if total:
+            done = min(value, total)
+            self.reporter.update(self.lo + (self.hi - self.lo) * done / total,
+                                 text=f"{self.text} ({done}/{total} frame)")
+
+
+def apply_preset(config, preset_name):
+    """Applica un preset VJ_PRESETS / DECOMPOSE_PRESETS al config, con gli
+    stessi valori che la UI mette negli slider quando 'Automatico' e'
+    attivo. I valori espliciti del job vanno applicati DOPO."""
+    if config.app_mode == "Decompose":
+        if preset_name not in DECOMPOSE_PRESETS:
+            raise ValueError(f"Preset Decompose sconosciuto: {preset_name}")
+        for k, v in DECOMPOSE_PRESETS[preset_name].items():
+            setattr(config, k, v)
+        config.decompose_style = preset_name
+        return config
+    if preset_name not in VJ_PRESETS:
+        raise ValueError(f"Preset VJ sconosciuto: {preset_name}")
+    p = VJ_PRESETS[preset_name]
+    config.auto_vj = True
+    config.vj_genre = preset_name
+    config.beat_slice_mode = bool(config.audio)
+    config.beat_subdivision_mode = "tempo_adaptive"
+    config.beat_subdivision_factor = p["subdiv"]
+    config.loop_reps = p["loop_reps"]
+    config.stutter_prob = p["stutter_prob"]
+    config.pitch_glitch = p["pitch_glitch"]
+    config.crossfade_dur = p["crossfade_ms"] / 1000.0
+    config.freeze_on_beat = True
+    config.freeze_prob = p["freeze_prob"]
+    config.freeze_dur = p["freeze_ms"] / 1000.0
+    return config
+
+
+_JOB_MODES = {"vj": "VJ Mode", "vj mode": "VJ Mode", "vj_mode": "VJ Mode",
+              "decompose": "Decompose"}
+_JOB_EXPORT = {"16:9": "16:9 (1280x720)", "9:16": "9:16 (720x1280)", "1:1": "1:1 (720x720)"}
+_JOB_EFFECTS = {"color_react": "color_react_amount",
+                "saturation_react": "saturation_react_amount"}
+
+
+def _int_keys(d):
+    """{"0": [a, b]} (chiavi e tuple come le restituisce JSON) ->
+    {0: (a, b)}: weights, quotas, source_weights, sources."""
+    return {int(k): (tuple(v) if isinstance(v, list) else v) for k, v in (d or {}).items()}
+
+
+def config_from_spec(spec, base_dir="."):
+    """Dizionario di un job (JSON/YAML gia' letto) -> RenderConfig.
+
+    Chiavi: sources (lista o {indice: path}), audio, mode, preset, export
+    ("16:9" / "9:16" / "1:1" o etichetta completa), effects (color_react,
+    saturation_react, temporal_bands, stripes) e, per tutto il resto,
+    qualsiasi campo di RenderConfig con lo stesso nome. I path relativi
+    sono risolti rispetto a base_dir (la cartella del job)."""
+    spec = dict(spec)
+
+    def _path(p):
+        return p if p is None or os.path.isabs(p) else os.path.normpath(os.path.join(base_dir, p))
+
+    sources = spec.pop("sources", None)
+    if not sources:
+        raise ValueError("Il job non ha 'sources'.")
+    if isinstance(sources, dict):
+        sources = {int(k): _path(v) for k, v in sources.items()}
+    else:
+        sources = {i: _path(p) for i, p in enumerate(sources)}
+
+    audio = _path(spec.pop("audio", None))
+    mode = str(spec.pop("mode", "VJ Mode"))
+    mode = _JOB_MODES.get(mode.lower(), mode)
+    if mode not in ("Decompose", "VJ Mode"):
+        raise ValueError(f"Modalita' sconosciuta: {mode}")
+
+    config = RenderConfig(sources=sources, audio=audio, app_mode=mode,
+                          audio_name=os.path.basename(audio) if audio else None)
+
+    export = spec.pop("export", None)
+    if export is not None:
+        export = _JOB_EXPORT.get(export, export)
+        if export not in EXPORT_SIZES:
+            raise ValueError(f"Formato di export sconosciuto: {export}")
+        config.formato_label = export
+
+    preset = spec.pop("preset", None)
+    if preset:
+        apply_preset(config, preset)
+
+    effects = dict(spec.pop("effects", None) or {})
+    for k, attr in _JOB_EFFECTS.items():
+        if k in effects:
+            setattr(config, attr, float(effects.pop(k)))
+    tb = effects.pop("temporal_bands", None)
+    if tb:
+        config.temporal_bands_on = True
+        tb = tb if isinstance(tb, dict) else {}
+        config.tb_intensity = float(tb.get("intensity", 0.7))
+        config.tb_ampiezza = float(tb.get("ampiezza", 0.5))
+        config.tb_spostamento = float(tb.get("spostamento", 0.6))
+        config.tb_direzione = float(tb.get("direzione", 0.5))
+    for s in effects.pop("stripes", None) or []:
+        s = dict(s)
+        if isinstance(s.get("source"), str):
+            s["source"] = _path(s["source"])
+        config.stripes.append(StripeConfig(**s))
+    if effects:
+        raise ValueError(f"Effetti sconosciuti nel job: {', '.join(effects)}")
+
+    for k, v in spec.items():
+        if k not in RenderConfig.__dataclass_fields__:
+            raise ValueError(f"Chiave sconosciuta nel job: {k}")
+        if k in ("weights", "quotas", "source_weights"):
+            v = _int_keys(v)
+        elif k in ("output_dir",):
+            v = _path(v)
+        setattr(config, k, v)
+    if config.app_mode == "VJ Mode" and config.stripes and not MODULATION_LAB_AVAILABLE:
+        raise ValueError("Bande selettive richieste ma Modulation Lab non disponibile.")
+    return config
+
+
+def load_job(path):
+    """Legge un job JSON o YAML (PyYAML opzionale, importato solo qui) e
+    restituisce il RenderConfig corrispondente."""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if path.lower().endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError("Per i job YAML serve PyYAML (pip install pyyaml).")
+        spec = yaml.safe_load(text)
+    else:
+        spec = json.loads(text)
+    config = config_from_spec(spec or {}, base_dir=os.path.dirname(os.path.abspath(path)))
+    if config.name is None:
+        config.name = os.path.splitext(os.path.basename(path))[0]
+    return config
+
+
+def _analysis_cache_key(config):
+    """Chiave dell'analisi audio in analysis_cache: stesso brano (nome
+    originale + dimensione), stessa durata, stessa modalita' veloce."""
+    if not config.audio:
+        return None
+    return (config.audio_name or config.audio, os.path.getsize(config.audio),
+            round(config.duration, 2), config.fast_audio_analysis)
+
+
+def render(config, progress=None, analysis_cache=None, live=None, serve=False):
+    """Esegue un render completo (la pipeline di 'AVVIA RENDERING') e
+    restituisce un RenderResult. progress: oggetto con .progress(valore,
+    text=...) come st.progress, avvolto in un ProgressReporter (al massimo
+    10 aggiornamenti al secondo), o un ProgressReporter gia' pronto
+    (default: nessun output). analysis_cache:
+    mapping in cui tenere l'analisi audio tra un render e l'altro (la UI
+    passa st.session_state; None = nessuna cache). live: LiveOutput per
+    suonare il risultato in tempo reale (play_live) invece di scriverlo su
+    file; niente anteprima, video_path None, statistiche nel log di
+    profilazione. serve=True: si ferma al clip finale e restituisce un
+    FrameServer (sorgenti aperte) invece di un RenderResult — niente
+    audio, niente file; vedi frame_server.
+
+    Gli avvisi non bloccanti (sorgente striscia illeggibile...) finiscono
+    in RenderResult.warnings invece che in st.warning; gli errori veri
+    vengono propagati al chiamante."""
+    cfg = config
+    if isinstance(progress, ProgressReporter):
+        reporter = progress
+    else:
+        reporter = ProgressReporter(progress) if progress is not None else _NullProgress()
+    cache = analysis_cache if analysis_cache is not None else {}
+    paths = dict(cfg.sources)
+    if not paths:
+        raise ValueError("Carica almeno un video!")
+
+    run_durata = cfg.duration
+    fps = cfg.fps
+    export_size_run = cfg.export_size
+    app_mode = cfg.app_mode
+    stripes = cfg.stripes if (app_mode == "VJ Mode" and MODULATION_LAB_AVAILABLE) else []
+    # Pesi/quote mancanti (job che non li specificano): stessi default
+    # degli slider della UI — V1 da 100% a 0%, le altre da 0% a 100%;
+    # quote divise in parti uguali.
+    weights = {k: cfg.weights.get(k, (100, 0) if k == 0 else (0, 100)) for k in paths}
+    quotas = {k: cfg.quotas.get(k, round(100 / len(paths))) for k in paths}
+    warnings = []
+
+    out_dir = cfg.output_dir or tempfile.gettempdir()
+    os.makedirs(out_dir, exist_ok=True)
+    if cfg.name:
+        out_v = os.path.join(out_dir, f"{cfg.name}.mp4")
+        prev_v = os.path.join(out_dir, f"{cfg.name}_preview.mp4")
+    else:
+        out_v = os.path.join(out_dir, f"render_{random.randint(0,9999)}.mp4")
+        prev_v = os.path.join(out_dir, f"preview_{random.randint(0,9999)}.mp4")
+    # Seed DOPO aver scelto i nomi file: con lo stesso seed due render di
+    # fila non devono sovrascriversi a vicenda nella cartella temporanea.
+    if cfg.seed is not None:
+        random.seed(cfg.seed)
+        np.random.seed(cfg.seed % (2 ** 32))
+
+    beat_times      = None
+    rms_envelope    = None
+    decompose_band_envelope = None
+    vj_rms_envelope = None
+    vj_band_envelope = None
+    vj_onset_times  = None
+    beat_count    = 0
+    engine        = None
+    stripe_clips  = []   # sorgenti dedicate delle strisce, chiuse nel finally
+    total_frags   = 0
+    cut_schedule  = None
+    wav_path      = None
+    color_cmd_path = None
+    _prof = {}  # profilazione render: {stage: secondi}
+    _t_stage = time.perf_counter()
+
+    try:
+        # Analisi audio: Decompose beat sync OPPURE VJ Mode beat slice.
+        # Sempre calcolata sulla durata PIENA e tenuta in cache: se si
+        # rigenera il render cambiando solo un parametro (stutter,
+        # subdivisione...) non si rifa' da capo beat-tracking/HPSS,
+        # che e' il pezzo piu' lento.
+        _audio_cache_key = _analysis_cache_key(cfg)
+
+        if app_mode == "Decompose" and (cfg.beat_sync or cfg.color_react_amount > 0 or cfg.saturation_react_amount > 0) and cfg.audio:
+            if cache.get("_audio_cache_key") == _audio_cache_key:
+                beat_times, rms_envelope, decompose_band_envelope = cache["_audio_cache"]
+            else:
+                reporter.update(0.05, text="Analisi audio...", force=True)
+                beat_times, rms_envelope, decompose_band_envelope, _ = analyze_audio(cfg.audio, run_durata, fast_mode=cfg.fast_audio_analysis)
+                cache["_audio_cache_key"] = _audio_cache_key
+                cache["_audio_cache"] = (beat_times, rms_envelope, decompose_band_envelope)
+            beat_count = len(beat_times)
+        elif app_mode == "VJ Mode" and (cfg.beat_slice_mode or cfg.freeze_on_beat or cfg.color_react_amount > 0 or cfg.saturation_react_amount > 0 or cfg.mod_lab_on or stripes) and cfg.audio:
+            if cache.get("_vj_audio_cache_key") == _audio_cache_key:
+                beat_times, vj_rms_envelope, vj_band_envelope, vj_onset_times = cache["_vj_audio_cache"]
+            else:
+                reporter.update(0.05, text="Analisi beat...", force=True)
+                beat_times, vj_rms_envelope, vj_band_envelope, vj_onset_times = analyze_audio(cfg.audio, run_durata, fast_mode=cfg.fast_audio_analysis)
+                cache["_vj_audio_cache_key"] = _audio_cache_key
+                cache["_vj_audio_cache"] = (beat_times, vj_rms_envelope, vj_band_envelope, vj_onset_times)
+            beat_count = len(beat_times)
+
+        _prof["Analisi Audio"] = time.perf_counter() - _t_stage
+        _t_stage = time.perf_counter()
+
+        engine = VideoEngine()
+        engine.seek_aware = cfg.seek_aware
+        engine.effect_threads = cfg.effect_threads
+        engine.load_sources(paths, target_size=export_size_run)
+
+        _prof["Caricamento Sorgenti"] = time.perf_counter() - _t_stage
+        _t_stage = time.perf_counter()
+
+        if app_mode == "Decompose":
+            # generate()/generate_fixed_quota() non hanno un flag
+            # 'beat_sync' interno: se beat_times/rms_envelope non
+            # sono vuoti, i tagli e le strisce si sincronizzano
+            # all'audio a prescindere. Da quando l'analisi audio
+            # puo' partire anche solo per colore/saturazione (senza
+            # beat_sync attivo), vanno passati None esplicitamente
+            # se l'utente NON ha richiesto il beat sync — altrimenti
+            # taglio E strisce si riattiverebbero da soli in
+            # silenzio insieme al colore.
+            _beat_times_for_cuts = beat_times if cfg.beat_sync else None
+            _rms_for_stripes = rms_envelope if cfg.beat_sync else None
+            if cfg.mix_mode == "Quote Fisse":
+                final, cut_schedule = engine.generate_fixed_quota(
+                    quotas, cfg.r_a, cfg.r_b, cfg.r_rand, run_durata, fps,
+                    cfg.s_a, cfg.s_b, cfg.s_rand, cfg.scan_dir, reporter, cfg.use_scan,
+                    beat_times=_beat_times_for_cuts, rms_envelope=_rms_for_stripes,
+                    export_size=export_size_run
+                )
+            else:
+                final, cut_schedule = engine.generate(
+                    weights, cfg.r_a, cfg.r_b, cfg.r_rand, run_durata, fps,
+                    cfg.s_a, cfg.s_b, cfg.s_rand, cfg.scan_dir, reporter, cfg.use_scan,
+                    beat_times=_beat_times_for_cuts, rms_envelope=_rms_for_stripes,
+                    export_size=export_size_run
+                )
+            total_frags = engine.stats["fragments"]
+            mode_label = "Decompose"
+            _frags = engine.fragments
+            _starts = np.concatenate([[0.0], np.cumsum([f.duration for f in _frags])[:-1]])
+            _montage = engine.timeline
+            _frame_key = None
+
+            # --- Bande Temporali (Temporal Band Slicer) ---
+            # Applicata SUBITO dopo la composizione del clip, prima di
+            # qualsiasi altro post-processing (strisce/colore): meno
+            # step incatenati sul .fl() precedente = minor rischio di
+            # crash/instabilita' in fase di render.
+            if cfg.temporal_bands_on:
+                final = final.fl(lambda gf, t: apply_temporal_bands_clip(
+                    gf, t, cfg.tb_intensity, cfg.tb_ampiezza, cfg.tb_spostamento, cfg.tb_direzione,
+                    threads=cfg.effect_threads))
+
+            if cfg.mix_mode == "Quote Fisse":
+                mix_log = "Quote Fisse — " + " / ".join(
+                    f"V{k+1}:{quotas.get(k,0)}%" for k in paths.keys())
+            else:
+                mix_log = "Random (pesi Start%/End%)"
+            extra_log = (f"* Ritmo: {cfg.r_a}s >> {cfg.r_b}s (Random: {cfg.r_rand})\n"
+                         f"* Strisce: {cfg.s_a}px >> {cfg.s_b}px (Random: {cfg.s_rand})\n"
+                         f"* Geometria: {cfg.scan_dir}\n"
+                         f"* Formato: {cfg.formato_label}")
+            if cfg.temporal_bands_on:
+                extra_log += (
+                    f"\n* Bande Temporali: intensita' {int(cfg.tb_intensity*100)}% "
+                    f"/ ampiezza {int(cfg.tb_ampiezza*100)}% / spostamento {int(cfg.tb_spostamento*100)}% "
+                    f"/ direzione {int(cfg.tb_direzione*100)}%"
+                )
+        else:
+            # generate_dj_remix usa beat_times SOLO se
+            # beat_slice_mode=True (corretto, gia' un parametro
+            # esplicito) — ma la modulazione di slice_density e il
+            # burst-override di react_to_peaks reagiscono alla sola
+            # PRESENZA di rms/band_envelope, non a un flag dedicato.
+            # Da quando l'analisi puo' partire anche solo per
+            # colore/saturazione, vanno passati None se l'utente non
+            # ha acceso beat_slice_mode ne' freeze_on_beat — sennò
+            # accendere il colore farebbe scattare in silenzio anche
+            # densita' di taglio reattiva e burst override.
+            _vj_rms_for_engine = vj_rms_envelope if (cfg.beat_slice_mode or cfg.freeze_on_beat) else None
+            _vj_band_for_engine = vj_band_envelope if (cfg.beat_slice_mode or cfg.freeze_on_beat) else None
+            # MODULATION LAB: costruita solo se il toggle e' attivo E
+            # ci sono onset disponibili. In ogni altro caso e' None,
+            # quindi generate_dj_remix si comporta esattamente come
+            # prima dell'introduzione di questa funzionalita'.
+            _mod_matrix = None
+            if cfg.mod_lab_on and vj_onset_times:
+                _mod_matrix = build_start_offset_matrix(
+                    vj_onset_times, run_durata, amount=cfg.mod_matrix_amount
+                )
+
+            final, total_frags, cut_schedule = generate_dj_remix(
+                engine.video_clips, run_durata, fps,
+                cfg.slice_dur, cfg.loop_reps, cfg.stutter_prob, cfg.pitch_glitch, reporter,
+                beat_slice_mode=cfg.beat_slice_mode,
+                beat_times=beat_times,
+                rms_envelope=_vj_rms_for_engine,
+                band_envelope=_vj_band_for_engine,
+                crossfade_dur=cfg.crossfade_dur,
+                freeze_on_beat=cfg.freeze_on_beat,
+                freeze_prob=cfg.freeze_prob,
+                freeze_dur=cfg.freeze_dur,
+                source_mode=cfg.source_mode,
+                source_weights=cfg.source_weights,
+                no_repeat=cfg.no_repeat,
+                slice_density=cfg.slice_density,
+                beat_subdivision_mode=cfg.beat_subdivision_mode,
+                beat_subdivision_factor=cfg.beat_subdivision_factor,
+                beat_subdivision_choices=cfg.beat_subdivision_choices,
+                manual_duration_mode=cfg.manual_duration_mode,
+                manual_duration_choices=cfg.manual_duration_choices,
+                export_size=export_size_run,
+                react_to_peaks=cfg.react_to_peaks,
+                cut_source=cfg.cut_source,
+                onset_times=vj_onset_times,
+                subdivision_coarsen=cfg.subdivision_coarsen,
+                mod_matrix=_mod_matrix,
+                mod_matrix_fps=fps,
+                seek_aware=cfg.seek_aware,
+            )
+            mode_label = "VJ Mode"
+            _frags, _starts = final.fragments, final.starts
+            _montage = final
+            # Chiave dei frame statici per write_video, composta effetto
+            # per effetto come 'final'. None = nessun riuso: le bande
+            # temporali estraggono numeri casuali a ogni frame, saltarne
+            # uno cambierebbe anche tutti i frame successivi.
+            _frame_key = final.frame_key
+
+            # --- Bande Temporali (Temporal Band Slicer) ---
+            # Applicata SUBITO dopo la composizione del clip, prima
+            # delle strisce selettive (Modulation Lab): meno step
+            # incatenati sul .fl() precedente = minor rischio di
+            # crash/instabilita' in fase di render.
+            if cfg.temporal_bands_on:
+                final = final.fl(lambda gf, t: apply_temporal_bands_clip(
+                    gf, t, cfg.tb_intensity, cfg.tb_ampiezza, cfg.tb_spostamento, cfg.tb_direzione,
+                    threads=cfg.effect_threads))
+                _frame_key = None
+
+            if cfg.beat_slice_mode and beat_times:
+                _subdiv_lbl = next((m for m, v in MEASURE_FACTORS.items() if abs(v - cfg.beat_subdivision_factor) < 1e-9), "1/1")
+                _subdiv_str = {"fixed": _subdiv_lbl, "tempo_adaptive": "adattiva al tempo", "random_total": "random totale", "random_subset": "random in range"}.get(cfg.beat_subdivision_mode, _subdiv_lbl)
+                slice_info = f"beat-driven ({beat_count} beat, subdiv {_subdiv_str})"
+            else:
+                slice_info = f"{cfg.slice_dur}s fisso"
+            mix_log = (f"VJ Mode — slice {slice_info} / "
+                       f"loop x{cfg.loop_reps} / stutter {int(cfg.stutter_prob*100)}%")
+            src_alt_log = ("Pesata — " + " / ".join(
+                f"V{k+1}:{cfg.source_weights.get(k,0)}%" for k in cfg.source_weights)
+                if cfg.source_mode == "pesata" else "Casuale")
+            extra_log = (f"* Slice Mode: {slice_info}\n"
+                         f"* Loop Reps: {cfg.loop_reps}\n"
+                         f"* Stutter Prob: {int(cfg.stutter_prob*100)}%\n"
+                         f"* Pitch Glitch: {cfg.pitch_glitch}\n"
+                         f"* Alternanza Sorgenti: {src_alt_log}"
+                         f"{' (no ripetizioni consecutive)' if cfg.no_repeat else ''}\n"
+                         f"* Auto VJ: {cfg.auto_vj}" +
+                         (f" (preset {cfg.vj_genre})" if cfg.auto_vj and cfg.vj_genre else "") +
+                         (f" — subdivisione allargata x{cfg.subdivision_coarsen:.0f} (RAM safety)"
+                          if cfg.subdivision_coarsen > 1.0 else "") + "\n"
+                         f"* Crossfade: {int(cfg.crossfade_dur*1000)}ms\n"
+                         f"* Freeze on beat: {cfg.freeze_on_beat}" +
+                         (f" ({int(cfg.freeze_prob*100)}% / {int(cfg.freeze_dur*1000)}ms)"
+                          if cfg.freeze_on_beat else "") + "\n"
+                         f"* Audio Mix: {AUDIO_MIX_LABELS.get(cfg.audio_mix_mode, cfg.audio_mix_mode)}" +
+                         (f" (musica {int(cfg.vol_music*100)}% / originale {int(cfg.vol_original*100)}%)"
+                          if cfg.audio_mix_mode in ("mix", "mix_decomposed") else "") + "\n"
+                         f"* Reattivita' multi-banda: {'ON' if _vj_band_for_engine else 'OFF'}\n"
+                         f"* Formato: {cfg.formato_label}")
+            if cfg.temporal_bands_on:
+                extra_log += (
+                    f"\n* Bande Temporali: intensita' {int(cfg.tb_intensity*100)}% "
+                    f"/ ampiezza {int(cfg.tb_ampiezza*100)}% / spostamento {int(cfg.tb_spostamento*100)}% "
+                    f"/ direzione {int(cfg.tb_direzione*100)}%"
+                )
+
+            # MODULATION LAB: bande selettive, applicate in ordine.
+            # Ogni banda e' un post-processing sul clip gia' composto (non
+            # tocca generate_dj_remix) con la propria curva di opacita'
+            # sugli onset — None se senza onset -> solo opacita' di base.
+            # Sorgente: (1) uno degli stessi video gia' caricati (si riusa
+            # il path gia' su disco in 'paths'); (2) un video dedicato;
+            # (3) nessuno -> fallback (stesso video sfasato nel tempo,
+            # gestito dentro apply_selective_stripe quando
+            # stripe_source_get_frame e' None). Resize SEMPLICE (stretch),
+            # non crop: il contenuto della striscia non deve venire tagliato.
+            for _n, sc in enumerate(stripes, start=1):
+                _lbl = "Banda selettiva" if _n == 1 else f"Banda selettiva {_n}"
+                _opacity_curve = None
+                if vj_onset_times:
+                    _opacity_curve = build_stripe_opacity_curve(
+                        vj_onset_times, max(1, int(run_durata * fps)), fps,
+                        amount=sc.amount
+                    )
+
+                _src_clip = None
+                _src_get_frame = None
+                _src_duration = None
+                _src_path = paths.get(sc.source) if isinstance(sc.source, int) else sc.source
+                if _src_path is not None:
+                    try:
+                        # resize SEMPLICE (stretch), non crop-to-fill:
+                        # si vede l'intero fotogramma della sorgente, anche
+                        # se il rapporto d'aspetto e' diverso. Fatto dal
+                        # decoder (target_resolution con entrambi i lati).
+                        _target_wh = tuple(final.size)
+                        _src_clip = LazyVideoFileClip(_src_path, target_resolution=_target_wh[::-1])
+                        stripe_clips.append(_src_clip)
+                        _src_get_frame = _src_clip.get_frame
+                        _src_duration = _src_clip.duration
+                    except Exception as _e:
+                        # Non deve mai far crashare il render: se la
+                        # sorgente scelta non e' decodificabile, si
+                        # torna al fallback, avvisando l'utente.
+                        _src_get_frame = None
+                        _src_duration = None
+                        warnings.append(
+                            f"⚠️ Sorgente striscia non leggibile ({_e}): uso il fallback "
+                            f"(sfasamento {sc.offset_s}s dello stesso video)."
+                        )
+
+                if not (sc.base_opacity > 0 or _opacity_curve is not None):
+                    continue
+                final = final.fl(lambda gf, t, sc=sc, _c=_opacity_curve, _g=_src_get_frame, _d=_src_duration:
+                                 apply_selective_stripe(
+                    gf, t, run_durata, fps, _c,
+                    stripe_pct=sc.pct, stripe_pos_pct=sc.pos,
+                    orientation=sc.orient, time_offset=sc.offset_s,
+                    stripe_source_get_frame=_g,
+                    stripe_source_duration=_d,
+                    base_opacity=sc.base_opacity,
+                    stripe_length_pct=sc.length_pct,
+                    stripe_length_pos_pct=sc.length_pos_pct,
+                    content_follows_band=sc.content_follows,
+                    content_anchor_pos_pct=sc.content_anchor_pos,
+                    content_anchor_length_pos_pct=sc.content_anchor_length_pos,
+                    frozen_content=sc.frozen_content,
+                    jit=cfg.jit_kernels, threads=cfg.effect_threads
+                ))
+                if _frame_key is not None:
+                    _frame_key = (lambda t, below=_frame_key, sc=sc, _c=_opacity_curve,
+                                  _s=_src_clip if _src_get_frame is not None and _src_duration else None:
+                                  selective_stripe_key(
+                        below, t, run_durata, fps, _c, time_offset=sc.offset_s,
+                        stripe_source=_s, base_opacity=sc.base_opacity,
+                        frozen_content=sc.frozen_content))
+                extra_log += (
+                    f"\n* {_lbl}: base {int(sc.base_opacity*100)}% "
+                    f"+ picco {int(sc.amount*100)}% su onset"
+                    + (" (video dedicato caricato)" if _src_get_frame is not None
+                       else f" (sfasamento {sc.offset_s}s stesso video)")
+                    + (f" — contenuto ancorato a {int(sc.content_anchor_pos)}%/"
+                       f"{int(sc.content_anchor_length_pos)}%" if sc.content_follows else "")
+                    + (" — immagine catturata fissa" if sc.frozen_content is not None else "")
+                )
+
+        _prof["Costruzione Sequenza"] = time.perf_counter() - _t_stage
+
+        # --- Colore reattivo al beat (bassi/medi/alti -> RGB) ---
+        # Applicato sul clip video gia' composto, prima del mix
+        # audio: e' un post-processing indipendente dalla logica di
+        # taglio, quindi non serve toccare generate_dj_remix/engine.
+        # (i secondi REALI spesi qui dentro vengono misurati durante
+        # write_videofile, non ora: il clip e' lazy, il tint viene
+        # eseguito frame per frame solo quando si scrive il file)
+        _color_tint_acc = [0.0]
+        _sat_tint_acc = [0.0]
+        # Sono gli ultimi effetti della catena: con encoder_color (e i
+        # filtri disponibili) non avvolgono 'final' ma diventano il -vf
+        # dell'encoder (encoder_color_filter), applicato da ffmpeg sugli
+        # stessi istanti. Senza, resta il path numpy frame per frame.
+        _color_band_env = decompose_band_envelope if app_mode == "Decompose" else vj_band_envelope
+        _enc_tint_at = _enc_factor_at = None
+        _encoder_color = (cfg.encoder_color and not serve and bool(_color_band_env)
+                          and (cfg.color_react_amount > 0 or cfg.saturation_react_amount > 0)
+                          and ffmpeg_has_filters(ENCODER_COLOR_FILTERS))
+        _enc_label = " (filtro ffmpeg nell'encoder)" if _encoder_color else ""
+        if cfg.color_react_amount > 0 and _color_band_env:
+            if _encoder_color:
+                _enc_tint_at = beat_color_tint(_color_band_env, run_durata, cfg.color_react_amount)
+            else:
+                final = apply_beat_color_react(final, _color_band_env, run_durata, cfg.color_react_amount, profile_acc=_color_tint_acc,
+                                               threads=cfg.effect_threads)
+                if _frame_key is not None:
+                    _frame_key = chain_frame_key(
+                        _frame_key, beat_color_tint(_color_band_env, run_durata, cfg.color_react_amount))
+            extra_log += f"\n* Colore reattivo al beat: {int(cfg.color_react_amount*100)}%{_enc_label}"
+        if cfg.saturation_react_amount > 0 and _color_band_env:
+            if _encoder_color:
+                _enc_factor_at = beat_saturation_factor(_color_band_env, run_durata, cfg.saturation_react_amount)
+            else:
+                final = apply_beat_saturation_react(final, _color_band_env, run_durata, cfg.saturation_react_amount, profile_acc=_sat_tint_acc,
+                                                    threads=cfg.effect_threads)
+                if _frame_key is not None:
+                    _frame_key = chain_frame_key(
+                        _frame_key, beat_saturation_factor(_color_band_env, run_durata, cfg.saturation_react_amount))
+            extra_log += f"\n* Saturazione reattiva al beat: {int(cfg.saturation_react_amount*100)}%{_enc_label}"
+
+        if serve:
+            # Le sorgenti passano al FrameServer: il finally non le chiude.
+            server = FrameServer(final, engine, frame_key=_frame_key, log=extra_log,
+                                 clips=stripe_clips)
+            engine = None
+            stripe_clips = []
+            return server
+
+        _t_stage = time.perf_counter()
+
+        # Audio: originale, brano, decomposto o mix — un buffer numpy
+        # costruito qui in una volta sola (vedi build_audio_track), scritto
+        # in WAV e codificato in AAC dallo stesso ffmpeg che scrive il video.
+        audio_track = build_audio_track(
+            cfg.audio_mix_mode if cfg.use_custom_audio else "original_only", run_durata,
+            fragments=_frags, starts=_starts, source_paths=paths,
+            music_path=cfg.audio if cfg.use_custom_audio else None,
+            cut_schedule=cut_schedule, vol_music=cfg.vol_music, vol_original=cfg.vol_original)
+        if audio_track is not None:
+            wav_path = tempfile.NamedTemporaryFile(delete=False, suffix=".wav").name
+            write_wav(wav_path, audio_track)
+            del audio_track
+
+        _prof["Mix Audio"] = time.perf_counter() - _t_stage
+        _t_stage = time.perf_counter()
+
+        # Piano delle letture: le letture delle sorgenti per gli stessi
+        # istanti che iter_frames chiedera' a 'final' (np.arange con lo
+        # stesso passo), ricavate dal montaggio prima degli effetti.
+        # Decide quali sorgenti passano alla cache frame raw; le altre
+        # vanno al decode-ahead. Ogni tentativo di scrittura qui sotto ha
+        # il proprio FramePrefetcher: il piano riparte da capo.
+        _read_plan = {}
+        if cfg.prefetch_depth > 0 or cfg.frame_cache:
+            _read_plan = plan_source_reads(_montage, engine.video_clips,
+                                           np.arange(0, final.duration, 1.0 / final.fps))
+            _prof["Piano Letture"] = time.perf_counter() - _t_stage
+        _t_stage = time.perf_counter()
+        _frame_cache_log = ""
+        if cfg.frame_cache and _read_plan:
+            reporter.update(0.74, text="Cache frame...", force=True)
+            _cached = use_frame_cache(engine.video_clips, paths, _read_plan, fps)
+            for _k, (_nbytes, _built) in _cached.items():
+                _read_plan.pop(_k, None)
+                _frame_cache_log += (f"\n* Cache frame raw: V{_k + 1} "
+                                     f"({_nbytes / 1024 ** 2:.0f} MB, {'costruita' if _built else 'riusata'})")
+            if _cached:
+                _prof["Cache Frame Raw"] = time.perf_counter() - _t_stage
+        _t_stage = time.perf_counter()
+        _prefetch = None
+
+        reporter.update(0.75, text="Scrittura video...", force=True)
+        # audio=<file>: il writer aggiunge "-i wav -acodec copy" (come
+        # MoviePy); il "-c:a aac" in ffmpeg_params arriva DOPO sulla riga
+        # di comando e vince, quindi il WAV viene codificato nello stesso
+        # passaggio del video.
+        _video_params = []
+        if _enc_tint_at is not None or _enc_factor_at is not None:
+            color_cmd_path = tempfile.NamedTemporaryFile(delete=False, suffix=".cmd").name
+            _video_params = ["-vf", encoder_color_filter(_enc_tint_at, _enc_factor_at, final.fps,
+                                                         final.duration, color_cmd_path)]
+        _audio_args = (dict(audio=wav_path, ffmpeg_params=["-c:a", "aac"] + _video_params) if wav_path
+                       else dict(audio=None, ffmpeg_params=_video_params))
+        _enc_hi = 0.90 if cfg.make_preview else 0.99
+        _static_frames = 0
+        _live_log = ""
+        if live is not None:
+            # Decode-ahead dimensionato sul margine di latenza, in modo
+            # lossy (i frame saltati si scartano dalla coda), e pre-roll
+            # prima di far partire l'orologio.
+            reporter.update(0.75, text="Live...", force=True)
+            with FramePrefetcher(engine.video_clips, _read_plan,
+                                 live_prefetch_depth(live.latency_s, final.fps), lossy=True) as _prefetch:
+                _prefetch.preroll(live.latency_s)
+                with live_writer(live, final.size, final.fps, audio=wav_path,
+                                 video_params=_video_params) as _writer:
+                    _live = play_live(final, _writer, final.fps, frame_key=_frame_key,
+                                      log=live.log, stats_every=live.stats_every)
+            _static_frames = _live.reused
+            _live_log = (f"\n* Live ({live.sink}): {_live.achieved_fps():.1f}/{final.fps:g} fps, "
+                         f"{_live.dropped} frame saltati, p95 {_live.p95_ms():.1f} ms per frame "
+                         f"(calcolo {_live.compute_p95_ms():.1f} ms)")
+            out_v = None
+        else:
+            try:
+                with FramePrefetcher(engine.video_clips, _read_plan, cfg.prefetch_depth) as _prefetch:
+                    _static_frames = write_video(final, out_v, codec="libx264", preset="ultrafast",
+                                                 logger=reporter.encode_logger(0.75, _enc_hi, "Scrittura video"),
+                                                 frame_key=_frame_key, **_audio_args)
+            except Exception as _enc_err:
+                # Stesso bug noto dell'encoder AAC nativo di FFmpeg
+                # visto sulla preview ("Assertion diff >= 0 && diff <=
+                # 120 failed at aacenc.c") puo' in teoria capitare anche
+                # qui. Qui pero' l'audio e' DAVVERO nuovo (mixato da piu'
+                # sorgenti a volumi diversi), quindi non si puo' semplice-
+                # mente copiare come nella preview — si ritenta pero' con
+                # un bitrate audio fisso esplicito, che nella pratica fa
+                # spesso evitare l'assertion (percorso interno diverso
+                # nell'encoder rispetto al bitrate variabile di default).
+                if wav_path and ("aacenc" in str(_enc_err) or "Broken pipe" in str(_enc_err)):
+                    with FramePrefetcher(engine.video_clips, _read_plan, cfg.prefetch_depth) as _prefetch:
+                        _static_frames = write_video(final, out_v, codec="libx264", preset="ultrafast",
+                                                     logger=reporter.encode_logger(0.75, _enc_hi, "Scrittura video"),
+                                                     frame_key=_frame_key, audio=wav_path,
+                                                     ffmpeg_params=["-c:a", "aac", "-b:a", "192k"] + _video_params)
+                else:
+                    raise
+            reporter.flush()   # ultimo "(n/n frame)" trattenuto dal limite di frequenza
+        final.close()
+
+        # Il write_video qui sopra e' dove TUTTO il lavoro lazy
+        # dei clip viene davvero eseguito (decodifica sorgenti,
+        # crossfade, e anche il tint colore frame per frame): il
+        # tempo misurato include quindi decode+encode+tint insieme.
+        # _color_tint_acc[0] isola quanto di quel totale e' SOLO
+        # l'aritmetica del tint (esclusa la decodifica), per capire
+        # quanto pesa davvero sul totale invece di supporlo.
+        # (misurato PRIMA della sleep() di sicurezza qui sotto, che
+        # e' un'attesa fissa per il flush su disco e non lavoro vero)
+        _t_encode_final = time.perf_counter() - _t_stage
+        _prof["Live (decode+effetti+invio)" if live is not None else "Encoding Finale (decode+encode)"] = (
+            _t_encode_final - _color_tint_acc[0] - _sat_tint_acc[0])
+        if _color_tint_acc[0] > 0:
+            _prof["  di cui Tint Colore"] = _color_tint_acc[0]
+        if _sat_tint_acc[0] > 0:
+            _prof["  di cui Boost Saturazione"] = _sat_tint_acc[0]
+        # Coda del decode-ahead: riempimento medio vicino alla profondita'
+        # = il decoder sta avanti (il collo di bottiglia e' effetti +
+        # encoder); vicino a 0 con molta attesa = il decoder non tiene il
+        # passo e l'encoder lo aspetta.
+        _prefetch_log = ""
+        if _prefetch is not None and _prefetch.streams:
+            _pf = _prefetch.stats()
+            _prof["  di cui attesa decoder (coda vuota)"] = _pf["stall_s"]
+            _pf_reads = _pf["hits"] + _pf["misses"]
+            _prefetch_log = (
+                f"\n* Decode-ahead: coda {_pf['depth']} frame/sorgente, riempimento medio "
+                f"{_pf['mean_fill']:.1f}, {_pf['hits']}/{_pf_reads} letture dalla coda"
+                + (f", {_pf['skipped']} scartate (frame live saltati)" if _pf["skipped"] else ""))
+            for _e in _pf["errors"]:
+                warnings.append(f"⚠️ Decode-ahead interrotto ({_e}): letture proseguite senza coda.")
+        if _static_frames:
+            _prefetch_log += f"\n* Frame statici riusati (freeze / frame sorgente ripetuti): {_static_frames}"
+        _prefetch_log += _live_log
+        if out_v is not None:
+            time.sleep(1.5)
+        _t_stage = time.perf_counter()
+
+        # --- Anteprima 480p ---
+        # NON si riparte da 'final' (l'intera catena di frammenti,
+        # crossfade e composizione andrebbe rieseguita una seconda
+        # volta: su un brano corto e' invisibile, su 3-4 minuti con
+        # centinaia/migliaia di frammenti raddoppia memoria di picco
+        # e tempo, proprio il tipo di carico che fa andare in OOM un
+        # host con RAM limitata come il piano gratuito di Streamlit
+        # Cloud). Si riapre invece il file GIA' scritto su disco: e'
+        # un singolo stream h264 semplice, molto piu' leggero da
+        # ridecodificare che l'intero grafo di clip.
+        if cfg.make_preview and out_v is not None:
+            reporter.update(0.90, text="Generando preview...", force=True)
+            prev_src = VideoFileClip(out_v, audio=False)
+            from moviepy.video.fx.resize import resize
+            prev_clip = resize(prev_src, height=480)
+            # L'audio qui NON cambia affatto (solo il video viene
+            # ridimensionato) — quindi si copia lo stream audio gia'
+            # codificato invece di ri-codificarlo da capo. Oltre a
+            # essere piu' veloce, evita un bug noto dell'encoder AAC
+            # nativo di FFmpeg ("Assertion diff >= 0 && diff <= 120
+            # failed at aacenc.c") che puo' scattare proprio quando si
+            # ri-codifica audio gia' passato una volta per un encoder
+            # AAC. Lo stream viene preso direttamente dal render finale
+            # (audio=out_v, "-acodec copy"): con write_videofile MoviePy
+            # riscriveva comunque l'audio in un file temporaneo AAC
+            # prima di copiarlo, quindi un passaggio di encoder c'era.
+            try:
+                write_video(prev_clip, prev_v, codec="libx264", preset="ultrafast", audio=out_v,
+                            logger=reporter.encode_logger(0.90, 0.99, "Generando preview"))
+            except Exception:
+                # Fallback raro: se lo stream copy fallisce per qualche
+                # incompatibilita' di formato, si torna alla ri-codifica
+                # normale (il bug aacenc non si presenta sempre).
+                write_video(prev_clip, prev_v, codec="libx264", preset="ultrafast", audio=out_v,
+                            ffmpeg_params=["-c:a", "aac"],
+                            logger=reporter.encode_logger(0.90, 0.99, "Generando preview"))
+            reporter.flush()
+            prev_clip.close()
+            prev_src.close()
+            _prof["Encoding Preview"] = time.perf_counter() - _t_stage
+            time.sleep(0.5)
+        else:
+            prev_v = None
+        reporter.update(1.0, text="Pronto!", force=True)
+
+        # Nome condiviso video + report (stesso codice)
+        render_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+        mode_short = "VJ" if app_mode == "VJ Mode" else "DC"
+        render_name = f"loop507_{mode_short}_{render_id}"
+
+        _prof_total = sum(v for k, v in _prof.items() if not k.startswith("  "))
+        _prof_lines = "\n".join(
+            f"* {k}: {v:.1f}s ({v / _prof_total * 100:.0f}%)" if _prof_total > 0 else f"* {k}: {v:.1f}s"
+            for k, v in _prof.items()
+        )
+        profiling_log = (
+            f":: PROFILAZIONE RENDER (totale {_prof_total:.1f}s):\n{_prof_lines}{_frame_cache_log}{_prefetch_log}"
+        )
+
+        _bpm_line = ""
+        if cfg.bpm:
+            _bpm_line = f"* BPM: {cfg.bpm:.1f}" + (" (manuale)" if cfg.bpm_manual else " (rilevato)")
+
+        _log_lines = [
+            f"* Sorgenti Video: {engine.stats['sources']}",
+            f"* Frammenti Generati: {total_frags}",
+            f"* Modalita': {mix_log}",
+        ]
+        if _bpm_line:
+            _log_lines.append(_bpm_line)
+        if extra_log:
+            _log_lines.append(extra_log)
+        if cfg.beat_sync and cfg.audio:
+            _log_lines.append(f"* Beat Sync: ON — {beat_count} beat rilevati")
+        if app_mode == "VJ Mode" and cfg.beat_slice_mode and beat_times:
+            _n_slice = len(vj_onset_times) if cfg.cut_source == "onset" and vj_onset_times else beat_count
+            _slice_label = "onset rilevati" if cfg.cut_source == "onset" else "beat rilevati"
+            _log_lines.append(f"* Slice Automatico: ON — {_n_slice} {_slice_label}")
+        _log_block = "\n".join(_log_lines)
+
+        report_it = f"""[DECOMP_ARCHIVE] // VOL_01 // H.264 // AAC
+:: FILE: {render_name}
+:: STILE: Minimalismo Computazionale / Glitch Brutalista
+:: MOTORE: video_decomposed [05.03]
+:: AUDIO: 48 kHz / Float a 32 bit / Punto di Clipping
+:: PROCESSO: {mode_label}
+
+:: TECHNICAL LOG SHEET:
+{_log_block}
+
+{profiling_log}
+
+"Non e' montaggio. E' anatomia di un segnale corrotto."
+
+:: Regia e Algoritmo: Loop507
+
+#loop507 #datanoise #decomposition #glitchart #audiovisual #noisemusic #algorithmicvideo #brutalist #sounddesign #computationalminimalism #signalcorruption #recursivecollapse #newmediaart"""
+
+        report_en = translate_report_to_en(report_it)
+
+        return RenderResult(
+            video_path=out_v,
+            preview_path=prev_v,
+            render_name=render_name,
+            report=report_it + "\n\n" + ("=" * 40) + "\n\n" + report_en + "\n",
+            profiling=_prof,
+            profiling_log=profiling_log,
+            fragments=total_frags,
+            cut_schedule=cut_schedule,
+            warnings=warnings,
+        )
+
+    finally:
+        if engine is not None:
+            engine.close_sources()
+        for _c in stripe_clips:
+            _c.close()
+        for _tmp in (wav_path, color_cmd_path):
+            if _tmp:
+                try:
+                    os.remove(_tmp)
+                except OSError:
+                    pass
+
+
+def _render_job(job_path, out_dir=None):
+    """Un job della CLI (anche dentro un processo del pool): mai eccezioni
+    verso il chiamante, l'errore finisce nel riepilogo JSON."""
+    t0 = time.perf_counter()
+    try:
+        config = load_job(job_path)
+        if out_dir is not None:
+            config.output_dir = out_dir
+        result = render(config)
+    except Exception as e:
+        return {"job": job_path, "ok": False, "error": f"{type(e).__name__}: {e}"}
+    return {
+        "job": job_path,
+        "ok": True,
+        "video": result.video_path,
+        "preview": result.preview_path,
+        "render_name": result.render_name,
+        "fragments": result.fragments,
+        "profiling": {k.strip(): round(v, 3) for k, v in result.profiling.items()},
+        "wall_s": round(time.perf_counter() - t0, 3),
+        "warnings": result.warnings,
+    }
+
+
+# ---------------------------------------------------------------------------
+# ARCHIVIO UPLOAD
+# Ogni file caricato (video, brano, video delle strisce) viene scritto su
+# disco UNA volta, a blocchi, con nome = hash del contenuto: lo stesso
+# file caricato in due sessioni (o di nuovo dopo un rerun) e' lo stesso
+# path, e tutti i consumatori (motore, anteprime, strisce, mix audio)
+# leggono quel path invece di scrivere ognuno la propria copia. Niente
+# viene cancellato a render finito: i file escono per eta' o quando
+# l'archivio supera la dimensione massima, insieme ai render_*/preview_*
+# vecchi nella cartella temporanea.
+# ---------------------------------------------------------------------------
+UPLOAD_STORE_DIR = os.environ.get(
+    "LOOP507_UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "loop507_uploads"))
+UPLOAD_STORE_MAX_BYTES = int(float(os.environ.get("LOOP507_UPLOAD_MAX_GB", "4")) * 1024 ** 3)
+UPLOAD_STORE_MAX_AGE_S = 6 * 3600      # upload non piu' usati da 6 ore
+OUTPUT_MAX_AGE_S = 24 * 3600           # render_*.mp4 / preview_*.mp4
+UPLOAD_EVICT_INTERVAL_S = 60.0         # pulizia al massimo una volta al minuto
+_UPLOAD_CHUNK = 1024 * 1024
+
+
+class UploadStore:
+    """Archivio content-addressed degli upload. put() accetta un
+    UploadedFile di Streamlit (o qualsiasi file-like con read/seek) e
+    ritorna il path stabile del contenuto. Condiviso tra sessioni e
+    thread (st.cache_resource): la scrittura va su un .part univoco e
+    poi os.replace, quindi due put concorrenti dello stesso file non
+    si pestano i piedi.
+
+    in_use: callable che ritorna i path da non rimuovere mai (quelli dei
+    job in coda o in corso, vedi RenderQueue.active_paths)."""
+
+    def __init__(self, root=UPLOAD_STORE_DIR, max_bytes=UPLOAD_STORE_MAX_BYTES,
+                 max_age_s=UPLOAD_STORE_MAX_AGE_S, in_use=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.in_use = in_use
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._by_id = {}        # (file_id, size) -> path: niente re-hash a ogni rerun
+        self._last_evict = 0.0
+
+    def put(self, uploaded_file):
+        name = getattr(uploaded_file, "name", "") or ""
+        suffix = os.path.splitext(name)[1].lower()
+        memo_key = (getattr(uploaded_file, "file_id", None), getattr(uploaded_file, "size", None))
+        if memo_key[0] is not None:
+            with self._lock:
+                path = self._by_id.get(memo_key)
+            if path and os.path.exists(path):
+                self._touch(path)
+                return path
+
+        h = hashlib.sha256()
+        part = os.path.join(self.root, f".{uuid.uuid4().hex}.part")
+        uploaded_file.seek(0)
+        try:
+            with open(part, "wb") as out:
+                while True:
+                    chunk = uploaded_file.read(_UPLOAD_CHUNK)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    out.write(chunk)
+            path = os.path.join(self.root, h.hexdigest()[:32] + suffix)
+            if os.path.exists(path):
+                os.remove(part)
+                self._touch(path)
+            else:
+                os.replace(part, path)
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        finally:
+            uploaded_file.seek(0)
+
+        if memo_key[0] is not None:
+            with self._lock:
+                self._by_id[memo_key] = path
+        self.maybe_evict()
+        return path
+
+    @staticmethod
+    def _touch(path):
+        # mtime = ultimo uso: e' l'eta' che conta per l'eviction.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def maybe_evict(self):
+        now = time.time()
+        if now - self._last_evict < UPLOAD_EVICT_INTERVAL_S:
+            return
+        self._last_evict = now
+        try:
+            self.evict()
+        except Exception:
+            pass   # la pulizia non deve mai far fallire un upload
+
+    def evict(self, keep=None, output_dir=None):
+        """Rimuove gli upload piu' vecchi di max_age_s, poi i meno usati
+        di recente finche' l'archivio non rientra in max_bytes; i path in
+        keep (default: in_use()) restano. Nella cartella dei render
+        rimuove render_*/preview_* piu' vecchi di OUTPUT_MAX_AGE_S.
+        Ritorna il numero di file rimossi."""
+        if keep is None:
+            keep = self.in_use() if self.in_use else ()
+        keep = {os.path.abspath(p) for p in keep}
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.root):
+            try:
+                info = entry.stat()
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, entry.path, entry.name.endswith(".part")))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        removed = 0
+        for mtime, size, path, is_part in entries:
+            if os.path.abspath(path) in keep:
+                continue
+            # .part: scrittura in corso (recente) o interrotta (vecchia).
+            too_old = now - mtime > (3600 if is_part else self.max_age_s)
+            if too_old or (total > self.max_bytes and not is_part):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+        with self._lock:
+            self._by_id = {k: p for k, p in self._by_id.items() if os.path.exists(p)}
+
+        out_dir = output_dir or tempfile.gettempdir()
+        for pattern in ("render_*.mp4", "preview_*.mp4"):
+            for path in glob.glob(os.path.join(out_dir, pattern)):
+                if os.path.abspath(path) in keep:
+                    continue
+                try:
+                    if now - os.path.getmtime(path) > OUTPUT_MAX_AGE_S:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+
+@st.cache_resource
+def _upload_store():
+    return UploadStore(in_use=lambda: _render_queue().active_paths())
+
+
+# ---------------------------------------------------------------------------
+# CODA DI RENDER IN BACKGROUND
+# "AVVIA RENDERING" non esegue piu' il render dentro il run dello script
+# Streamlit (bloccato per minuti, e perso se il browser fa rerun): il job
+# finisce in una coda SQLite e lo eseguono processi worker separati
+# (python app.py worker), lanciati al bisogno. Il limite di render
+# contemporanei e' globale (tabella workers, non per sessione); avanzamento
+# e risultato restano nel database, quindi la UI li rilegge a ogni poll e
+# anche dopo una riconnessione (id del job nell'URL).
+# ---------------------------------------------------------------------------
+RENDER_QUEUE_DB = os.environ.get("LOOP507_QUEUE_DB")   # None: _private_dir("queue")
+RENDER_MAX_WORKERS = max(1, int(os.environ.get("LOOP507_RENDER_WORKERS", "1")))
+RENDER_WORKER_IDLE_S = 60.0   # un worker senza job per questo tempo esce
+RENDER_RECOVER_EVERY_S = 5.0  # ensure_workers dal pannello di stato, al massimo ogni tanto
+
+
+def _private_dir(name):
+    """Cartella dell'utente corrente (0700) sotto la temp di sistema, per
+    il database della coda: con un nome fisso e condiviso di /tmp chiunque
+    sulla macchina potrebbe crearlo prima o riscriverci i job. Errore se
+    la cartella esiste ma e' di un altro utente, e' un link o e'
+    accessibile ad altri."""
+    uid = os.getuid() if hasattr(os, "getuid") else None
+    base = os.path.join(tempfile.gettempdir(), f"loop507-{uid if uid is not None else 'user'}")
+    path = os.path.join(base, name)
+    for d in (base, path):
+        # makedirs darebbe il mode solo all'ultima: ogni livello a parte
+        os.makedirs(d, mode=0o700, exist_ok=True)
+        info = os.lstat(d)
+        if os.path.islink(d) or (uid is not None and (info.st_uid != uid or info.st_mode & 0o077)):
+            raise RuntimeError(f"Cartella privata non sicura: {d}")
+    return path
+
+
+def _json_default(o):
+    """Tipi numpy nei dict della coda: scalari -> numeri, array (i ritagli
+    fissi delle strisce, frozen_content) -> {__ndarray__ base64, dtype,
+    shape}."""
+    if isinstance(o, np.ndarray):
+        return {"__ndarray__": base64.b64encode(np.ascontiguousarray(o).tobytes()).decode("ascii"),
+                "dtype": str(o.dtype), "shape": list(o.shape)}
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f"{type(o).__name__} non serializzabile in JSON")
+
+
+def _config_json(config):
+    return json.dumps(asdict(config), default=_json_default)
+
+
+def _config_from_json(text):
+    """RenderConfig da _config_json: chiavi intere dei dict (JSON le rende
+    stringhe), StripeConfig e array dei ritagli."""
+    config = json.loads(text)
+    for k in ("sources", "weights", "quotas", "source_weights"):
+        config[k] = _int_keys(config.get(k))
+    stripes = []
+    for s in config.get("stripes", []):
+        fc = s.get("frozen_content")
+        if isinstance(fc, dict) and "__ndarray__" in fc:
+            s["frozen_content"] = np.frombuffer(base64.b64decode(fc["__ndarray__"]),
+                                                dtype=fc["dtype"]).reshape(fc["shape"]).copy()
+        stripes.append(StripeConfig(**s))
+    config["stripes"] = stripes
+    return RenderConfig(**config)
+
+
+def _result_json(result):
+    return json.dumps(asdict(result), default=_json_default)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _QueueProgress:
+    """Sink del ProgressReporter nel worker: stessa interfaccia di
+    st.progress, scrive sul job nel database. Il reporter limita gia' la
+    frequenza; qui si salta anche la scrittura se non cambia nulla di
+    visibile (stesso testo, avanzamento spostato di meno dell'1%)."""
+
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+        self._last = (None, None)
+
+    def progress(self, value, text=None):
+        last_v, last_text = self._last
+        if text == last_text and last_v is not None and abs(value - last_v) < 0.01:
+            return
+        self._last = (value, text)
+        self.queue.set_progress(self.job_id, value, text)
+
+
+class RenderQueue:
+    """Job store SQLite condiviso da UI e worker. Ogni operazione apre la
+    propria connessione: la UI (thread di Streamlit) e i worker (processi
+    separati) non condividono mai un oggetto connessione.
+
+    Config e risultati si salvano come JSON (asdict), non come pickle:
+    Streamlit esegue lo script in un modulo '__main__' diverso da quello
+    del worker, e il worker non deve mai eseguire codice preso dal
+    database. Di default il database sta in _private_dir("queue")."""
+
+    def __init__(self, db_path=RENDER_QUEUE_DB, max_workers=RENDER_MAX_WORKERS):
+        self.db_path = db_path or os.path.join(_private_dir("queue"), "render_queue.sqlite")
+        self.max_workers = max_workers
+        self._procs = []  # worker lanciati da questo processo (da raccogliere)
+        self._lock = threading.Lock()   # la stessa coda serve tutte le sessioni
+        self._last_ensure = 0.0
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, status TEXT NOT NULL, progress REAL DEFAULT 0,
+                message TEXT DEFAULT '', created REAL, updated REAL, worker_pid INTEGER,
+                config TEXT, cleanup TEXT, result TEXT, error TEXT, owner TEXT)""")
+            if "owner" not in [c[1] for c in con.execute("PRAGMA table_info(jobs)")]:
+                # database di prima della colonna: i vecchi job non hanno
+                # proprietario e non li vede piu' nessuno
+                con.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            con.execute("CREATE TABLE IF NOT EXISTS workers (pid INTEGER PRIMARY KEY, started REAL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def submit(self, config, cleanup=(), owner=None):
+        """Accoda un RenderConfig. cleanup = file temporanei che il worker
+        rimuove a render finito, riuscito o no (gli upload NO: stanno
+        nell'UploadStore, condivisi tra job, e li rimuove l'eviction).
+        owner = token di chi lo accoda: status() e recent() con lo stesso
+        token sono l'unico modo di rivederlo."""
+        job_id = uuid.uuid4().hex[:12]
+        now = time.time()
+        with self._connect() as con:
+            con.execute(
+                "INSERT INTO jobs (id, status, message, created, updated, config, cleanup, owner) "
+                "VALUES (?, 'queued', 'In coda...', ?, ?, ?, ?, ?)",
+                (job_id, now, now, _config_json(config), json.dumps(list(cleanup)), owner))
+        self.ensure_workers()
+        return job_id
+
+    def status(self, job_id, owner=None):
+        """Stato del job, None se non esiste. Con owner (la UI lo passa
+        sempre) anche None se il job e' di qualcun altro."""
+        query = ("SELECT id, status, progress, message, created, updated, result, error "
+                 "FROM jobs WHERE id = ?")
+        args = (job_id,)
+        if owner is not None:
+            query += " AND owner = ?"
+            args += (owner,)
+        with self._connect() as con:
+            row = con.execute(query, args).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def recent(self, owner, limit=10):
+        """Ultimi job accodati con questo token (mai quelli degli altri)."""
+        with self._connect() as con:
+            rows = con.execute(
+                "SELECT id, status, progress, message, created, updated, result, error "
+                "FROM jobs WHERE owner = ? ORDER BY created DESC LIMIT ?", (owner, limit)).fetchall()
+        return [self._row_to_dict(r) for r in rows]
+
+    @staticmethod
+    def _row_to_dict(row):
+        job_id, status, progress, message, created, updated, result, error = row
+        return {"id": job_id, "status": status, "progress": progress or 0.0,
+                "message": message or "", "created": created, "updated": updated,
+                "result": RenderResult(**json.loads(result)) if result else None, "error": error}
+
+    def set_progress(self, job_id, value, text=None):
+        with self._connect() as con:
+            con.execute("UPDATE jobs SET progress = ?, message = COALESCE(?, message), updated = ? WHERE id = ?",
+                        (float(value), text, time.time(), job_id))
+
+    def claim(self, pid):
+        """Prende il job in coda piu' vecchio e lo segna 'running' in una
+        sola transazione: due worker non possono prendere lo stesso job."""
+        con = self._connect()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            row = con.execute(
+                "SELECT id, config, cleanup FROM jobs WHERE status = 'queued' "
+                "ORDER BY created LIMIT 1").fetchone()
+            if row is None:
+                con.execute("COMMIT")
+                return None
+            con.execute("UPDATE jobs SET status = 'running', worker_pid = ?, message = 'Avvio...', "
+                        "updated = ? WHERE id = ?", (pid, time.time(), row[0]))
+            con.execute("COMMIT")
+        finally:
+            con.close()
+        return row[0], _config_from_json(row[1]), json.loads(row[2] or "[]")
+
+    def active_paths(self):
+        """File letti dai job in coda o in corso (sorgenti, brano, video
+        delle strisce): l'archivio upload non deve rimuoverli."""
+        with self._connect() as con:
+            rows = con.execute(
+                "SELECT config FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+        paths = set()
+        for (text,) in rows:
+            config = json.loads(text)
+            paths.update(config.get("sources", {}).values())
+            if config.get("audio"):
+                paths.add(config["audio"])
+            paths.update(s["source"] for s in config.get("stripes", [])
+                         if isinstance(s.get("source"), str))
+        return paths
+
+    def finish(self, job_id, result):
+        with self._connect() as con:
+            con.execute("UPDATE jobs SET status = 'done', progress = 1.0, message = 'Pronto!', "
+                        "result = ?, updated = ? WHERE id = ?",
+                        (_result_json(result), time.time(), job_id))
+
+    def fail(self, job_id, error):
+        with self._connect() as con:
+            con.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                        (error, time.time(), job_id))
+
+    def register_worker(self, pid):
+        """True se il worker rientra nel limite globale (e viene
+        registrato), False se ce ne sono gia' abbastanza vivi."""
+        con = self._connect()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            alive = [p for (p,) in con.execute("SELECT pid FROM workers") if _pid_alive(p)]
+            con.execute("DELETE FROM workers")
+            con.executemany("INSERT INTO workers (pid, started) VALUES (?, ?)",
+                            [(p, time.time()) for p in alive])
+            ok = len(alive) < self.max_workers
+            if ok:
+                con.execute("INSERT OR REPLACE INTO workers (pid, started) VALUES (?, ?)", (pid, time.time()))
+            con.execute("COMMIT")
+        finally:
+            con.close()
+        return ok
+
+    def unregister_worker(self, pid):
+        with self._connect() as con:
+            con.execute("DELETE FROM workers WHERE pid = ?", (pid,))
+
+    def queued_count(self):
+        with self._connect() as con:
+            return con.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def ensure_workers(self, min_interval=0.0):
+        """Recupera i job rimasti 'running' su un worker morto (crash, OOM)
+        e lancia i worker che mancano per smaltire la coda. Il limite vero
+        lo applica register_worker(): un worker in piu' esce subito.
+        min_interval: non rifa' il controllo se l'ultimo e' piu' recente
+        (il pannello di stato lo chiama a ogni poll)."""
+        with self._lock:
+            now = time.monotonic()
+            if min_interval and now - self._last_ensure < min_interval:
+                return
+            self._last_ensure = now
+            self._ensure_workers()
+
+    def _ensure_workers(self):
+        # poll() raccoglie i worker gia' usciti: finche' restano zombie
+        # os.kill(pid, 0) li darebbe ancora per vivi.
+        self._procs = [p for p in self._procs if p.poll() is None]
+        with self._connect() as con:
+            for job_id, pid in con.execute(
+                    "SELECT id, worker_pid FROM jobs WHERE status = 'running'").fetchall():
+                if pid is None or not _pid_alive(pid):
+                    con.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                                ("Worker terminato durante il render (memoria esaurita?)", time.time(), job_id))
+            queued = con.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            alive = sum(1 for (p,) in con.execute("SELECT pid FROM workers") if _pid_alive(p))
+        for _ in range(min(queued, self.max_workers - alive)):
+            self._procs.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "worker", "--db", self.db_path,
+                 "--max-workers", str(self.max_workers)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True))
+
+
+def run_render_worker(queue, idle_timeout=RENDER_WORKER_IDLE_S):
+    """Ciclo di un processo worker: prende un job alla volta finche' la
+    coda non resta vuota per idle_timeout secondi. L'analisi audio resta
+    in cache nel processo tra un job e l'altro (stesso ruolo di
+    session_state nel render sincrono)."""
+    pid = os.getpid()
+    if not queue.register_worker(pid):
+        return
+    analysis_cache = {}
+    store = UploadStore(in_use=queue.active_paths)
+    idle_since = time.time()
+    try:
+        while True:
+            job = queue.claim(pid)
+            if job is None:
+                if time.time() - idle_since > idle_timeout:
+                    # Fuori dalla tabella PRIMA dell'ultimo controllo: un
+                    # job accodato da qui in poi fa lanciare un worker
+                    # nuovo a ensure_workers (questo non conta piu'), uno
+                    # accodato prima lo trova il controllo qui sotto.
+                    queue.unregister_worker(pid)
+                    if queue.queued_count() == 0 or not queue.register_worker(pid):
+                        return
+                    idle_since = time.time()
+                    continue
+                time.sleep(0.5)
+                continue
+            job_id, config, cleanup = job
+            try:
+                result = render(config, progress=_QueueProgress(queue, job_id),
+                                analysis_cache=analysis_cache)
+                queue.finish(job_id, result)
+            except Exception as e:
+                queue.fail(job_id, f"{type(e).__name__}: {e}")
+            finally:
+                for p in cleanup:
+                    try:
+                        os.remove(p)
+                    except OSError:
+                        pass
+                store.maybe_evict()
+            idle_since = time.time()
+    finally:
+        queue.unregister_worker(pid)
+
+
+# ---------------------------------------------------------------------------
+# BENCHMARK — python app.py bench
+# Media sintetici generati in locale (ffmpeg testsrc a piu' risoluzioni e
+# GOP, brano click+sinusoide a BPM fisso), poi ogni motore e ogni effetto
+# su una griglia di parametri, ciascun caso in un processo nuovo (il picco
+# RSS di un processo non scende mai: misurarlo nello stesso processo
+# sommerebbe i casi precedenti). Risultati in JSON, confrontabili con una
+# baseline salvata.
+# ---------------------------------------------------------------------------
+BENCH_RESOLUTIONS = {"360p": (640, 360), "720p": (1280, 720), "1080p": (1920, 1080)}
+BENCH_GOPS = (12, 250)       # keyframe fitti (seek economico) / radi (seek costoso)
+BENCH_BPM = 128.0
+BENCH_DURATION = 6.0         # secondi di render per caso
+BENCH_SOURCE_DURATION = 20.0
+BENCH_RSS_SLACK_MB = 16.0     # sotto questa crescita del picco RSS non e' una regressione
+
+
+def _bench_write_audio(path, duration, bpm, sr=44100):
+    """Brano sintetico: sinusoide di fondo + click sul beat (accento ogni
+    4) + un controtempo ogni 2 battute, cosi' beat e onset differiscono."""
+    n = int(duration * sr)
+    t = np.arange(n) / sr
+    y = 0.15 * np.sin(2 * np.pi * 110.0 * t)
+    click_n = int(0.03 * sr)
+    click = np.sin(2 * np.pi * 1000.0 * t[:click_n]) * np.exp(-t[:click_n] / 0.006)
+    beat = 60.0 / bpm
+    k = 0
+    while k * beat < duration:
+        for at, gain in [(k * beat, 0.9 if k % 4 == 0 else 0.6)] + \
+                        ([((k + 0.5) * beat, 0.4)] if k % 8 == 6 else []):
+            n0 = int(at * sr)
+            seg = y[n0:n0 + click_n]
+            seg += gain * click[:len(seg)]
+        k += 1
+    write_wav(path, np.repeat(y[:, None], 2, axis=1), fps=sr)
+
+
+def make_bench_media(workdir, resolutions=None, gops=BENCH_GOPS, duration=BENCH_SOURCE_DURATION,
+                     fps=30, bpm=BENCH_BPM):
+    """Genera (solo se mancano) i video testsrc per ogni risoluzione x GOP
+    — due varianti per coppia (testsrc e testsrc2, con audio sinusoidale a
+    frequenze diverse) per avere sempre due sorgenti — e il brano. Restituisce
+    {"videos": {(res, gop): [path, path]}, "audio": path}."""
+    from moviepy.config import get_setting
+    ffmpeg = get_setting("FFMPEG_BINARY")
+    os.makedirs(workdir, exist_ok=True)
+    videos = {}
+    for res in (resolutions or list(BENCH_RESOLUTIONS)):
+        w, h = BENCH_RESOLUTIONS[res]
+        for gop in gops:
+            pair = []
+            for n, (pattern, freq) in enumerate((("testsrc", 440), ("testsrc2", 660))):
+                path = os.path.join(workdir, f"{res}_g{gop}_{n}.mp4")
+                if not os.path.exists(path):
+                    subprocess.run(
+                        [ffmpeg, "-y", "-loglevel", "error",
+                         "-f", "lavfi", "-i", f"{pattern}=size={w}x{h}:rate={fps}:duration={duration}",
+                         "-f", "lavfi", "-i", f"sine=frequency={freq}:duration={duration}",
+                         "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+                         "-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0",
+                         "-c:a", "aac", "-shortest", path + ".tmp.mp4"],
+                        check=True)
+                    os.replace(path + ".tmp.mp4", path)
+                pair.append(path)
+            videos[(res, gop)] = pair
+    audio = os.path.join(workdir, f"clicks_{int(bpm)}bpm.wav")
+    if not os.path.exists(audio):
+        _bench_write_audio(audio, duration, bpm)
+    return {"videos": videos, "audio": audio}
+
+
+# Griglia: i motori girano su ogni coppia risoluzione x GOP, gli effetti
+# (costo per frame, indipendente dal GOP) solo sulla risoluzione piu' bassa
+# scelta. Ogni voce = parametri RenderConfig sopra la base del caso.
+BENCH_ENGINE_CASES = {
+    "decompose_random":  dict(app_mode="Decompose", mix_mode="Random", use_scan=False),
+    "decompose_quota":   dict(app_mode="Decompose", mix_mode="Quote Fisse", use_scan=False),
+    "vj_fixed":          dict(slice_dur=0.25, stutter_prob=0.0),
+    "vj_fixed_seek":     dict(slice_dur=0.25, stutter_prob=0.0, seek_aware=True),
+    "vj_beat":           dict(beat_slice_mode=True, stutter_prob=0.0),
+    "vj_onset":          dict(beat_slice_mode=True, cut_source="onset", stutter_prob=0.0),
+    "vj_crossfade":      dict(beat_slice_mode=True, stutter_prob=0.0, crossfade_dur=0.08),
+    "vj_stutter":        dict(beat_slice_mode=True, loop_reps=3, stutter_prob=0.5),
+    "vj_freeze":         dict(beat_slice_mode=True, stutter_prob=0.0, freeze_on_beat=True,
+                              freeze_prob=0.5, freeze_dur=0.15),
+}
+BENCH_EFFECT_CASES = {
+    "fx_none":           dict(beat_slice_mode=True, stutter_prob=0.0),
+    "fx_slit_scan":      dict(app_mode="Decompose", use_scan=True, s_a=5, s_b=60, s_rand=True, scan_dir="Mix"),
+    "fx_temporal_bands": dict(beat_slice_mode=True, stutter_prob=0.0, temporal_bands_on=True,
+                              tb_intensity=0.7, tb_ampiezza=0.5, tb_spostamento=0.6, tb_direzione=0.5),
+    "fx_color_react":    dict(beat_slice_mode=True, stutter_prob=0.0, color_react_amount=0.6),
+    "fx_saturation":     dict(beat_slice_mode=True, stutter_prob=0.0, saturation_react_amount=0.6),
+    "fx_stripe":         dict(beat_slice_mode=True, stutter_prob=0.0,
+                              stripes=[dict(base_opacity=0.4)]),
+    "fx_stripe_source":  dict(beat_slice_mode=True, stutter_prob=0.0,
+                              stripes=[dict(base_opacity=0.4, source=1),
+                                       dict(base_opacity=0.3, orient="Verticale", content_follows=True)]),
+    "fx_audio_mix":      dict(beat_slice_mode=True, stutter_prob=0.0,
+                              audio_mix_mode="mix_decomposed", vol_music=0.8, vol_original=0.5),
+}
+# Griglia di parametri per effetto, sopra la base di BENCH_EFFECT_CASES:
+# prodotto cartesiano degli assi, un caso per punto (nome "effetto[k=v,...]";
+# valori non scalari, come le liste di strisce, indicati con #indice).
+# Con --quick solo il primo punto di ogni griglia.
+BENCH_EFFECT_GRID = {
+    "fx_slit_scan":      {"s_b": [20, 60, 150], "scan_dir": ["Orizzontale", "Mix"]},
+    "fx_temporal_bands": {"tb_intensity": [0.3, 0.7, 1.0], "tb_ampiezza": [0.2, 0.8]},
+    "fx_color_react":    {"color_react_amount": [0.2, 0.6, 1.0]},
+    "fx_saturation":     {"saturation_react_amount": [0.2, 0.6, 1.0]},
+    "fx_stripe":         {"stripes": [[dict(pct=10.0, base_opacity=0.15)],
+                                      [dict(pct=30.0, base_opacity=0.4)],
+                                      [dict(pct=60.0, base_opacity=0.8, orient="Verticale")]]},
+    "fx_audio_mix":      {"audio_mix_mode": ["mix", "mix_decomposed", "custom_decomposed"]},
+}
+
+
+def _bench_effect_points(name, quick=False):
+    """[(nome caso, parametri)] della griglia di 'name' (un solo punto,
+    col nome dell'effetto, se l'effetto non ha griglia)."""
+    import itertools
+    base = BENCH_EFFECT_CASES[name]
+    grid = BENCH_EFFECT_GRID.get(name)
+    if not grid:
+        return [(name, base)]
+    axes = list(grid)
+    points = []
+    for combo in itertools.product(*(list(enumerate(grid[a])) for a in axes)):
+        label = ",".join(f"{a}={v}" if isinstance(v, (int, float, str)) else f"{a}#{j}"
+                         for a, (j, v) in zip(axes, combo))
+        points.append((f"{name}[{label}]", dict(base, **{a: v for a, (_, v) in zip(axes, combo)})))
+    return points[:1] if quick else points
+
+
+def _bench_cases(media, quick=False):
+    cases = []
+    engine_keys = list(media["videos"])
+    if quick:
+        engine_keys = engine_keys[:1]
+    for res, gop in engine_keys:
+        for name, params in BENCH_ENGINE_CASES.items():
+            cases.append({"name": f"{name}@{res}_g{gop}", "group": name,
+                          "sources": media["videos"][(res, gop)], "params": params})
+    fx_key = engine_keys[0]
+    for name in BENCH_EFFECT_CASES:
+        for point, params in _bench_effect_points(name, quick=quick):
+            cases.append({"name": f"{point}@{fx_key[0]}_g{fx_key[1]}", "group": name,
+                          "sources": media["videos"][fx_key], "params": params})
+    return cases
+
+
+def _bench_config(case, audio, duration, fps):
+    params = dict(case["params"])
+    stripes = [StripeConfig(**s) for s in params.pop("stripes", [])]
+    return RenderConfig(
+        sources=dict(enumerate(case["sources"])), audio=audio, duration=duration, fps=fps,
+        seed=1234, make_preview=False, name=f"bench_{os.getpid()}",
+        output_dir=os.path.join(tempfile.gettempdir(), "loop507_bench_out"),
+        stripes=stripes, **params)
+
+
+def _proc_status_mb(field):
+    """Campo di /proc/self/status in MB (VmRSS, VmHWM); None fuori da Linux."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _bench_run_case(case, audio, duration, fps, analysis_cache):
+    """Un caso, nel processo (nuovo) del pool: render completo a file.
+
+    peak_rss_mb = picco RSS del render meno l'RSS prima del render. Non
+    ru_maxrss: passa intatto attraverso fork+exec (il processo spawn del
+    pool ripartirebbe dal picco del padre, uguale per tutti i casi). Su
+    Linux si azzera il picco (VmHWM) scrivendo 5 in clear_refs, cosi'
+    nemmeno gli import del processo finiscono nella misura."""
+    import resource
+    config = _bench_config(case, audio, duration, fps)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    rss_start = _proc_status_mb("VmRSS")
+    t0 = time.perf_counter()
+    result = render(config, analysis_cache=dict(analysis_cache))
+    wall = time.perf_counter() - t0
+    rss_peak = _proc_status_mb("VmHWM")
+    if rss_start is None or rss_peak is None:
+        # fuori da Linux: solo ru_maxrss, approssimato per eccesso
+        rss_start, rss_peak = 0.0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    frames = int(round(duration * fps))
+    try:
+        os.remove(result.video_path)
+    except OSError:
+        pass
+    return {
+        "name": case["name"],
+        "group": case["group"],
+        "params": {k: v for k, v in case["params"].items() if k != "stripes"},
+        "wall_s": round(wall, 3),
+        "fps": round(frames / wall, 2) if wall > 0 else None,
+        "fragments": result.fragments,
+        "peak_rss_mb": round(max(0.0, rss_peak - rss_start), 1),
+        "start_rss_mb": round(rss_start, 1),
+        "ffmpeg_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0, 1),
+        "profiling": {k.strip(): round(v, 3) for k, v in result.profiling.items()},
+    }
+
+
+def run_benchmarks(workdir=None, resolutions=None, quick=False, only=None,
+                   duration=BENCH_DURATION, fps=24, log=print):
+    """Esegue la griglia e restituisce il dict dei risultati (quello che
+    'bench --out' scrive in JSON). only = sottostringa per filtrare i casi.
+    L'analisi audio si fa una volta sola qui e si passa gia' pronta a ogni
+    caso: e' uguale per tutti e non e' cio' che si vuole misurare."""
+    import platform
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    workdir = workdir or os.path.join(tempfile.gettempdir(), "loop507_bench_media")
+    if resolutions is None:
+        resolutions = ["360p"] if quick else list(BENCH_RESOLUTIONS)
+    log(f"Media sintetici in {workdir}...")
+    media = make_bench_media(workdir, resolutions=resolutions)
+    cases = [c for c in _bench_cases(media, quick=quick) if not only or only in c["name"]]
+
+    probe = _bench_config(cases[0], media["audio"], duration, fps) if cases else None
+    analysis_cache = {}
+    if probe is not None:
+        log("Analisi audio (una volta per tutti i casi)...")
+        bt, rms, band, onsets = analyze_audio(media["audio"], duration)
+        key = _analysis_cache_key(probe)
+        analysis_cache = {"_audio_cache_key": key, "_audio_cache": (bt, rms, band),
+                          "_vj_audio_cache_key": key, "_vj_audio_cache": (bt, rms, band, onsets)}
+
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for case in cases:
+        # max_tasks_per_child=1: processo nuovo a ogni caso (RSS pulito).
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx, max_tasks_per_child=1) as pool:
+            try:
+                res = pool.submit(_bench_run_case, case, media["audio"], duration, fps,
+                                  analysis_cache).result()
+            except Exception as e:
+                res = {"name": case["name"], "group": case["group"], "error": f"{type(e).__name__}: {e}"}
+        results.append(res)
+        if "error" in res:
+            log(f"  {case['name']:<36} ERRORE {res['error']}")
+        else:
+            log(f"  {case['name']:<36} {res['wall_s']:7.2f}s {res['fps']:7.1f} fps "
+                f"{res['peak_rss_mb']:+7.0f} MB  frammenti {res['fragments']}")
+    return {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.machine(), "cpus": os.cpu_count(),
+            "duration": duration, "fps": fps, "quick": quick,
+        },
+        "results": results,
+    }
+
+
+def compare_benchmarks(current, baseline, tolerance=0.15):
+    """Confronto caso per caso con la baseline: ritorna (righe di testo,
+    lista dei casi peggiorati oltre tolerance su tempo o picco RSS). Per
+    l'RSS serve anche una crescita di almeno BENCH_RSS_SLACK_MB: su un
+    picco di pochi MB la percentuale e' solo rumore."""
+    base = {r["name"]: r for r in baseline.get("results", []) if "error" not in r}
+    lines, regressions = [], []
+    for k in ("duration", "fps"):
+        if baseline.get("meta", {}).get(k) != current.get("meta", {}).get(k):
+            lines.append(f"  ATTENZIONE: {k} diverso dalla baseline "
+                         f"({baseline.get('meta', {}).get(k)} vs {current.get('meta', {}).get(k)}), "
+                         f"confronto non significativo.")
+    for r in current.get("results", []):
+        b = base.get(r["name"])
+        if b is None or "error" in r:
+            continue
+        dt = r["wall_s"] / b["wall_s"] - 1.0 if b["wall_s"] else 0.0
+        dm = r["peak_rss_mb"] / b["peak_rss_mb"] - 1.0 if b["peak_rss_mb"] else 0.0
+        worse = dt > tolerance or (dm > tolerance and r["peak_rss_mb"] - b["peak_rss_mb"] > BENCH_RSS_SLACK_MB)
+        if worse:
+            regressions.append(r["name"])
+        lines.append(f"  {r['name']:<36} tempo {dt:+7.1%}  RSS {dm:+7.1%}" + ("  << PEGGIORATO" if worse else ""))
+    return lines, regressions
+
+
+KERNEL_BENCH_SIZES = {"1280x720": (1280, 720), "720x1280": (720, 1280)}
+
+
+def _kernel_bench_cases():
+    """{nome: f(frame, jit)} con gli stessi parametri di un render tipico."""
+    return {
+        "stripe_blend": lambda fr, jit: apply_selective_stripe(
+            lambda t: fr, 1.0, 8.0, 24, None, stripe_pct=30.0, base_opacity=0.6, jit=jit),
+    }
+
+
+def run_kernel_benchmarks(sizes=None, repeats=20, seed=507, log=print):
+    """Kernel JIT contro path numpy, per kernel e per dimensione: verifica
+    bit per bit con lo stesso stato di random (stesso seed prima di ogni
+    chiamata) e millisecondi medi per frame. La compilazione (prima
+    chiamata) e' misurata a parte."""
+    sizes = sizes or list(KERNEL_BENCH_SIZES)
+    t0 = time.perf_counter()
+    kernels = jit_kernels()
+    results = []
+    rng = np.random.default_rng(seed)
+    for size_name in sizes:
+        w, h = KERNEL_BENCH_SIZES[size_name]
+        frame = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        for name, fn in _kernel_bench_cases().items():
+            res = {"name": f"{name}/{size_name}", "kernel": name, "size": size_name}
+            timings = {}
+            outputs = {}
+            for jit in ((False, True) if kernels is not None else (False,)):
+                random.seed(seed)
+                outputs[jit] = fn(frame, jit)   # anche warm-up/compilazione
+                ts = []
+                for i in range(repeats):
+                    random.seed(seed + i)
+                    t1 = time.perf_counter()
+                    fn(frame, jit)
+                    ts.append(time.perf_counter() - t1)
+                timings[jit] = sum(ts) / len(ts) * 1000.0
+            res["numpy_ms"] = timings[False]
+            if kernels is not None:
+                res["jit_ms"] = timings[True]
+                res["speedup"] = timings[False] / timings[True] if timings[True] else 0.0
+                res["bit_exact"] = bool(np.array_equal(outputs[False], outputs[True]))
+            results.append(res)
+            log(f"  {res['name']:<26} numpy {res['numpy_ms']:7.2f} ms"
+                + (f"  jit {res['jit_ms']:7.2f} ms  x{res['speedup']:.1f}  "
+                   f"{'identico' if res['bit_exact'] else 'DIVERSO'}" if kernels is not None else
+                   "  (Numba non disponibile)"))
+    import platform
+    return {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "numpy": np.__version__,
+            "numba": _module_version("numba"), "cpus": os.cpu_count(),
+            "repeats": repeats, "jit_available": kernels is not None,
+            "setup_and_compile_s": time.perf_counter() - t0 - sum(
+                (r["numpy_ms"] + r.get("jit_ms", 0.0)) * repeats / 1000.0 for r in results),
+        },
+        "results": results,
+    }
+
+
+class _FxCapture:
+    """Clip finto per i benchmark: .fl(fx) restituisce fx stessa, cosi' gli
+    effetti basati su clip.fl si chiamano direttamente su un frame."""
+
+    @staticmethod
+    def fl(fx):
+        return fx
+
+
+def _effect_bench_cases(threads):
+    """{nome: f(frame)} degli effetti a tile con 'threads' thread per frame,
+    parametri da render tipico (colore/saturazione a energia piena)."""
+    env = {"low": [0.9], "mid": [0.5], "high": [0.7]}
+    color_fx = apply_beat_color_react(_FxCapture, env, 1.0, 0.8, threads=threads)
+    sat_fx = apply_beat_saturation_react(_FxCapture, env, 1.0, 0.8, threads=threads)
+    return {
+        "color_tint": lambda fr: color_fx(lambda t: fr, 0.5),
+        "saturation": lambda fr: sat_fx(lambda t: fr, 0.5),
+        "stripe_blend": lambda fr: apply_selective_stripe(
+            lambda t: fr, 1.0, 8.0, 24, None, stripe_pct=30.0, base_opacity=0.6, threads=threads),
+        "temporal_bands": lambda fr: glitch_temporal_bands(fr, 0.7, 0.5, 0.6, 0.5, threads=threads),
+        "slit_scan_h": lambda fr: apply_procedural_slit_scan(
+            lambda t: fr, 3.0, 10.0, 4, 40, False, "Orizzontale", threads=threads),
+        "slit_scan_v": lambda fr: apply_procedural_slit_scan(
+            lambda t: fr, 3.0, 10.0, 4, 40, False, "Verticale", threads=threads),
+    }
+
+
+def run_effect_benchmarks(sizes=None, threads=None, repeats=20, seed=507, log=print):
+    """Effetti numpy a tile (run_tiled) per numero di thread: millisecondi
+    medi per frame, speedup rispetto a un thread e verifica bit per bit
+    contro il risultato a un thread (stesso stato di random)."""
+    sizes = sizes or list(KERNEL_BENCH_SIZES)
+    threads = sorted(set(threads or [1, 2, 4]) | {1})
+    results = []
+    rng = np.random.default_rng(seed)
+    for size_name in sizes:
+        w, h = KERNEL_BENCH_SIZES[size_name]
+        frame = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        cases = {n: _effect_bench_cases(n) for n in threads}
+        for name in cases[1]:
+            reference = None
+            for n in threads:
+                fn = cases[n][name]
+                random.seed(seed)
+                out = fn(frame)   # anche warm-up del pool
+                reference = out if reference is None else reference
+                ts = []
+                for i in range(repeats):
+                    random.seed(seed + i)
+                    t1 = time.perf_counter()
+                    fn(frame)
+                    ts.append(time.perf_counter() - t1)
+                res = {"name": f"{name}/{size_name}/t{n}", "effect": name, "size": size_name,
+                       "threads": n, "ms": sum(ts) / len(ts) * 1000.0,
+                       "bit_exact": bool(np.array_equal(reference, out))}
+                base = next(r["ms"] for r in results + [res]
+                            if r["effect"] == name and r["size"] == size_name and r["threads"] == 1)
+                res["speedup"] = base / res["ms"] if res["ms"] else 0.0
+                results.append(res)
+                log(f"  {name + '/' + size_name:<26} {n:2d} thread {res['ms']:7.2f} ms  "
+                    f"x{res['speedup']:.2f}  {'identico' if res['bit_exact'] else 'DIVERSO'}")
+    import platform
+    return {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "numpy": np.__version__,
+            "cpus": os.cpu_count(), "repeats": repeats, "threads": threads,
+        },
+        "results": results,
+    }
+
+
+# Avvio a freddo: "import app" in un interprete nuovo. Il budget vale per
+# la parte dell'app (streamlit escluso: con "streamlit run" e' gia'
+# caricato prima dello script); i moduli pesanti devono restare fuori
+# dall'avvio e arrivare con il sottosistema che li usa.
+STARTUP_IMPORT_BUDGET_MS = 400.0
+STARTUP_LAZY_SUBSYSTEMS = {
+    "analisi": "import librosa, librosa.beat, librosa.onset, librosa.feature, librosa.effects",
+    "motore": ("import moviepy.video.fx.resize, moviepy.video.fx.crop, "
+               "moviepy.video.compositing.concatenate"),
+    "kernel JIT": "import numba",
+}
+STARTUP_FORBIDDEN_IMPORTS = ("librosa", "numba", "scipy", "moviepy.editor",
+                             "moviepy.video.fx.all", "IPython", "pygame")
+
+
+def _parse_importtime(stderr):
+    """Righe di python -X importtime -> [(modulo, profondita', cumulativo
+    in ms)], nell'ordine di stampa (i figli prima del genitore)."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        rows.append((name.strip(), depth, int(parts[1]) / 1000.0))
+    return rows
+
+
+def run_startup_benchmark(repeats=5, budget_ms=STARTUP_IMPORT_BUDGET_MS, top=12, log=print):
+    """Tempo di "import app" a freddo (mediana su 'repeats' interpreti
+    nuovi) con il dettaglio per modulo importato dall'app, costo al primo
+    uso dei sottosistemi caricati in ritardo e moduli pesanti finiti per
+    sbaglio nell'avvio. 'ok' False se si sfora il budget o se uno di
+    STARTUP_FORBIDDEN_IMPORTS viene caricato all'import."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    mod = os.path.splitext(os.path.basename(__file__))[0]
+    probe = (f"import sys, json; import {mod}; "
+             f"print(json.dumps([m for m in {list(STARTUP_FORBIDDEN_IMPORTS)!r} if m in sys.modules]))")
+    totals, st_ms, per_module, forbidden = [], [], {}, set()
+    for _ in range(repeats):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", probe], cwd=here,
+                              capture_output=True, text=True, timeout=120)
+        if proc.returncode != 0:
+            raise RuntimeError(f"import {mod} fallito: {proc.stderr.strip().splitlines()[-1:]}")
+        forbidden.update(json.loads(proc.stdout.strip().splitlines()[-1]))
+        rows = _parse_importtime(proc.stderr)
+        app_row = next(r for r in rows if r[0] == mod and r[1] == 0)
+        totals.append(app_row[2])
+        # figli diretti dell'app: le righe a profondita' 1 subito prima della sua
+        i = rows.index(app_row)
+        children = []
+        for name, depth, ms in reversed(rows[:i]):
+            if depth == 0:
+                break
+            if depth == 1:
+                children.append((name, ms))
+        st_ms.append(sum(ms for name, ms in children if name == "streamlit"))
+        for name, ms in children:
+            per_module.setdefault(name, []).append(ms)
+    total = float(np.median(totals))
+    streamlit_ms = float(np.median(st_ms))
+    app_ms = total - streamlit_ms
+    modules = sorted(((n, float(np.median(v))) for n, v in per_module.items()),
+                     key=lambda r: -r[1])
+    log(f"  import {mod}: {total:7.1f} ms (streamlit {streamlit_ms:.1f} ms, "
+        f"app {app_ms:.1f} ms / budget {budget_ms:.0f} ms)")
+    for name, ms in modules[:top]:
+        log(f"    {name:<40} {ms:7.1f} ms")
+
+    subsystems = {}
+    for label, stmt in STARTUP_LAZY_SUBSYSTEMS.items():
+        code = (f"import time, {mod}; t0 = time.perf_counter(); {stmt}; "
+                f"print((time.perf_counter() - t0) * 1000.0)")
+        proc = subprocess.run([sys.executable, "-c", code], cwd=here,
+                              capture_output=True, text=True, timeout=300)
+        subsystems[label] = (float(proc.stdout.strip().splitlines()[-1])
+                             if proc.returncode == 0 else None)
+        log(f"  primo uso {label:<12} " + (f"{subsystems[label]:7.1f} ms" if subsystems[label] is not None
+                                           else "non disponibile"))
+    if forbidden:
+        log(f"  MODULI PESANTI ALL'AVVIO: {', '.join(sorted(forbidden))}")
+    ok = app_ms <= budget_ms and not forbidden
+    if app_ms > budget_ms:
+        log(f"  BUDGET SFORATO: {app_ms:.1f} ms > {budget_ms:.0f} ms")
+    import platform
+    return {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "cpus": os.cpu_count(),
+            "repeats": repeats, "budget_ms": budget_ms,
+        },
+        "total_ms": total, "streamlit_ms": streamlit_ms, "app_ms": app_ms,
+        "modules": [{"module": n, "ms": ms} for n, ms in modules],
+        "lazy_subsystems_ms": subsystems,
+        "forbidden_at_startup": sorted(forbidden),
+        "ok": ok,
+    }
+
+
+def _module_version(name):
+    try:
+        from importlib.metadata import version
+        return version(name)
+    except Exception:
+        return None
+
+
+@st.cache_resource
+def _render_queue():
+    return RenderQueue()
+
+
+def _job_owner():
+    """Token della sessione a cui appartengono i job in background. Sta
+    anche nell'URL (?owner=) accanto all'id del job: riaprendo il link il
+    risultato si ritrova, ma un job (e la lista dei render recenti) lo
+    vede solo chi ha il token."""
+    if "job_owner" not in st.session_state:
+        st.session_state.job_owner = st.query_params.get("owner") or uuid.uuid4().hex
+    return st.session_state.job_owner
+
+
+@st.fragment(run_every=1.0)
+def _render_job_status(job_id):
+    """Pannello di avanzamento del job in background: rilegge il database
+    ogni secondo senza rieseguire tutto lo script. A job finito copia il
+    risultato in session_state e fa un rerun completo della pagina, che
+    da quel momento smette di interrogare la coda."""
+    # Anche senza nuovi submit: job rimasti 'running' su un worker morto
+    # e job in coda senza worker vengono recuperati mentre li si guarda.
+    _render_queue().ensure_workers(min_interval=RENDER_RECOVER_EVERY_S)
+    job = _render_queue().status(job_id, owner=_job_owner())
+    if job is None:
+        # inesistente o di un'altra sessione: il link non apre nulla
+        st.session_state.render_job = None
+        st.query_params.pop("job", None)
+        st.rerun()
+    if job["status"] in ("queued", "running"):
+        st.progress(min(max(job["progress"], 0.0), 1.0), text=job["message"])
+        st.caption(f"_Job `{job_id}` in background: puoi chiudere o ricaricare la pagina, "
+                   f"riaprendo questo link ritrovi il risultato._")
+        return
+    if job["status"] == "done":
+        result = job["result"]
+        st.session_state.video_path    = result.video_path
+        st.session_state.preview_path  = result.preview_path
+        st.session_state.render_name   = result.render_name
+        st.session_state.profiling_log = result.profiling_log
+        st.session_state.report_data   = result.report
+        st.session_state.render_warnings = list(result.warnings)
+        st.session_state.video_ready = True
+    else:
+        st.session_state.render_error = job["error"]
+    st.session_state.render_job = None
+    st.rerun()
+
+
+def _close_scrub_server():
+    """Chiude la timeline di scrubbing della sessione (sorgenti aperte) e
+    libera il seed: il render successivo torna a un montaggio nuovo."""
+    server = st.session_state.pop("scrub_server", None)
+    st.session_state.pop("scrub_seed", None)
+    if server is not None:
+        server.close()
+
+
+def _scrub_panel(server):
+    """Timeline di scrubbing: slider sulla griglia dei frame del render e
+    frame finale composto a quell'istante (FrameServer, LRU)."""
+    step = 1.0 / server.fps
+    last = (server.n_frames - 1) * step
+    t = st.slider("Istante (s)", 0.0, max(last, step), 0.0, step=step,
+                  format="%.2f", key="scrub_t")
+    t0 = time.perf_counter()
+    frame = server.frame_at(min(t, last))
+    ms = (time.perf_counter() - t0) * 1000.0
+    st.image(frame, use_container_width=True)
+    st.caption(f"Frame {server.frame_index(t) + 1}/{server.n_frames} · {ms:.0f} ms · "
+               f"seed {st.session_state.get('scrub_seed')} — bande temporali e slit scan "
+               f"cambiano a ogni lettura, il resto e' identico al render.")
+
+
+# ---------------------------------------------------------------------------
+# PROFILO DEI RERUN (UI)
+# Con "streamlit run" ogni widget toccato riesegue lo script intero: prima
+# le definizioni del modulo, poi main(). Con VD_PROFILE_RERUN=1 (o
+# ?profile=1 nell'URL) ogni rerun viene diviso in sezioni — main() chiama
+# _rerun_lap("nome") all'inizio di ognuna, senza re-indentare nulla — e
+# le piu' lente finiscono nel log del server; lo storico (condiviso tra
+# sessioni) compare in fondo alla pagina con media e p95 per sezione.
+# ---------------------------------------------------------------------------
+RERUN_PROFILE_ENV = "VD_PROFILE_RERUN"
+RERUN_PROFILE_HISTORY = 200     # rerun tenuti nello storico
+RERUN_PROFILE_TOP = 5           # sezioni piu' lente nella riga di log
+
+_RERUN_PROFILER = None          # profiler del rerun in corso (None = spento)
+
+
+class RerunProfiler:
+    """Cronometro a giri: lap(nome) chiude la sezione corrente e apre la
+    successiva. Una sezione che si riapre (rami alterni) accumula."""
+
+    def __init__(self, t0=None, first="modulo", clock=time.perf_counter):
+        self.clock = clock
+        self.sections = {}
+        self._name = first
+        self._t = t0 if t0 is not None else clock()
+        self.t0 = self._t
+
+    def lap(self, name):
+        now = self.clock()
+        self.sections[self._name] = self.sections.get(self._name, 0.0) + (now - self._t)
+        self._name, self._t = name, now
+
+    def finish(self):
+        self.lap(None)
+        self.sections.pop(None, None)
+        return self.sections
+
+    def line(self, top=RERUN_PROFILE_TOP):
+        total = sum(self.sections.values())
+        slowest = sorted(self.sections.items(), key=lambda kv: -kv[1])[:top]
+        return (f"rerun {total * 1000.0:.0f} ms — "
+                + " · ".join(f"{name} {sec * 1000.0:.0f} ms" for name, sec in slowest))
+
+
+class _RerunHistory:
+    """Ultimi RERUN_PROFILE_HISTORY rerun profilati ({sezione: secondi})."""
+
+    def __init__(self, maxlen=RERUN_PROFILE_HISTORY):
+        self._runs = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def add(self, sections):
+        with self._lock:
+            self._runs.append(dict(sections))
+
+    def summary(self):
+        """[(sezione, rerun, media ms, p95 ms)] dalla piu' lenta (p95)."""
+        with self._lock:
+            runs = list(self._runs)
+        per = {}
+        for run in runs:
+            for name, sec in run.items():
+                per.setdefault(name, []).append(sec * 1000.0)
+        rows = [(name, len(v), float(np.mean(v)), float(np.percentile(v, 95)))
+                for name, v in per.items()]
+        return sorted(rows, key=lambda r: -r[3])
+
+
+@st.cache_resource
+def _rerun_history():
+    return _RerunHistory()
+
+
+def _rerun_lap(name):
+    if _RERUN_PROFILER is not None:
+        _RERUN_PROFILER.lap(name)
+
+
+def _rerun_profile_panel():
+    rows = _rerun_history().summary()
+    if not rows:
+        return
+    with st.expander("Profilo rerun", expanded=False):
+        st.code("\n".join([f"{'sezione':<32} {'rerun':>5} {'media':>9} {'p95':>9}"]
+                          + [f"{name:<32} {n:>5} {mean:>6.1f} ms {p95:>6.1f} ms"
+                             for name, n, mean, p95 in rows]), language=None)
+
+
+def run_main():
+    """main() con il profilo dei rerun se richiesto (RERUN_PROFILE_ENV o
+    ?profile=1). Anche un rerun interrotto (st.rerun, st.stop) viene
+    registrato: le sezioni fin li' sono tempo speso comunque."""
+    global _RERUN_PROFILER
+    if os.environ.get(RERUN_PROFILE_ENV) != "1" and st.query_params.get("profile") != "1":
+        return main()
+    _RERUN_PROFILER = RerunProfiler(t0=_SCRIPT_T0)
+    try:
+        return main()
+    finally:
+        prof, _RERUN_PROFILER = _RERUN_PROFILER, None
+        prof.finish()
+        _rerun_history().add(prof.sections)
+        print(prof.line(), flush=True)
+
+
+def _cli(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="app.py", description="VideoDecomposer senza interfaccia (streamlit run app.py per la UI).")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_render = sub.add_parser("render", help="Esegue uno o piu' job JSON/YAML.")
+    p_render.add_argument("job", help="File job (.json/.yaml/.yml) o cartella di job.")
+    p_render.add_argument("--jobs", type=int, default=1,
+                          help="Render in parallelo (processi separati). Default 1.")
+    p_render.add_argument("--out", default=None,
+                          help="Cartella di output (sovrascrive output_dir dei job).")
+    p_worker = sub.add_parser("worker", help="Worker della coda di render (lo lancia la UI).")
+    p_worker.add_argument("--db", default=RENDER_QUEUE_DB)
+    p_worker.add_argument("--max-workers", type=int, default=RENDER_MAX_WORKERS)
+    p_bench = sub.add_parser("bench", help="Benchmark su media sintetici (motori + effetti).")
+    p_bench.add_argument("--quick", action="store_true",
+                         help="Solo 360p e la prima coppia di GOP (controllo veloce).")
+    p_bench.add_argument("--res", nargs="+", choices=list(BENCH_RESOLUTIONS), default=None,
+                         help="Risoluzioni da includere (default: tutte, o 360p con --quick).")
+    p_bench.add_argument("--only", default=None, help="Solo i casi che contengono questa stringa.")
+    p_bench.add_argument("--duration", type=float, default=BENCH_DURATION)
+    p_bench.add_argument("--fps", type=int, default=24)
+    p_bench.add_argument("--media", default=None, help="Cartella dei media sintetici (riusati se presenti).")
+    p_bench.add_argument("--out", default=None, help="Scrive i risultati JSON in questo file.")
+    p_bench.add_argument("--baseline", default=None, help="JSON di un run precedente da confrontare.")
+    p_bench.add_argument("--save-baseline", default=None, help="Salva questo run come baseline.")
+    p_bench.add_argument("--tolerance", type=float, default=0.15,
+                         help="Peggioramento massimo tollerato (0.15 = +15%%) prima di uscire con errore.")
+    p_kbench = sub.add_parser("bench-kernels",
+                              help="Kernel JIT (Numba) contro numpy: verifica bit per bit e tempi.")
+    p_kbench.add_argument("--size", nargs="+", choices=list(KERNEL_BENCH_SIZES), default=None)
+    p_kbench.add_argument("--repeats", type=int, default=20)
+    p_kbench.add_argument("--out", default=None, help="Scrive i risultati JSON in questo file.")
+    p_live = sub.add_parser("live", help="Suona un job in tempo reale su UDP / named pipe.")
+    p_live.add_argument("job", help="File job (.json/.yaml/.yml).")
+    p_live.add_argument("--sink", choices=LIVE_SINKS, default="mpegts",
+                        help="mpegts (H.264 + audio), mjpeg, pipe (rgb24 grezzo).")
+    p_live.add_argument("--target", default=None,
+                        help="URL (udp://, tcp://...) o path della named pipe "
+                             "(default: " + ", ".join(f"{k} {v}" for k, v in LIVE_DEFAULT_TARGETS.items()) + ").")
+    p_live.add_argument("--latency", type=float, default=LIVE_LATENCY_S,
+                        help="Margine di pre-roll/decode-ahead in secondi.")
+    p_live.add_argument("--stats-every", type=float, default=2.0,
+                        help="Secondi fra due righe di statistiche (0 = solo il riepilogo).")
+    p_sbench = sub.add_parser("bench-startup",
+                              help="Tempo di import a freddo per modulo, contro un budget.")
+    p_sbench.add_argument("--repeats", type=int, default=5)
+    p_sbench.add_argument("--budget-ms", type=float, default=STARTUP_IMPORT_BUDGET_MS,
+                          help="Budget per l'app, streamlit escluso (default %(default)s).")
+    p_sbench.add_argument("--out", default=None, help="Scrive i risultati JSON in questo file.")
+    p_frame = sub.add_parser("frame", help="Frame composti del montaggio di un job a istanti dati (PNG).")
+    p_frame.add_argument("job", help="File job (.json/.yaml/.yml).")
+    p_frame.add_argument("--t", nargs="+", type=float, required=True, help="Istanti in secondi.")
+    p_frame.add_argument("--out", default=".", help="Cartella dei PNG (default: corrente).")
+    p_ebench = sub.add_parser("bench-effects",
+                              help="Effetti numpy a tile per numero di thread: scalabilita' e verifica.")
+    p_ebench.add_argument("--size", nargs="+", choices=list(KERNEL_BENCH_SIZES), default=None)
+    p_ebench.add_argument("--threads", nargs="+", type=int, default=None,
+                          help="Thread per frame da confrontare (default: 1 2 4).")
+    p_ebench.add_argument("--repeats", type=int, default=20)
+    p_ebench.add_argument("--out", default=None, help="Scrive i risultati JSON in questo file.")
+    args = parser.parse_args(argv)
+
+    if args.command == "live":
+        config = load_job(args.job)
+        config.make_preview = False
+        live = LiveOutput(sink=args.sink, target=args.target, latency_s=args.latency,
+                          stats_every=args.stats_every)
+        result = render(config, live=live)
+        print(result.profiling_log)
+        return 0
+
+    if args.command == "bench-startup":
+        results = run_startup_benchmark(repeats=args.repeats, budget_ms=args.budget_ms)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2, ensure_ascii=False)
+        return 0 if results["ok"] else 1
+
+    if args.command == "frame":
+        os.makedirs(args.out, exist_ok=True)
+        with frame_server(load_job(args.job)) as server:
+            for t in args.t:
+                n = server.frame_index(t)
+                path = os.path.join(args.out, f"frame_{n:06d}.png")
+                Image.fromarray(server.frame_at(t)).save(path)
+                print(path)
+            print(json.dumps(server.stats()))
+        return 0
+
+    if args.command == "bench-effects":
+        results = run_effect_benchmarks(sizes=args.size, threads=args.threads, repeats=args.repeats)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2, ensure_ascii=False)
+        return 0 if all(r["bit_exact"] for r in results["results"]) else 1
+
+    if args.command == "bench-kernels":
+        results = run_kernel_benchmarks(sizes=args.size, repeats=args.repeats)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2, ensure_ascii=False)
+        return 0 if all(r.get("bit_exact", True) for r in results["results"]) else 1
+
+    if args.command == "bench":
+        results = run_benchmarks(workdir=args.media, resolutions=args.res, quick=args.quick,
+                                 only=args.only, duration=args.duration, fps=args.fps)
+        for path in (args.out, args.save_baseline):
+            if path:
+                with open(path, "w", encoding="utf-8") as f:
+                    json.dump(results, f, indent=2, ensure_ascii=False)
+        if args.baseline:
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                lines, regressions = compare_benchmarks(results, json.load(f), args.tolerance)
+            print(f"Confronto con {args.baseline}:")
+            print("\n".join(lines))
+            if regressions:
+                print(f"{len(regressions)} casi peggiorati oltre {args.tolerance:.0%}.")
+                return 1
+        return 0 if all("error" not in r for r in results["results"]) else 1
+
+    if args.command == "worker":
+        run_render_worker(RenderQueue(args.db, args.max_workers))
+        return 0
+
+    if os.path.isdir(args.job):
+        job_paths = sorted(
+            os.path.join(args.job, f) for f in os.listdir(args.job)
+            if f.lower().endswith((".json", ".yaml", ".yml"))
+        )
+    else:
+        job_paths = [args.job]
+    if not job_paths:
+        parser.error(f"Nessun job in {args.job}")
+
+    if args.jobs > 1 and len(job_paths) > 1:
+        # Un processo per job: ogni render tiene aperti i propri decoder
+        # ffmpeg e la propria copia dei frame, niente GIL condiviso.
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(args.jobs, len(job_paths))) as pool:
+            summaries = list(pool.map(_render_job, job_paths, [args.out] * len(job_paths)))
+    else:
+        summaries = [_render_job(p, args.out) for p in job_paths]
+
+    print(json.dumps(summaries if len(summaries) > 1 else summaries[0], indent=2, ensure_ascii=False))
+    return 0 if all(s["ok"] for s in summaries) else 1
+
+
 def main():
+    _rerun_lap("setup pagina")
     st.set_page_config(page_title="VideoDecomposer PRO", layout="wide")
     st.title("VideoDecomposer: Rendering & Report")
 
@@ -1920,21 +6382,33 @@ def main():
                      ('video_path', ''), ('preview_path', ''), ('render_name', 'loop507_render')]:
         if key not in st.session_state:
             st.session_state[key] = val
+    # Job in background: dopo una riconnessione (nuova sessione, stesso
+    # link) id del job e token (_job_owner) arrivano dall'URL e il
+    # risultato si ritrova.
+    if "render_job" not in st.session_state:
+        st.session_state.render_job = st.query_params.get("job")
 
+    _rerun_lap("sidebar: sorgenti e audio")
     with st.sidebar:
         st.header("Sorgenti")
         files = [st.file_uploader(f"Video {i+1}", type=["mp4","mov"]) for i in range(4)]
+        if any(files):
+            with st.expander("Filmstrip sorgenti", expanded=False):
+                for i, f in enumerate(files):
+                    if f:
+                        _strip = get_source_filmstrip(_upload_store().put(f))
+                        if _strip is None:
+                            st.caption(f"Video {i+1}: anteprima non disponibile.")
+                        else:
+                            st.image(_strip, caption=f"Video {i+1}", use_container_width=True)
         st.divider()
         audio_file = st.file_uploader("Audio (mp3/wav)", type=["mp3","wav"])
         if audio_file is not None:
-            audio_key = f"bpm_{audio_file.name}_{audio_file.size}"
-            if st.session_state.get("_bpm_key") != audio_key:
-                with st.spinner("Analisi BPM..."):
-                    _bpm = detect_bpm(audio_file)
-                st.session_state["detected_bpm"] = _bpm
-                st.session_state["_bpm_key"] = audio_key
+            _audio_path = _upload_store().put(audio_file)
+            if st.session_state.get("_bpm_key") != _audio_path:
+                st.session_state["_bpm_key"] = _audio_path
                 st.session_state["manual_bpm_input"] = 0.0  # nuovo brano: azzera l'eventuale BPM manuale del brano precedente
-            detected_bpm = st.session_state.get("detected_bpm")
+            detected_bpm = st.session_state["detected_bpm"] = _cached_bpm(_audio_path)
             if detected_bpm:
                 st.caption(f"_BPM rilevato: **{detected_bpm:.1f}**_")
             _manual_bpm = st.number_input(
@@ -1974,6 +6448,7 @@ def main():
         else:
             detected_bpm = None
             fast_audio_analysis = False
+        _rerun_lap("sidebar: modalita'")
         st.divider()
         st.subheader("Modalita'")
         app_mode = st.radio("Modalita'", ["Decompose", "VJ Mode"], horizontal=True, label_visibility="collapsed")
@@ -1987,6 +6462,7 @@ def main():
     weights = {}
     quotas  = {}
 
+    _rerun_lap("colonna 1: mix sorgenti")
     with c1:
         loaded = [i for i in range(4) if files[i]]
         default_quota = round(100 / len(loaded)) if loaded else 25
@@ -2013,25 +6489,11 @@ def main():
             st.markdown("---")
             preview_slot_vd = st.container()
 
+    _rerun_lap("colonna 2: parametri")
     with c2:
         if app_mode == "Decompose":
             st.subheader("Ritmo e Strisce")
 
-            # Preset "automatici" — combinano in un colpo solo ritmo dei tagli
-            # e spessore/asse delle strisce, sul modello di VJ_PRESETS in VJ
-            # Mode. Non richiedono audio: sono solo scorciatoie di stile per
-            # evitare di tarare a mano min/max e px ogni volta.
-            DECOMPOSE_PRESETS = {
-                "Lento Cinematico":    dict(r_a=0.8,  r_b=2.0, r_rand=True,
-                                             s_a=20, s_b=60,  s_rand=False, scan_dir="Orizzontale"),
-                "Standard Bilanciato": dict(r_a=0.2,  r_b=1.0, r_rand=True,
-                                             s_a=10, s_b=80,  s_rand=True,  scan_dir="Mix"),
-                "Nervoso Glitch":      dict(r_a=0.1,  r_b=0.4, r_rand=True,
-                                             s_a=5,  s_b=40,  s_rand=True,  scan_dir="Verticale"),
-                "Random Estremo":      dict(r_a=0.05, r_b=3.0, r_rand=True,
-                                             s_a=1,  s_b=150, s_rand=True,  scan_dir="Mix"),
-            }
-
             auto_decompose = st.toggle(
                 "Automatico",
                 value=False,
@@ -2148,24 +6610,6 @@ def main():
             if audio_file is None:
                 st.caption("_Carica un audio nella sidebar per attivare la modalita' automatica._")
 
-            # Preset per genere musicale — valori tarati su stutter/loop/crossfade/freeze.
-            # "subdiv" e' la misura beat di base (in unita' MEASURE_FACTORS) usata in
-            # automatico: prima non esisteva, e il default generico (bpm_to_default_
-            # subdivision) raggruppava 4 beat per slice per QUALSIASI genere a tempo
-            # medio/alto — quindi "Techno" tagliava alla stessa grana lenta di
-            # "Ambient", niente affatto reattivo.
-            VJ_PRESETS = {
-                "Techno":   dict(loop_reps=3, stutter_prob=0.50, pitch_glitch=False,
-                                  crossfade_ms=40,  freeze_prob=0.35, freeze_ms=100, subdiv=0.5),
-                "House":    dict(loop_reps=2, stutter_prob=0.30, pitch_glitch=False,
-                                  crossfade_ms=100, freeze_prob=0.20, freeze_ms=150, subdiv=1.0),
-                "Ambient":  dict(loop_reps=1, stutter_prob=0.10, pitch_glitch=False,
-                                  crossfade_ms=250, freeze_prob=0.10, freeze_ms=300, subdiv=2.0),
-                "Pop":      dict(loop_reps=2, stutter_prob=0.25, pitch_glitch=False,
-                                  crossfade_ms=80,  freeze_prob=0.20, freeze_ms=150, subdiv=1.0),
-                "Classica": dict(loop_reps=1, stutter_prob=0.05, pitch_glitch=False,
-                                  crossfade_ms=300, freeze_prob=0.08, freeze_ms=250, subdiv=4.0),
-            }
             if auto_vj:
                 vj_genre = st.selectbox(
                     "Stile musicale",
@@ -2292,10 +6736,6 @@ def main():
                 slice_density = 1.0
                 react_to_peaks = True
                 _auto_coarsen = 1.0
-                _auto_loop_reps_cap = None
-                _auto_freeze_cap = None
-                _loop_reps_est = None
-                _freeze_prob_est = None
             else:
                 manual_duration_mode = "fixed"
                 manual_duration_choices = None
@@ -2448,6 +6888,7 @@ def main():
                     if slice_density_pct < 100:
                         st.caption(f"_Solo il {slice_density_pct}% dei beat genera un taglio — il resto continua sulla stessa sorgente._")
 
+            _rerun_lap("colonna 2: stima frammenti")
             # --- Stima frammenti previsti (avviso per brani lunghi) ---
             # fragments_per_beat = 1/sv sia per sv<1 (uno slice diventa
             # 1/sv frammenti) sia per sv>=1 (sv beat vengono accorpati
@@ -2471,93 +6912,29 @@ def main():
                 _factors_est = beat_subdivision_choices or [1.0]
             _mean_fpb = sum(1.0 / f for f in _factors_est) / len(_factors_est)
 
-            # Lo stutter (loop_reps/stutter_prob) e il freeze (freeze_on_beat/
-            # freeze_prob) NON sono ancora stati letti dai widget qui
-            # (vengono dopo nel codice), ma i loro valori sono gia' in
-            # session_state da un run precedente (o dal preset, al primo
-            # run) — leggibili comunque per stimare.
-            # Servono perche' uno slice stutterato non e' UN oggetto, ne
-            # sono 'loop_reps' (Techno: stutter 50%, loop x3 -> quasi il
-            # doppio degli oggetti reali rispetto al numero di tagli), e
-            # ogni freeze aggiunge un ImageClip in piu' nella sequenza
-            # (Techno: freeze_prob 35%, ON di default in automatico).
-            # Senza questi due fattori la stima sottovaluta pesantemente
-            # gli oggetti reali che moviepy deve tenere in memoria — ed e'
-            # esattamente quello che ha reso insufficiente il primo
-            # tentativo di auto-coarsening (contava solo lo stutter, non
-            # il freeze).
-            _loop_reps_est = st.session_state.get(
-                f"loop_reps_{vj_genre}",
-                preset["loop_reps"] if (auto_vj and preset) else 2
-            )
-            _stutter_prob_est = st.session_state.get(
-                f"stutter_prob_{vj_genre}",
-                int(preset["stutter_prob"] * 100) if (auto_vj and preset) else 40
-            ) / 100.0
-            _freeze_on_est = st.session_state.get(f"freeze_on_beat_{vj_genre}", auto_vj)
-            _freeze_prob_est = st.session_state.get(
-                f"freeze_prob_{vj_genre}",
-                int(preset["freeze_prob"] * 100) if (auto_vj and preset) else 20
-            ) / 100.0 if _freeze_on_est else 0.0
-
-            def _calc_est(base, lr, sp, fp):
-                # +1 oggetto extra ogni 'lr-1' ripetizioni stutterate, +1
-                # oggetto (piu' leggero, ImageClip) ogni freeze: additivi,
-                # non moltiplicati tra loro (sono eventi indipendenti per
-                # slice, non concatenati l'uno dentro l'altro).
-                mult = 1.0 + sp * max(0, lr - 1) + fp
-                return int(base * mult)
-
-            _base_est = int(_beats_est * slice_density * _mean_fpb)  # SOLO i tagli: la grana che l'utente vuole tenere il piu' fine possibile
-            _est_fragments = _calc_est(_base_est, _loop_reps_est, _stutter_prob_est, _freeze_prob_est)
-
-            # --- Auto-adattamento (solo in automatico), priorita' a 3 livelli ---
-            # "Automatico" deve restare il piu' fine e reattivo possibile sul
-            # taglio (piccolo, a tempo di BPM) — quindi si riduce PRIMA tutto
-            # cio' che non tocca la grana del taglio (stutter, poi freeze), e
-            # SOLO se anche cosi' non basta si allarga la subdivisione
-            # (ultima risorsa, tagli piu' grandi). Soglia abbassata rispetto
-            # al primo tentativo (era 800, ora 500): la stima precedente
-            # aveva gia' sottostimato una volta (freeze non contato), meglio
-            # tenere piu' margine reale che tarare al millimetro su un numero
-            # di cui non abbiamo certezza assoluta.
+            # Lo stutter (loop_reps/stutter_prob) e il freeze (freeze_prob)
+            # NON entrano piu' nella stima: prima uno slice stutterato erano
+            # 'loop_reps' clip concatenati e ogni freeze un ImageClip in piu',
+            # quindi pesavano sugli oggetti che MoviePy teneva in memoria (e
+            # in automatico venivano ridotti d'ufficio per RAM safety). Ora
+            # sono mappe di tempo sullo stesso Fragment (vedi Fragment.
+            # src_offset): costo identico a un frammento normale, nessun
+            # motivo di toccare i valori scelti dall'utente o dal preset.
+            _est_fragments = int(_beats_est * slice_density * _mean_fpb)
+
+            # --- Auto-adattamento (solo in automatico) ---
+            # Resta solo l'ultima risorsa: se i TAGLI da soli superano la
+            # soglia di sicurezza, si allarga la subdivisione.
             _auto_coarsen = 1.0
-            _auto_loop_reps_cap = None
-            _auto_freeze_cap = None
             _SAFE_TARGET = 500
             if auto_vj and _est_fragments > _SAFE_TARGET:
-                _lr, _fp = _loop_reps_est, _freeze_prob_est
-                _base_work = _base_est
-
-                if _base_work > _SAFE_TARGET:
-                    # anche a stutter/freeze zero i tagli da soli sfondano:
-                    # qui non c'e' alternativa, va allargata la subdivisione
-                    while _auto_coarsen < 8.0 and (_base_work / _auto_coarsen) > _SAFE_TARGET:
-                        _auto_coarsen *= 2.0
-                    _base_work = int(_base_work / _auto_coarsen)
-
-                # Livello 1: riduci lo stutter (i tagli restano quelli scelti dal BPM)
-                while _lr > 1 and _calc_est(_base_work, _lr, _stutter_prob_est, _fp) > _SAFE_TARGET:
-                    _lr -= 1
-                # Livello 2: se non basta, riduci anche il freeze
-                while _fp > 0.0 and _calc_est(_base_work, _lr, _stutter_prob_est, _fp) > _SAFE_TARGET:
-                    _fp = max(0.0, _fp - 0.1)
-
-                _auto_loop_reps_cap = _lr
-                _auto_freeze_cap = _fp
-                _est_fragments_adj = _calc_est(_base_work, _lr, _stutter_prob_est, _fp)
-
-                _parts = []
-                if _auto_coarsen > 1.0:
-                    _parts.append(f"subdivisione allargata x{_auto_coarsen:.0f}")
-                if _lr < _loop_reps_est:
-                    _parts.append(f"loop stutter ridotto da x{_loop_reps_est} a x{_lr}")
-                if _fp < _freeze_prob_est:
-                    _parts.append(f"probabilita' freeze ridotta da {int(_freeze_prob_est*100)}% a {int(_fp*100)}%")
+                while _auto_coarsen < 8.0 and (_est_fragments / _auto_coarsen) > _SAFE_TARGET:
+                    _auto_coarsen *= 2.0
+                _est_fragments_adj = int(_est_fragments / _auto_coarsen)
                 st.info(
-                    "ℹ️ Automatico: " + ", ".join(_parts) +
+                    f"ℹ️ Automatico: subdivisione allargata x{_auto_coarsen:.0f}"
                     " per restare sotto la soglia di sicurezza RAM. "
-                    f"Oggetti stimati ~{_est_fragments} → ~{_est_fragments_adj}."
+                    f"Frammenti stimati ~{_est_fragments} → ~{_est_fragments_adj}."
                 )
                 _est_fragments = _est_fragments_adj
 
@@ -2584,13 +6961,6 @@ def main():
                 key=f"loop_reps_{vj_genre}",
                 help="Quante volte uno slice viene ripetuto. 1 = nessun loop."
             )
-            if auto_vj and _auto_loop_reps_cap is not None and _auto_loop_reps_cap < loop_reps:
-                # Il valore mostrato nello slider resta quello del preset (lo
-                # slider e' un widget con la sua key, non lo tocchiamo) ma il
-                # valore EFFETTIVAMENTE usato dal motore e' quello ridotto
-                # dall'auto-adattamento sopra — gia' spiegato all'utente col
-                # st.info() poco fa.
-                loop_reps = _auto_loop_reps_cap
             stutter_prob = st.slider(
                 "Probabilita' stutter %", min_value=0, max_value=100,
                 value=int(preset["stutter_prob"] * 100) if auto_vj else 40,
@@ -2607,6 +6977,7 @@ def main():
             st.markdown("---")
             mod_lab_on = False
             mod_matrix_amount = 0.35
+            _rerun_lap("colonna 2: banda selettiva 1")
             if MODULATION_LAB_AVAILABLE:
                 mod_lab_on = st.checkbox(
                     "🧪 Modulation Lab (beta): micro-variazione start su onset",
@@ -2813,17 +7184,16 @@ def main():
                     "il resto dell'app funziona normalmente)._"
                 )
 
+            _rerun_lap("anteprima: banda 1")
             with preview_slot_vd:
                 st.subheader("Anteprima")
                 _prev_idx = next((i for i in range(4) if files[i]), None)
                 if _prev_idx is None:
                     st.caption("Carica almeno un video per vedere l'anteprima.")
                 else:
-                    _prev_cache_key = f"{files[_prev_idx].name}_{files[_prev_idx].size}"
-                    if st.session_state.get("_vd_preview_key") != _prev_cache_key:
-                        st.session_state["_vd_preview_frame"] = get_preview_frame_from_upload(files[_prev_idx])
-                        st.session_state["_vd_preview_key"] = _prev_cache_key
-                    _prev_frame = st.session_state.get("_vd_preview_frame")
+                    # Frame dalla cache miniature (per contenuto): niente
+                    # ffmpeg ai rerun successivi.
+                    _prev_frame = get_thumbnail(_upload_store().put(files[_prev_idx]))
                     if _prev_frame is None:
                         st.caption("Impossibile leggere un frame di anteprima da questo video.")
                     else:
@@ -2840,13 +7210,9 @@ def main():
                                         _stripe_prev_source = files[_si]
                                         break
                             if _stripe_prev_source is not None:
-                                _sprev_cache_key = f"{_stripe_prev_source.name}_{_stripe_prev_source.size}"
-                                if st.session_state.get("_vd_stripe_preview_key") != _sprev_cache_key:
-                                    st.session_state["_vd_stripe_preview_frame"] = get_preview_frame_from_upload(
-                                        _stripe_prev_source, max_w=pw
-                                    )
-                                    st.session_state["_vd_stripe_preview_key"] = _sprev_cache_key
-                                _stripe_prev_frame = st.session_state.get("_vd_stripe_preview_frame")
+                                _stripe_prev_frame = get_thumbnail(
+                                    _upload_store().put(_stripe_prev_source), max_w=pw
+                                )
                                 if _stripe_prev_frame is None:
                                     st.warning(
                                         "⚠️ La sorgente scelta per la striscia non è leggibile "
@@ -2938,6 +7304,7 @@ def main():
                         # all'immagine combinata banda1+banda2 (_pf_2 = _pf).
 
             st.markdown("---")
+            _rerun_lap("colonna 2: banda selettiva 2")
             if MODULATION_LAB_AVAILABLE:
                 with st.expander("🎞️ Banda selettiva 2 (beta)", expanded=False):
                     stripe_mod_on_2 = st.checkbox(
@@ -3122,6 +7489,7 @@ def main():
                     "il resto dell'app funziona normalmente)._"
                 )
 
+            _rerun_lap("anteprima: banda 2")
             with preview_slot_vd:
                 # Riusa lo STESSO frame gia' preparato (ed eventualmente gia'
                 # modificato dalla banda 1) sopra: cosi' l'anteprima finale
@@ -3143,13 +7511,9 @@ def main():
                                     _stripe_prev_source_2 = files[_si_2]
                                     break
                         if _stripe_prev_source_2 is not None:
-                            _sprev_cache_key_2 = f"{_stripe_prev_source_2.name}_{_stripe_prev_source_2.size}"
-                            if st.session_state.get("_vd_stripe_preview_key_2") != _sprev_cache_key_2:
-                                st.session_state["_vd_stripe_preview_frame_2"] = get_preview_frame_from_upload(
-                                    _stripe_prev_source_2, max_w=pw_2
-                                )
-                                st.session_state["_vd_stripe_preview_key_2"] = _sprev_cache_key_2
-                            _stripe_prev_frame_2 = st.session_state.get("_vd_stripe_preview_frame_2")
+                            _stripe_prev_frame_2 = get_thumbnail(
+                                _upload_store().put(_stripe_prev_source_2), max_w=pw_2
+                            )
                             if _stripe_prev_frame_2 is None:
                                 st.warning(
                                     "⚠️ La sorgente scelta per la striscia non è leggibile "
@@ -3295,7 +7659,7 @@ def main():
                                      "Dopo la cattura puoi spostarla liberamente con "
                                      "'Posizione banda' senza che cambi più nel tempo."
                             ):
-                                _hq_frame = get_preview_frame_from_upload(_stripe_prev_source, max_w=1920)
+                                _hq_frame = get_thumbnail(_upload_store().put(_stripe_prev_source), max_w=1920)
                                 if _hq_frame is None:
                                     st.warning(
                                         "⚠️ Non sono riuscito a rileggere il video ad alta "
@@ -3388,7 +7752,7 @@ def main():
                                      "Dopo la cattura puoi spostarla liberamente con "
                                      "'Posizione banda' senza che cambi più nel tempo."
                             ):
-                                _hq_frame_2 = get_preview_frame_from_upload(_stripe_prev_source_2, max_w=1920)
+                                _hq_frame_2 = get_thumbnail(_upload_store().put(_stripe_prev_source_2), max_w=1920)
                                 if _hq_frame_2 is None:
                                     st.warning(
                                         "⚠️ Non sono riuscito a rileggere il video ad alta "
@@ -3441,6 +7805,7 @@ def main():
                                      "Despunta per tornare a mostrare il video dal vivo."
                             )
 
+            _rerun_lap("colonna 2: crossfade, freeze, deck")
             st.markdown("---")
             crossfade_on = st.toggle(
                 "Crossfade tra slice", value=auto_vj,
@@ -3472,12 +7837,6 @@ def main():
                     help="Percentuale dei beat reali rilevati nell'audio su cui scatta "
                          "il freeze-frame (ancorato al beat, non casuale)."
                 ) / 100.0
-                if auto_vj and _auto_freeze_cap is not None and _auto_freeze_cap < freeze_prob:
-                    # Stessa logica del cap su loop_reps: lo slider resta
-                    # com'e' visivamente, il valore usato dal motore e'
-                    # quello ridotto dall'auto-adattamento (gia' spiegato
-                    # nel st.info() sopra).
-                    freeze_prob = _auto_freeze_cap
                 freeze_ms = st.slider(
                     "Durata freeze (ms)", min_value=50, max_value=500,
                     value=preset["freeze_ms"] if auto_vj else 150, step=10,
@@ -3523,6 +7882,7 @@ def main():
             r_rand = False; r_a = 0.2; r_b = 1.0
             use_scan = False; s_rand = False; s_a = 10; s_b = 80; scan_dir = "Orizzontale"
 
+    _rerun_lap("colonna 3: esportazione")
     with c3:
         st.subheader("Esportazione")
         durata = st.number_input("Durata Totale (s)", 5, 300, 15, key="durata_input")
@@ -3536,7 +7896,62 @@ def main():
                  "questa risoluzione invece che a piena risoluzione nativa — piu' "
                  "leggero e meno a rischio OOM su video lunghi o piu' sorgenti insieme."
         )
-        export_size = EXPORT_SIZES.get(formato_label)
+        seek_aware = st.toggle(
+            "Tagli vicino ai keyframe",
+            value=False,
+            key="seek_aware_toggle",
+            help="Ogni taglio resta nella stessa zona del video scelta "
+                 "dall'anti-ripetizione, ma parte preferibilmente poco dopo un "
+                 "keyframe: ffmpeg decodifica molti meno frame a vuoto per "
+                 "arrivarci. Differenza grande sui video da telefono (keyframe "
+                 "ogni parecchi secondi), quasi nulla su video gia' fitti di keyframe."
+        )
+        prefetch_depth = st.slider(
+            "Decode-ahead (frame per sorgente)", 0, 48, PREFETCH_DEPTH, step=4,
+            key="prefetch_depth_slider",
+            help="Durante la scrittura un thread per sorgente decodifica in anticipo "
+                 "i frame dei prossimi tagli, mentre il render applica gli effetti e "
+                 "codifica. Piu' alto = piu' margine sui seek lenti, ma piu' RAM "
+                 "(~2.7 MB per frame a 720p). 0 = disattivato. Riempimento della coda "
+                 "e attese nel report di profilazione."
+        )
+        frame_cache = st.toggle(
+            "Cache frame raw (sorgenti corte)",
+            value=True,
+            key="frame_cache_toggle",
+            help="Le sorgenti da cui il montaggio taglia molti frammenti vengono "
+                 "decodificate una volta sola, gia' al formato e all'fps di export, in "
+                 f"un file su disco (max {FRAME_CACHE_MAX_SOURCE_BYTES // 1024 ** 2} MB per "
+                 f"sorgente, {FRAME_CACHE_MAX_BYTES / 1024 ** 3:.0f} GB in tutto): niente "
+                 "seek ripetuti. Si attiva da sola solo dove conviene."
+        )
+        encoder_color = st.toggle(
+            "Colore/saturazione nell'encoder",
+            value=True,
+            key="encoder_color_toggle",
+            help="Colore e saturazione reattivi al beat applicati da ffmpeg mentre "
+                 "codifica (filtri lutrgb/colorchannelmixer pilotati da sendcmd), "
+                 "non in Python frame per frame. Stesso risultato a meno di 1-3 "
+                 "livelli sulla saturazione. Spento = path numpy di sempre."
+        )
+        jit_kernels_on = st.toggle(
+            "Kernel JIT (Numba)",
+            value=JIT_KERNELS_AVAILABLE,
+            disabled=not JIT_KERNELS_AVAILABLE,
+            key="jit_kernels_toggle",
+            help="Blend delle bande selettive compilato con Numba, su piu' "
+                 "core. Stesso identico risultato del path numpy; "
+                 "il primo render della sessione compila i kernel (qualche secondo)."
+                 + ("" if JIT_KERNELS_AVAILABLE else " Numba non installato.")
+        )
+        effect_threads = st.slider(
+            "Thread per frame (effetti)", 1, max(4, os.cpu_count() or 1), EFFECT_THREADS,
+            key="effect_threads_slider",
+            help="Colore, saturazione, bande selettive, bande temporali e slit scan "
+                 "divisi in fasce di righe su piu' core (numpy rilascia il GIL). "
+                 "Stesso identico risultato con qualunque valore; 1 = tutto nel "
+                 "thread del render. Scalabilita' misurabile con bench-effects."
+        )
         st.markdown("---")
 
         if app_mode == "Decompose":
@@ -3546,7 +7961,6 @@ def main():
             beat_sync = False
             st.caption("_Beat sync disponibile in modalita' Decompose._")
 
-        use_custom_audio = False
         audio_mix_mode = "custom_only"
         vol_music = 1.0
         vol_original = 1.0
@@ -3562,19 +7976,15 @@ def main():
             )
             if audio_mix_choice == "Solo musica caricata":
                 audio_mix_mode = "custom_only"
-                use_custom_audio = True
             elif audio_mix_choice == "Musica decomposta (stessi tagli del video)":
                 audio_mix_mode = "custom_decomposed"
-                use_custom_audio = True
                 st.caption("_Il brano viene tagliato e rimescolato con la stessa griglia "
                            "ritmica del video: ogni slice video pesca un punto a caso "
                            "diverso nel brano. Stesso ritmo, contenuto decomposto._")
             elif audio_mix_choice == "Solo audio originale dei video":
                 audio_mix_mode = "original_only"
-                use_custom_audio = False
             elif audio_mix_choice == "Mix decomposto (musica decomposta + originale)":
                 audio_mix_mode = "mix_decomposed"
-                use_custom_audio = True
                 st.caption("_Come 'Musica decomposta', ma mixata con l'audio originale "
                            "dei video invece di sostituirlo._")
                 col_v1, col_v2 = st.columns(2)
@@ -3584,7 +7994,6 @@ def main():
                     vol_original = st.slider("Volume audio originale", 0, 200, 100, step=5) / 100.0
             else:
                 audio_mix_mode = "mix"
-                use_custom_audio = True
                 col_v1, col_v2 = st.columns(2)
                 with col_v1:
                     vol_music = st.slider("Volume musica caricata", 0, 200, 100, step=5) / 100.0
@@ -3645,622 +8054,161 @@ def main():
 
         st.markdown("---")
 
+        def _ui_config(store, paths):
+            # RenderConfig dai widget qui sopra: lo stesso per il render e
+            # per la timeline di scrubbing.
+            cfg = RenderConfig(
+                sources=paths,
+                audio=store.put(audio_file) if audio_file else None,
+                audio_name=audio_file.name if audio_file else None,
+                app_mode=app_mode,
+                duration=durata,
+                fps=fps,
+                formato_label=formato_label,
+                fast_audio_analysis=fast_audio_analysis,
+                seek_aware=seek_aware,
+                prefetch_depth=prefetch_depth,
+                frame_cache=frame_cache,
+                encoder_color=encoder_color,
+                jit_kernels=jit_kernels_on,
+                effect_threads=effect_threads,
+                bpm=detected_bpm,
+                bpm_manual=st.session_state.get("manual_bpm_input", 0.0) > 0,
+                # Decompose (in VJ Mode: i default impostati sopra)
+                mix_mode=mix_mode or "Random", weights=weights, quotas=quotas,
+                r_a=r_a, r_b=r_b, r_rand=r_rand, use_scan=use_scan,
+                s_a=s_a, s_b=s_b, s_rand=s_rand, scan_dir=scan_dir, beat_sync=beat_sync,
+                # VJ Mode (in Decompose: i default impostati sopra)
+                auto_vj=auto_vj, slice_dur=slice_dur, loop_reps=loop_reps,
+                stutter_prob=stutter_prob, pitch_glitch=pitch_glitch,
+                beat_slice_mode=beat_slice_mode, crossfade_dur=crossfade_dur,
+                freeze_on_beat=freeze_on_beat, freeze_prob=freeze_prob, freeze_dur=freeze_dur,
+                slice_density=slice_density,
+                beat_subdivision_mode=beat_subdivision_mode,
+                beat_subdivision_factor=beat_subdivision_factor,
+                beat_subdivision_choices=beat_subdivision_choices,
+                manual_duration_mode=manual_duration_mode,
+                manual_duration_choices=manual_duration_choices,
+                react_to_peaks=react_to_peaks,
+                # Audio e post-processing
+                audio_mix_mode=audio_mix_mode, vol_music=vol_music, vol_original=vol_original,
+                color_react_amount=color_react_amount,
+                saturation_react_amount=saturation_react_amount,
+                temporal_bands_on=temporal_bands_on, tb_intensity=tb_intensity,
+                tb_ampiezza=tb_ampiezza, tb_spostamento=tb_spostamento, tb_direzione=tb_direzione,
+            )
+            if app_mode == "VJ Mode":
+                cfg.vj_genre = vj_genre
+                cfg.cut_source = cut_source
+                cfg.source_mode = source_mode
+                cfg.source_weights = source_weights
+                cfg.no_repeat = no_repeat
+                cfg.subdivision_coarsen = _auto_coarsen
+                cfg.mod_lab_on = mod_lab_on
+                cfg.mod_matrix_amount = mod_matrix_amount
+
+                def _stripe_source(choice, video_file):
+                    # Scelta del radio -> StripeConfig.source: None
+                    # (fallback), indice di uno dei video gia' caricati
+                    # (si riusa il path gia' scritto su disco in 'paths')
+                    # oppure path del video caricato apposta.
+                    if choice == "Carica video separato":
+                        if video_file is None:
+                            return None
+                        try:
+                            return store.put(video_file)
+                        except Exception as _e:
+                            st.warning(f"⚠️ Video striscia non leggibile ({_e}): uso il fallback.")
+                            return None
+                    # "Video N (nome file)" -> uno dei 4 gia' caricati.
+                    for _si in range(4):
+                        if choice.startswith(f"Video {_si+1} ") and _si in paths:
+                            return _si
+                    return None
+
+                if MODULATION_LAB_AVAILABLE and stripe_mod_on:
+                    cfg.stripes.append(StripeConfig(
+                        pct=stripe_mod_pct, pos=stripe_mod_pos, orient=stripe_mod_orient,
+                        offset_s=stripe_mod_offset_s, amount=stripe_mod_amount,
+                        base_opacity=stripe_base_opacity,
+                        length_pct=stripe_length_pct, length_pos_pct=stripe_length_pos_pct,
+                        content_follows=stripe_content_follows,
+                        content_anchor_pos=stripe_content_anchor_pos,
+                        content_anchor_length_pos=stripe_content_anchor_length_pos,
+                        source=_stripe_source(stripe_source_choice, stripe_video_file),
+                        frozen_content=stripe_frozen_crop if stripe_use_frozen else None,
+                    ))
+                if MODULATION_LAB_AVAILABLE and stripe_mod_on_2:
+                    cfg.stripes.append(StripeConfig(
+                        pct=stripe_mod_pct_2, pos=stripe_mod_pos_2, orient=stripe_mod_orient_2,
+                        offset_s=stripe_mod_offset_s_2, amount=stripe_mod_amount_2,
+                        base_opacity=stripe_base_opacity_2,
+                        length_pct=stripe_length_pct_2, length_pos_pct=stripe_length_pos_pct_2,
+                        content_follows=stripe_content_follows_2,
+                        content_anchor_pos=stripe_content_anchor_pos_2,
+                        content_anchor_length_pos=stripe_content_anchor_length_pos_2,
+                        source=_stripe_source(stripe_source_choice_2, stripe_video_file_2),
+                        frozen_content=stripe_frozen_crop_2 if stripe_use_frozen_2 else None,
+                    ))
+
+            return cfg
+
+        _rerun_lap("colonna 3: avvio render")
         do_final = st.button("AVVIA RENDERING", use_container_width=True)
+        do_scrub = st.button(
+            "PREPARA TIMELINE", use_container_width=True,
+            help="Pianifica il montaggio con le impostazioni attuali senza "
+                 "scriverlo: uno slider mostra il frame finale (effetti "
+                 "compresi) a qualunque istante. Il rendering successivo "
+                 "usa lo stesso montaggio finche' la timeline resta aperta."
+        )
 
-        if do_final:
-            run_durata = durata
-            export_size_run = export_size
-
-            paths = {i: tempfile.NamedTemporaryFile(delete=False, suffix='.mp4').name
-                     for i, f in enumerate(files) if f}
-            for i, f in enumerate(files):
-                if f:
-                    with open(paths[i], "wb") as tf: tf.write(f.read())
+        if do_final or do_scrub:
+            # render() lavora solo su path: sorgenti, brano e video delle
+            # strisce arrivano dall'archivio upload (scritti una volta,
+            # condivisi tra job e sessioni, rimossi dall'eviction).
+            store = _upload_store()
+            paths = {i: store.put(f) for i, f in enumerate(files) if f}
 
             if not paths:
                 st.error("Carica almeno un video!")
                 return
 
-            p_bar = st.progress(0, text="Avvio...")
-            beat_times      = None
-            rms_envelope    = None
-            decompose_band_envelope = None
-            vj_rms_envelope = None
-            vj_band_envelope = None
-            vj_onset_times  = None
-            beat_count    = 0
-            engine        = None
-            tmp_audio_path = None
-            total_frags   = 0
-            cut_schedule  = None
-            _prof = {}  # profilazione render: {stage: secondi}
-            _t_stage = time.perf_counter()
+            cfg = _ui_config(store, paths)
+            # Stesso seed della timeline aperta: il render scrive il
+            # montaggio che si e' appena sfogliato.
+            cfg.seed = st.session_state.get("scrub_seed")
 
+        if do_scrub:
+            _close_scrub_server()
+            cfg.seed = random.randrange(2 ** 31)
             try:
-                # Analisi audio: Decompose beat sync OPPURE VJ Mode beat slice.
-                # Sempre calcolata sulla durata PIENA e tenuta in cache: se si
-                # rigenera il render cambiando solo un parametro (stutter,
-                # subdivisione...) non si rifa' da capo beat-tracking/HPSS,
-                # che e' il pezzo piu' lento.
-                _audio_cache_key = (
-                    getattr(audio_file, "name", None), getattr(audio_file, "size", None), round(durata, 2), fast_audio_analysis
-                ) if audio_file else None
-
-                if app_mode == "Decompose" and (beat_sync or color_react_amount > 0 or saturation_react_amount > 0) and audio_file:
-                    if _audio_cache_key and st.session_state.get("_audio_cache_key") == _audio_cache_key:
-                        beat_times, rms_envelope, decompose_band_envelope = st.session_state["_audio_cache"]
-                    else:
-                        p_bar.progress(0.05, text="Analisi audio...")
-                        beat_times, rms_envelope, decompose_band_envelope, _ = analyze_audio(audio_file, durata, fast_mode=fast_audio_analysis)
-                        st.session_state["_audio_cache_key"] = _audio_cache_key
-                        st.session_state["_audio_cache"] = (beat_times, rms_envelope, decompose_band_envelope)
-                    beat_count = len(beat_times)
-                elif app_mode == "VJ Mode" and (beat_slice_mode or freeze_on_beat or color_react_amount > 0 or saturation_react_amount > 0 or mod_lab_on or stripe_mod_on or stripe_mod_on_2) and audio_file:
-                    if _audio_cache_key and st.session_state.get("_vj_audio_cache_key") == _audio_cache_key:
-                        beat_times, vj_rms_envelope, vj_band_envelope, vj_onset_times = st.session_state["_vj_audio_cache"]
-                    else:
-                        p_bar.progress(0.05, text="Analisi beat...")
-                        audio_file.seek(0)
-                        beat_times, vj_rms_envelope, vj_band_envelope, vj_onset_times = analyze_audio(audio_file, durata, fast_mode=fast_audio_analysis)
-                        audio_file.seek(0)  # reset per eventuale uso audio custom dopo
-                        st.session_state["_vj_audio_cache_key"] = _audio_cache_key
-                        st.session_state["_vj_audio_cache"] = (beat_times, vj_rms_envelope, vj_band_envelope, vj_onset_times)
-                    beat_count = len(beat_times)
-
-                _prof["Analisi Audio"] = time.perf_counter() - _t_stage
-                _t_stage = time.perf_counter()
-
-                engine = VideoEngine()
-                engine.load_sources(paths, target_size=export_size_run)
-
-                _prof["Caricamento Sorgenti"] = time.perf_counter() - _t_stage
-                _t_stage = time.perf_counter()
-
-                if app_mode == "Decompose":
-                    # generate()/generate_fixed_quota() non hanno un flag
-                    # 'beat_sync' interno: se beat_times/rms_envelope non
-                    # sono vuoti, i tagli e le strisce si sincronizzano
-                    # all'audio a prescindere. Da quando l'analisi audio
-                    # puo' partire anche solo per colore/saturazione (senza
-                    # beat_sync attivo), vanno passati None esplicitamente
-                    # se l'utente NON ha richiesto il beat sync — altrimenti
-                    # taglio E strisce si riattiverebbero da soli in
-                    # silenzio insieme al colore.
-                    _beat_times_for_cuts = beat_times if beat_sync else None
-                    _rms_for_stripes = rms_envelope if beat_sync else None
-                    if mix_mode == "Quote Fisse":
-                        final, cut_schedule = engine.generate_fixed_quota(
-                            quotas, r_a, r_b, r_rand, run_durata, fps,
-                            s_a, s_b, s_rand, scan_dir, p_bar, use_scan,
-                            beat_times=_beat_times_for_cuts, rms_envelope=_rms_for_stripes,
-                            export_size=export_size_run
-                        )
-                    else:
-                        final, cut_schedule = engine.generate(
-                            weights, r_a, r_b, r_rand, run_durata, fps,
-                            s_a, s_b, s_rand, scan_dir, p_bar, use_scan,
-                            beat_times=_beat_times_for_cuts, rms_envelope=_rms_for_stripes,
-                            export_size=export_size_run
-                        )
-                    total_frags = engine.stats["fragments"]
-                    mode_label = "Decompose"
-
-                    # --- Bande Temporali (Temporal Band Slicer) ---
-                    # Applicata SUBITO dopo la composizione del clip, prima di
-                    # qualsiasi altro post-processing (strisce/colore): meno
-                    # step incatenati sul .fl() precedente = minor rischio di
-                    # crash/instabilita' in fase di render.
-                    if temporal_bands_on:
-                        final = final.fl(lambda gf, t: apply_temporal_bands_clip(
-                            gf, t, tb_intensity, tb_ampiezza, tb_spostamento, tb_direzione))
-
-                    if mix_mode == "Quote Fisse":
-                        mix_log = "Quote Fisse — " + " / ".join(
-                            f"V{k+1}:{quotas.get(k,0)}%" for k in paths.keys())
-                    else:
-                        mix_log = "Random (pesi Start%/End%)"
-                    extra_log = (f"* Ritmo: {r_a}s >> {r_b}s (Random: {r_rand})\n"
-                                 f"* Strisce: {s_a}px >> {s_b}px (Random: {s_rand})\n"
-                                 f"* Geometria: {scan_dir}\n"
-                                 f"* Formato: {formato_label}")
-                    if temporal_bands_on:
-                        extra_log += (
-                            f"\n* Bande Temporali: intensita' {int(tb_intensity*100)}% "
-                            f"/ ampiezza {int(tb_ampiezza*100)}% / spostamento {int(tb_spostamento*100)}% "
-                            f"/ direzione {int(tb_direzione*100)}%"
-                        )
-                else:
-                    # generate_dj_remix usa beat_times SOLO se
-                    # beat_slice_mode=True (corretto, gia' un parametro
-                    # esplicito) — ma la modulazione di slice_density e il
-                    # burst-override di react_to_peaks reagiscono alla sola
-                    # PRESENZA di rms/band_envelope, non a un flag dedicato.
-                    # Da quando l'analisi puo' partire anche solo per
-                    # colore/saturazione, vanno passati None se l'utente non
-                    # ha acceso beat_slice_mode ne' freeze_on_beat — sennò
-                    # accendere il colore farebbe scattare in silenzio anche
-                    # densita' di taglio reattiva e burst override.
-                    _vj_rms_for_engine = vj_rms_envelope if (beat_slice_mode or freeze_on_beat) else None
-                    _vj_band_for_engine = vj_band_envelope if (beat_slice_mode or freeze_on_beat) else None
-                    # MODULATION LAB: costruita solo se il toggle e' attivo E
-                    # ci sono onset disponibili. In ogni altro caso e' None,
-                    # quindi generate_dj_remix si comporta esattamente come
-                    # prima dell'introduzione di questa funzionalita'.
-                    _mod_matrix = None
-                    if mod_lab_on and vj_onset_times:
-                        _mod_matrix = build_start_offset_matrix(
-                            vj_onset_times, run_durata, amount=mod_matrix_amount
-                        )
-
-                    # MODULATION LAB: curva per la striscia selettiva pulsante,
-                    # indipendente da _mod_matrix (post-processing sul clip
-                    # gia' composto, non tocca generate_dj_remix). None se
-                    # disattivata o senza onset -> nessun impatto.
-                    _stripe_opacity_curve = None
-                    if stripe_mod_on and vj_onset_times:
-                        _stripe_opacity_curve = build_stripe_opacity_curve(
-                            vj_onset_times, max(1, int(run_durata * fps)), fps,
-                            amount=stripe_mod_amount
-                        )
-
-                    # Banda selettiva 2: stessa logica, indipendente dalla prima.
-                    _stripe_opacity_curve_2 = None
-                    if stripe_mod_on_2 and vj_onset_times:
-                        _stripe_opacity_curve_2 = build_stripe_opacity_curve(
-                            vj_onset_times, max(1, int(run_durata * fps)), fps,
-                            amount=stripe_mod_amount_2
-                        )
-
-                    final, total_frags, cut_schedule = generate_dj_remix(
-                        engine.video_clips, run_durata, fps,
-                        slice_dur, loop_reps, stutter_prob, pitch_glitch, p_bar,
-                        beat_slice_mode=beat_slice_mode,
-                        beat_times=beat_times,
-                        rms_envelope=_vj_rms_for_engine,
-                        band_envelope=_vj_band_for_engine,
-                        crossfade_dur=crossfade_dur,
-                        freeze_on_beat=freeze_on_beat,
-                        freeze_prob=freeze_prob,
-                        freeze_dur=freeze_dur,
-                        source_mode=source_mode,
-                        source_weights=source_weights,
-                        no_repeat=no_repeat,
-                        slice_density=slice_density,
-                        beat_subdivision_mode=beat_subdivision_mode,
-                        beat_subdivision_factor=beat_subdivision_factor,
-                        beat_subdivision_choices=beat_subdivision_choices,
-                        manual_duration_mode=manual_duration_mode,
-                        manual_duration_choices=manual_duration_choices,
-                        export_size=export_size_run,
-                        react_to_peaks=react_to_peaks,
-                        cut_source=cut_source,
-                        onset_times=vj_onset_times,
-                        subdivision_coarsen=_auto_coarsen,
-                        mod_matrix=_mod_matrix,
-                        mod_matrix_fps=fps
-                    )
-                    mode_label = "VJ Mode"
-
-                    # --- Bande Temporali (Temporal Band Slicer) ---
-                    # Applicata SUBITO dopo la composizione del clip, prima
-                    # delle strisce selettive (Modulation Lab): meno step
-                    # incatenati sul .fl() precedente = minor rischio di
-                    # crash/instabilita' in fase di render.
-                    if temporal_bands_on:
-                        final = final.fl(lambda gf, t: apply_temporal_bands_clip(
-                            gf, t, tb_intensity, tb_ampiezza, tb_spostamento, tb_direzione))
-
-                    if beat_slice_mode and beat_times:
-                        _subdiv_lbl = next((m for m, v in MEASURE_FACTORS.items() if abs(v - beat_subdivision_factor) < 1e-9), "1/1")
-                        _subdiv_str = {"fixed": _subdiv_lbl, "tempo_adaptive": "adattiva al tempo", "random_total": "random totale", "random_subset": "random in range"}.get(beat_subdivision_mode, _subdiv_lbl)
-                        slice_info = f"beat-driven ({beat_count} beat, subdiv {_subdiv_str})"
-                    else:
-                        slice_info = f"{slice_dur}s fisso"
-                    mix_log = (f"VJ Mode — slice {slice_info} / "
-                               f"loop x{loop_reps} / stutter {int(stutter_prob*100)}%")
-                    src_alt_log = ("Pesata — " + " / ".join(
-                        f"V{k+1}:{source_weights.get(k,0)}%" for k in source_weights)
-                        if source_mode == "pesata" else "Casuale")
-                    extra_log = (f"* Slice Mode: {slice_info}\n"
-                                 f"* Loop Reps: {loop_reps}" +
-                                 (f" (ridotto da x{_loop_reps_est} per RAM safety)"
-                                  if auto_vj and _auto_loop_reps_cap is not None and _auto_loop_reps_cap < _loop_reps_est else "") + "\n"
-                                 f"* Stutter Prob: {int(stutter_prob*100)}%\n"
-                                 f"* Pitch Glitch: {pitch_glitch}\n"
-                                 f"* Alternanza Sorgenti: {src_alt_log}"
-                                 f"{' (no ripetizioni consecutive)' if no_repeat else ''}\n"
-                                 f"* Auto VJ: {auto_vj}" +
-                                 (f" (preset {vj_genre})" if auto_vj and vj_genre else "") +
-                                 (f" — subdivisione allargata x{_auto_coarsen:.0f} (RAM safety)"
-                                  if _auto_coarsen > 1.0 else "") + "\n"
-                                 f"* Crossfade: {int(crossfade_dur*1000)}ms\n"
-                                 f"* Freeze on beat: {freeze_on_beat}" +
-                                 (f" ({int(freeze_prob*100)}% / {int(freeze_dur*1000)}ms)"
-                                  if freeze_on_beat else "") +
-                                 (f" (ridotto da {int(_freeze_prob_est*100)}% per RAM safety)"
-                                  if auto_vj and freeze_on_beat and _auto_freeze_cap is not None
-                                     and _freeze_prob_est is not None and _auto_freeze_cap < _freeze_prob_est else "") + "\n"
-                                 f"* Audio Mix: {AUDIO_MIX_LABELS.get(audio_mix_mode, audio_mix_mode)}" +
-                                 (f" (musica {int(vol_music*100)}% / originale {int(vol_original*100)}%)"
-                                  if audio_mix_mode in ("mix", "mix_decomposed") else "") + "\n"
-                                 f"* Reattivita' multi-banda: {'ON' if _vj_band_for_engine else 'OFF'}\n"
-                                 f"* Formato: {formato_label}")
-                    if temporal_bands_on:
-                        extra_log += (
-                            f"\n* Bande Temporali: intensita' {int(tb_intensity*100)}% "
-                            f"/ ampiezza {int(tb_ampiezza*100)}% / spostamento {int(tb_spostamento*100)}% "
-                            f"/ direzione {int(tb_direzione*100)}%"
-                        )
-
-                    # MODULATION LAB: prepara la sorgente per la striscia
-                    # selettiva. Tre casi: (1) uno degli stessi video gia'
-                    # caricati sopra (nessun upload aggiuntivo: si riusa il
-                    # path gia' scritto su disco in 'paths'); (2) un video
-                    # caricato apposta; (3) nessuno -> resta il fallback
-                    # (stesso video sfasato nel tempo, gestito dentro
-                    # apply_selective_stripe quando stripe_source_get_frame
-                    # e' None). Resize SEMPLICE (stretch), non crop: il
-                    # contenuto della striscia non deve venire tagliato.
-                    _stripe_src_get_frame = None
-                    _stripe_src_duration = None
-                    _stripe_src_path = None
-                    if stripe_mod_on and stripe_source_choice != "Nessuna (fallback: sfasamento stesso video)":
-                        if stripe_source_choice == "Carica video separato" and stripe_video_file is not None:
-                            try:
-                                _stripe_src_path = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4').name
-                                with open(_stripe_src_path, "wb") as _sf:
-                                    _sf.write(stripe_video_file.read())
-                            except Exception as _e:
-                                _stripe_src_path = None
-                                st.warning(f"⚠️ Video striscia non leggibile ({_e}): uso il fallback.")
-                        else:
-                            # "Video N (nome file)" -> uno dei 4 gia' caricati:
-                            # riusa direttamente il path gia' scritto su disco.
-                            for _si in range(4):
-                                if stripe_source_choice.startswith(f"Video {_si+1} ") and _si in paths:
-                                    _stripe_src_path = paths[_si]
-                                    break
-
-                        if _stripe_src_path is not None:
-                            try:
-                                _stripe_src_clip = VideoFileClip(_stripe_src_path)
-                                _target_wh = tuple(final.size)
-                                if tuple(_stripe_src_clip.size) != _target_wh:
-                                    # resize SEMPLICE (stretch), non crop-to-fill:
-                                    # si vede l'intero fotogramma della sorgente,
-                                    # anche se il rapporto d'aspetto e' diverso.
-                                    _stripe_src_clip = _stripe_src_clip.resize(newsize=_target_wh)
-                                _stripe_src_get_frame = _stripe_src_clip.get_frame
-                                _stripe_src_duration = _stripe_src_clip.duration
-                            except Exception as _e:
-                                # Non deve mai far crashare il render: se la
-                                # sorgente scelta non e' decodificabile, si
-                                # torna al fallback, avvisando l'utente.
-                                _stripe_src_get_frame = None
-                                _stripe_src_duration = None
-                                st.warning(
-                                    f"⚠️ Sorgente striscia non leggibile ({_e}): uso il fallback "
-                                    f"(sfasamento {stripe_mod_offset_s}s dello stesso video)."
-                                )
-
-                    if stripe_mod_on and (stripe_base_opacity > 0 or _stripe_opacity_curve is not None):
-                        final = final.fl(lambda gf, t: apply_selective_stripe(
-                            gf, t, run_durata, fps, _stripe_opacity_curve,
-                            stripe_pct=stripe_mod_pct, stripe_pos_pct=stripe_mod_pos,
-                            orientation=stripe_mod_orient, time_offset=stripe_mod_offset_s,
-                            stripe_source_get_frame=_stripe_src_get_frame,
-                            stripe_source_duration=_stripe_src_duration,
-                            base_opacity=stripe_base_opacity,
-                            stripe_length_pct=stripe_length_pct,
-                            stripe_length_pos_pct=stripe_length_pos_pct,
-                            content_follows_band=stripe_content_follows,
-                            content_anchor_pos_pct=stripe_content_anchor_pos,
-                            content_anchor_length_pos_pct=stripe_content_anchor_length_pos,
-                            frozen_content=(stripe_frozen_crop if stripe_use_frozen else None)
-                        ))
-                        extra_log += (
-                            f"\n* Banda selettiva: base {int(stripe_base_opacity*100)}% "
-                            f"+ picco {int(stripe_mod_amount*100)}% su onset"
-                            + (" (video dedicato caricato)" if _stripe_src_get_frame is not None
-                               else f" (sfasamento {stripe_mod_offset_s}s stesso video)")
-                            + (f" — contenuto ancorato a {int(stripe_content_anchor_pos)}%/"
-                               f"{int(stripe_content_anchor_length_pos)}%" if stripe_content_follows else "")
-                            + (" — immagine catturata fissa" if stripe_use_frozen and stripe_frozen_crop is not None else "")
-                        )
-
-                    # MODULATION LAB: prepara la sorgente per la striscia
-                    # selettiva. Tre casi: (1) uno degli stessi video gia'
-                    # caricati sopra (nessun upload aggiuntivo: si riusa il
-                    # path gia' scritto su disco in 'paths'); (2) un video
-                    # caricato apposta; (3) nessuno -> resta il fallback
-                    # (stesso video sfasato nel tempo, gestito dentro
-                    # apply_selective_stripe quando stripe_source_get_frame
-                    # e' None). Resize SEMPLICE (stretch), non crop: il
-                    # contenuto della striscia non deve venire tagliato.
-                    _stripe_src_get_frame_2 = None
-                    _stripe_src_duration_2 = None
-                    _stripe_src_path_2 = None
-                    if stripe_mod_on_2 and stripe_source_choice_2 != "Nessuna (fallback: sfasamento stesso video)":
-                        if stripe_source_choice_2 == "Carica video separato" and stripe_video_file_2 is not None:
-                            try:
-                                _stripe_src_path_2 = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4').name
-                                with open(_stripe_src_path_2, "wb") as _sf_2:
-                                    _sf_2.write(stripe_video_file_2.read())
-                            except Exception as _e:
-                                _stripe_src_path_2 = None
-                                st.warning(f"⚠️ Video striscia non leggibile ({_e}): uso il fallback.")
-                        else:
-                            # "Video N (nome file)" -> uno dei 4 gia' caricati:
-                            # riusa direttamente il path gia' scritto su disco.
-                            for _si_2 in range(4):
-                                if stripe_source_choice_2.startswith(f"Video {_si_2+1} ") and _si_2 in paths:
-                                    _stripe_src_path_2 = paths[_si_2]
-                                    break
-
-                        if _stripe_src_path_2 is not None:
-                            try:
-                                _stripe_src_clip_2 = VideoFileClip(_stripe_src_path_2)
-                                _target_wh_2 = tuple(final.size)
-                                if tuple(_stripe_src_clip_2.size) != _target_wh_2:
-                                    # resize SEMPLICE (stretch), non crop-to-fill:
-                                    # si vede l'intero fotogramma della sorgente,
-                                    # anche se il rapporto d'aspetto e' diverso.
-                                    _stripe_src_clip_2 = _stripe_src_clip_2.resize(newsize=_target_wh_2)
-                                _stripe_src_get_frame_2 = _stripe_src_clip_2.get_frame
-                                _stripe_src_duration_2 = _stripe_src_clip_2.duration
-                            except Exception as _e:
-                                # Non deve mai far crashare il render: se la
-                                # sorgente scelta non e' decodificabile, si
-                                # torna al fallback, avvisando l'utente.
-                                _stripe_src_get_frame_2 = None
-                                _stripe_src_duration_2 = None
-                                st.warning(
-                                    f"⚠️ Sorgente striscia non leggibile ({_e}): uso il fallback "
-                                    f"(sfasamento {stripe_mod_offset_s_2}s dello stesso video)."
-                                )
-
-                    if stripe_mod_on_2 and (stripe_base_opacity_2 > 0 or _stripe_opacity_curve_2 is not None):
-                        final = final.fl(lambda gf, t: apply_selective_stripe(
-                            gf, t, run_durata, fps, _stripe_opacity_curve_2,
-                            stripe_pct=stripe_mod_pct_2, stripe_pos_pct=stripe_mod_pos_2,
-                            orientation=stripe_mod_orient_2, time_offset=stripe_mod_offset_s_2,
-                            stripe_source_get_frame=_stripe_src_get_frame_2,
-                            stripe_source_duration=_stripe_src_duration_2,
-                            base_opacity=stripe_base_opacity_2,
-                            stripe_length_pct=stripe_length_pct_2,
-                            stripe_length_pos_pct=stripe_length_pos_pct_2,
-                            content_follows_band=stripe_content_follows_2,
-                            content_anchor_pos_pct=stripe_content_anchor_pos_2,
-                            content_anchor_length_pos_pct=stripe_content_anchor_length_pos_2,
-                            frozen_content=(stripe_frozen_crop_2 if stripe_use_frozen_2 else None)
-                        ))
-                        extra_log += (
-                            f"\n* Banda selettiva 2: base {int(stripe_base_opacity_2*100)}% "
-                            f"+ picco {int(stripe_mod_amount_2*100)}% su onset"
-                            + (" (video dedicato caricato)" if _stripe_src_get_frame_2 is not None
-                               else f" (sfasamento {stripe_mod_offset_s_2}s stesso video)")
-                            + (f" — contenuto ancorato a {int(stripe_content_anchor_pos_2)}%/"
-                               f"{int(stripe_content_anchor_length_pos_2)}%" if stripe_content_follows_2 else "")
-                            + (" — immagine catturata fissa" if stripe_use_frozen_2 and stripe_frozen_crop_2 is not None else "")
-                        )
-
-
-                _prof["Costruzione Sequenza"] = time.perf_counter() - _t_stage
-
-                # --- Colore reattivo al beat (bassi/medi/alti -> RGB) ---
-                # Applicato sul clip video gia' composto, prima del mix
-                # audio: e' un post-processing indipendente dalla logica di
-                # taglio, quindi non serve toccare generate_dj_remix/engine.
-                # (i secondi REALI spesi qui dentro vengono misurati durante
-                # write_videofile, non ora: il clip e' lazy, il tint viene
-                # eseguito frame per frame solo quando si scrive il file)
-                _color_tint_acc = [0.0]
-                _sat_tint_acc = [0.0]
-                _color_band_env = decompose_band_envelope if app_mode == "Decompose" else vj_band_envelope
-                if color_react_amount > 0 and _color_band_env:
-                    final = apply_beat_color_react(final, _color_band_env, run_durata, color_react_amount, profile_acc=_color_tint_acc)
-                    extra_log += f"\n* Colore reattivo al beat: {int(color_react_amount*100)}%"
-                if saturation_react_amount > 0 and _color_band_env:
-                    final = apply_beat_saturation_react(final, _color_band_env, run_durata, saturation_react_amount, profile_acc=_sat_tint_acc)
-                    extra_log += f"\n* Saturazione reattiva al beat: {int(saturation_react_amount*100)}%"
-
-                _t_stage = time.perf_counter()
-
-                # Audio custom / mix
-                if use_custom_audio and audio_file:
-                    from moviepy.editor import AudioFileClip, CompositeAudioClip
-                    from moviepy.audio.fx.all import audio_loop, volumex
-                    audio_file.seek(0)
-                    tmp_audio = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-                    tmp_audio.write(audio_file.read())
-                    tmp_audio.close()
-                    tmp_audio_path = tmp_audio.name
-                    audio_clip = AudioFileClip(tmp_audio_path)
-
-                    if audio_mix_mode in ("custom_decomposed", "mix_decomposed"):
-                        # Gli slice tagliano anche il brano: stessa griglia
-                        # di tagli del video (cut_schedule), ma pescati a
-                        # caso nel brano invece che in sequenza naturale.
-                        audio_clip = decompose_audio_track(audio_clip, cut_schedule, run_durata)
-                    elif audio_clip.duration < run_durata:
-                        audio_clip = audio_loop(audio_clip, duration=run_durata)
-                    else:
-                        audio_clip = audio_clip.set_duration(run_durata)
-
-                    if audio_mix_mode in ("mix", "mix_decomposed") and final.audio is not None:
-                        music_track = audio_clip.fx(volumex, vol_music)
-                        original_track = final.audio.set_duration(run_durata).fx(volumex, vol_original)
-                        mixed = CompositeAudioClip([original_track, music_track]).set_duration(run_durata)
-                        final = final.set_audio(mixed)
-                    else:
-                        final = final.set_audio(audio_clip)
-                elif audio_mix_mode == "original_only":
-                    pass  # mantiene l'audio originale già presente in final
-
-                out_v = os.path.join(tempfile.gettempdir(), f"render_{random.randint(0,9999)}.mp4")
-                _prof["Mix Audio"] = time.perf_counter() - _t_stage
-                _t_stage = time.perf_counter()
-
-                p_bar.progress(0.75, text="Scrittura video...")
-                try:
-                    final.write_videofile(out_v, codec="libx264", audio_codec="aac",
-                                          preset="ultrafast", logger=None)
-                except Exception as _enc_err:
-                    # Stesso bug noto dell'encoder AAC nativo di FFmpeg
-                    # visto sulla preview ("Assertion diff >= 0 && diff <=
-                    # 120 failed at aacenc.c") puo' in teoria capitare anche
-                    # qui. Qui pero' l'audio e' DAVVERO nuovo (mixato da piu'
-                    # sorgenti a volumi diversi), quindi non si puo' semplice-
-                    # mente copiare come nella preview — si ritenta pero' con
-                    # un bitrate audio fisso esplicito, che nella pratica fa
-                    # spesso evitare l'assertion (percorso interno diverso
-                    # nell'encoder rispetto al bitrate variabile di default).
-                    if "aacenc" in str(_enc_err) or "Broken pipe" in str(_enc_err):
-                        final.write_videofile(out_v, codec="libx264", audio_codec="aac",
-                                              audio_bitrate="192k",
-                                              preset="ultrafast", logger=None)
-                    else:
-                        raise
-                final.close()
-
-                # Il write_videofile qui sopra e' dove TUTTO il lavoro lazy
-                # dei clip viene davvero eseguito (decodifica sorgenti,
-                # crossfade, e anche il tint colore frame per frame): il
-                # tempo misurato include quindi decode+encode+tint insieme.
-                # _color_tint_acc[0] isola quanto di quel totale e' SOLO
-                # l'aritmetica del tint (esclusa la decodifica), per capire
-                # quanto pesa davvero sul totale invece di supporlo.
-                # (misurato PRIMA della sleep() di sicurezza qui sotto, che
-                # e' un'attesa fissa per il flush su disco e non lavoro vero)
-                _t_encode_final = time.perf_counter() - _t_stage
-                _prof["Encoding Finale (decode+encode)"] = _t_encode_final - _color_tint_acc[0] - _sat_tint_acc[0]
-                if _color_tint_acc[0] > 0:
-                    _prof["  di cui Tint Colore"] = _color_tint_acc[0]
-                if _sat_tint_acc[0] > 0:
-                    _prof["  di cui Boost Saturazione"] = _sat_tint_acc[0]
-                time.sleep(1.5)
-                _t_stage = time.perf_counter()
-
-                # --- Anteprima 480p ---
-                # NON si riparte da 'final' (l'intera catena di frammenti,
-                # crossfade e composizione andrebbe rieseguita una seconda
-                # volta: su un brano corto e' invisibile, su 3-4 minuti con
-                # centinaia/migliaia di frammenti raddoppia memoria di picco
-                # e tempo, proprio il tipo di carico che fa andare in OOM un
-                # host con RAM limitata come il piano gratuito di Streamlit
-                # Cloud). Si riapre invece il file GIA' scritto su disco: e'
-                # un singolo stream h264 semplice, molto piu' leggero da
-                # ridecodificare che l'intero grafo di clip.
-                p_bar.progress(0.90, text="Generando preview...")
-                prev_v = os.path.join(tempfile.gettempdir(), f"preview_{random.randint(0,9999)}.mp4")
-                prev_src = VideoFileClip(out_v)
-                prev_clip = prev_src.resize(height=480)
-                # L'audio qui NON cambia affatto (solo il video viene
-                # ridimensionato) — quindi si copia lo stream audio gia'
-                # codificato invece di ri-codificarlo da capo. Oltre a
-                # essere piu' veloce, evita un bug noto dell'encoder AAC
-                # nativo di FFmpeg ("Assertion diff >= 0 && diff <= 120
-                # failed at aacenc.c") che puo' scattare proprio quando si
-                # ri-codifica audio gia' passato una volta per un encoder
-                # AAC. "-c:a copy" (aggiunto DOPO audio_codec="aac" nei
-                # parametri, cosi' vince sulla riga di comando FFmpeg)
-                # bypassa l'encoder del tutto per questo passaggio.
-                try:
-                    prev_clip.write_videofile(prev_v, codec="libx264", audio_codec="aac",
-                                              preset="ultrafast", logger=None,
-                                              ffmpeg_params=["-c:a", "copy"])
-                except Exception:
-                    # Fallback raro: se lo stream copy fallisce per qualche
-                    # incompatibilita' di formato, si torna alla ri-codifica
-                    # normale (il bug aacenc non si presenta sempre).
-                    prev_clip.write_videofile(prev_v, codec="libx264", audio_codec="aac",
-                                              preset="ultrafast", logger=None)
-                prev_clip.close()
-                prev_src.close()
-                _prof["Encoding Preview"] = time.perf_counter() - _t_stage
-                time.sleep(0.5)
-                p_bar.progress(1.0, text="Pronto!")
-
-                # Nome condiviso video + report (stesso codice)
-                render_id = datetime.now().strftime("%Y%m%d_%H%M%S")
-                mode_short = "VJ" if app_mode == "VJ Mode" else "DC"
-                render_name = f"loop507_{mode_short}_{render_id}"
-
-                st.session_state.video_path   = out_v
-                st.session_state.preview_path = prev_v
-                st.session_state.render_name  = render_name
-
-                _prof_total = sum(v for k, v in _prof.items() if not k.startswith("  "))
-                _prof_lines = "\n".join(
-                    f"* {k}: {v:.1f}s ({v / _prof_total * 100:.0f}%)" if _prof_total > 0 else f"* {k}: {v:.1f}s"
-                    for k, v in _prof.items()
-                )
-                profiling_log = (
-                    f":: PROFILAZIONE RENDER (totale {_prof_total:.1f}s):\n{_prof_lines}"
-                )
-                st.session_state.profiling_log = profiling_log
-
-                _bpm_line = ""
-                if detected_bpm:
-                    _bpm_is_manual = st.session_state.get("manual_bpm_input", 0.0) > 0
-                    _bpm_line = f"* BPM: {detected_bpm:.1f}" + (" (manuale)" if _bpm_is_manual else " (rilevato)")
-
-                _log_lines = [
-                    f"* Sorgenti Video: {engine.stats['sources']}",
-                    f"* Frammenti Generati: {total_frags}",
-                    f"* Modalita': {mix_log}",
-                ]
-                if _bpm_line:
-                    _log_lines.append(_bpm_line)
-                if extra_log:
-                    _log_lines.append(extra_log)
-                if beat_sync and audio_file:
-                    _log_lines.append(f"* Beat Sync: ON — {beat_count} beat rilevati")
-                if app_mode == "VJ Mode" and beat_slice_mode and beat_times:
-                    _n_slice = len(vj_onset_times) if cut_source == "onset" and vj_onset_times else beat_count
-                    _slice_label = "onset rilevati" if cut_source == "onset" else "beat rilevati"
-                    _log_lines.append(f"* Slice Automatico: ON — {_n_slice} {_slice_label}")
-                _log_block = "\n".join(_log_lines)
-
-                report_it = f"""[DECOMP_ARCHIVE] // VOL_01 // H.264 // AAC
-:: FILE: {render_name}
-:: STILE: Minimalismo Computazionale / Glitch Brutalista
-:: MOTORE: video_decomposed [05.03]
-:: AUDIO: 48 kHz / Float a 32 bit / Punto di Clipping
-:: PROCESSO: {mode_label}
-
-:: TECHNICAL LOG SHEET:
-{_log_block}
-
-{profiling_log}
-
-"Non e' montaggio. E' anatomia di un segnale corrotto."
-
-:: Regia e Algoritmo: Loop507
-
-#loop507 #datanoise #decomposition #glitchart #audiovisual #noisemusic #algorithmicvideo #brutalist #sounddesign #computationalminimalism #signalcorruption #recursivecollapse #newmediaart"""
-
-                report_en = translate_report_to_en(report_it)
-
-                st.session_state.report_data = report_it + "\n\n" + ("=" * 40) + "\n\n" + report_en + "\n"
-                st.session_state.video_ready = True
-
+                with st.spinner("Pianificazione del montaggio..."):
+                    st.session_state.scrub_server = frame_server(cfg, analysis_cache=st.session_state)
+                st.session_state.scrub_seed = cfg.seed
             except Exception as e:
                 st.error(f"Errore: {e}")
 
-            finally:
-                if engine is not None:
-                    engine.close_sources()
-                for p in paths.values():
-                    try:
-                        os.remove(p)
-                    except OSError:
-                        pass
-                if tmp_audio_path:
-                    try:
-                        os.remove(tmp_audio_path)
-                    except OSError:
-                        pass
+        if do_final:
+            # Il render gira in un worker separato: lo script termina
+            # subito e il pannello qui sotto ne segue l'avanzamento.
+            try:
+                job_id = _render_queue().submit(cfg, owner=_job_owner())
+            except Exception as e:
+                st.error(f"Errore: {e}")
+            else:
+                st.session_state.render_job = job_id
+                st.session_state.video_ready = False
+                st.query_params["job"] = job_id
+                st.query_params["owner"] = _job_owner()
+
+        _rerun_lap("pannello risultati")
+        for _w in st.session_state.pop("render_warnings", []):
+            st.warning(_w)
+        if st.session_state.get("render_error"):
+            st.error(f"Errore: {st.session_state.pop('render_error')}")
+        if st.session_state.render_job:
+            _render_job_status(st.session_state.render_job)
 
         if st.session_state.video_ready:
             st.markdown("---")
@@ -4277,5 +8225,39 @@ def main():
                 st.download_button("Scarica Report", st.session_state.report_data,
                                    f"{st.session_state.render_name}_report.txt", key="down_t")
 
+        if st.session_state.get("scrub_server") is not None:
+            st.markdown("---")
+            st.caption("Timeline del montaggio")
+            _scrub_panel(st.session_state.scrub_server)
+            if st.button("Chiudi timeline", key="scrub_close"):
+                _close_scrub_server()
+                st.rerun()
+
+        with st.expander("Render recenti", expanded=False):
+            _JOB_STATUS_LBL = {"queued": "in coda", "running": "in corso",
+                               "done": "pronto", "failed": "errore"}
+            for _job in _render_queue().recent(_job_owner(), 8):
+                _when = datetime.fromtimestamp(_job["created"]).strftime("%d/%m %H:%M:%S")
+                _col_j1, _col_j2 = st.columns([3, 1])
+                _col_j1.caption(
+                    f"`{_job['id']}` · {_when} · {_JOB_STATUS_LBL.get(_job['status'], _job['status'])}"
+                    + (f" {int(_job['progress'] * 100)}%" if _job["status"] == "running" else "")
+                )
+                if _job["status"] in ("done", "running", "queued") and \
+                        _col_j2.button("Apri", key=f"open_job_{_job['id']}"):
+                    st.session_state.render_job = _job["id"]
+                    st.query_params["job"] = _job["id"]
+                    st.query_params["owner"] = _job_owner()
+                    st.rerun()
+
+        if _RERUN_PROFILER is not None:
+            _rerun_profile_panel()
+
 if __name__ == "__main__":
-    main()
+    # "streamlit run app.py" esegue lo script con __name__ == "__main__":
+    # la CLI (python app.py render ...) parte solo fuori dal runtime.
+    from streamlit import runtime
+    if runtime.exists():
+        run_main()
+    else:
+        sys.exit(_cli())